@@ -0,0 +1,373 @@
+# fake_llm.py
+"""
+Offline stand-in for the OpenAI chat completions API.
+
+FakeLLMClient mimics client.chat.completions.create(...) in-process and
+returns real openai response types, so travel_plan.py cannot tell it apart
+from the OpenAI client. Output is itinerary Markdown in the SYSTEM_PROMPT
+format (or JSON when a json_schema response_format is requested), paced by a
+configurable latency and token rate.
+
+Use it in-process with LLM_BACKEND=fake, or run it as a local
+OpenAI-compatible HTTP stub:
+
+    python fake_llm.py --port 8001
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=stub streamlit run travel_plan.py
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+CHARS_PER_TOKEN = 4
+
+# --------------------------------------------
+# ITINERARY TEXT
+# --------------------------------------------
+
+MORNING_ACTIVITIES = [
+    "Breakfast at a neighbourhood café, then a guided walk through the old town",
+    "Visit the main history museum before the tour groups arrive",
+    "Explore the central market and sample local pastries",
+    "Early climb to the city viewpoint for panoramic photos",
+    "Stroll through the botanical gardens and riverside promenade",
+]
+AFTERNOON_ACTIVITIES = [
+    "Lunch at a family-run restaurant known for regional dishes",
+    "Tour the cathedral and the surrounding historic quarter",
+    "Browse artisan shops and galleries in the design district",
+    "Take a boat ride along the waterfront",
+    "Relax in a public park, then visit a contemporary art space",
+]
+EVENING_ACTIVITIES = [
+    "Sunset drinks at a rooftop bar overlooking the skyline",
+    "Dinner at a popular local bistro (reserve ahead)",
+    "Attend a live music or cultural performance",
+    "Evening food tour through the night market",
+    "Leisurely walk through illuminated landmarks",
+]
+TIPS = [
+    "Tip: buy a day transit pass to save on fares.",
+    "Tip: most museums close one day a week, so check hours in advance.",
+    "Tip: carry some cash for small vendors.",
+    "Tip: book popular restaurants a few days ahead.",
+]
+AIRLINES = [
+    ("Skyline Airways", "Frequent direct flights, good on-time record, mid-range fares"),
+    ("Atlas Air Lines", "Comfortable economy seats and generous baggage allowance"),
+    ("Horizon International", "Budget-friendly one-stop options with reliable connections"),
+]
+
+
+def parse_user_prompt(prompt: str) -> dict:
+    """Pull the trip fields out of a build_user_prompt() message."""
+    def field(label, default=""):
+        match = re.search(rf"^\s*{label}:\s*(.+)$", prompt, re.MULTILINE)
+        return match.group(1).strip() if match else default
+
+    days_text = field("Number of days", "3")
+    return {
+        "source_city": field("Traveling FROM", "Home"),
+        "destination": field("Traveling TO", "Destination"),
+        "dates": field("Travel dates", ""),
+        "days": int(days_text) if days_text.isdigit() else 3,
+        "condensed": "This is a long trip." in prompt,
+        "local_header": "are added separately" in prompt,
+        "airlines": "best airlines for flights" in prompt,
+    }
+
+
+def build_plan_data(trip: dict, rng: random.Random) -> dict:
+    """Random itinerary content in the shape of travel_plan.plan_json_schema()."""
+    bullets = 1 if trip["condensed"] else 3
+    plan = {}
+    if not trip["local_header"]:
+        plan["header"] = {
+            "travel_dates": trip["dates"],
+            "temperature": "15-25°C / 59-77°F",
+            "weather": "Mild and mostly sunny, with occasional showers",
+            "what_to_wear": "Light layers, comfortable walking shoes and a compact umbrella. "
+                            "Modest clothing for religious sites.",
+        }
+    plan["days"] = []
+    for day in range(1, trip["days"] + 1):
+        slots = []
+        for slot, activities in (
+            ("Morning", MORNING_ACTIVITIES),
+            ("Afternoon", AFTERNOON_ACTIVITIES),
+            ("Evening", EVENING_ACTIVITIES),
+        ):
+            items = [f"{activity} in {trip['destination']}." for activity in rng.sample(activities, bullets)]
+            if not trip["condensed"]:
+                items.append(rng.choice(TIPS))
+            slots.append({"name": slot, "activities": items})
+        plan["days"].append({"title": f"Day {day}", "slots": slots})
+    if trip["airlines"]:
+        plan["airlines"] = [
+            {"name": name, "reasons": [f"{reason} from {trip['source_city']} to {trip['destination']}."]}
+            for name, reason in AIRLINES[: rng.choice((2, 3))]
+        ]
+    return plan
+
+
+def build_itinerary(trip: dict, rng: random.Random) -> str:
+    """Produce itinerary Markdown in the SYSTEM_PROMPT output format."""
+    plan = build_plan_data(trip, rng)
+    lines = []
+    header = plan.get("header")
+    if header:
+        lines += [
+            f"**Travel Dates:** {header['travel_dates']}",
+            f"**Expected Temperature:** {header['temperature']}",
+            f"**Weather:** {header['weather']}",
+            f"**What to Wear:** {header['what_to_wear']}",
+            "",
+        ]
+    for day in plan["days"]:
+        lines.append(f"## {day['title']}")
+        for slot in day["slots"]:
+            lines.append(f"**{slot['name']}:**")
+            lines += [f"- {activity}" for activity in slot["activities"]]
+            lines.append("")
+    if plan.get("airlines"):
+        lines.append("## ✈️ Recommended Airlines")
+        for airline in plan["airlines"]:
+            lines.append(f"**{airline['name']}**")
+            lines += [f"- {reason}" for reason in airline["reasons"]]
+            lines.append("")
+    return "\n".join(lines).strip()
+
+
+def build_itinerary_json(trip: dict, rng: random.Random, response_format: dict) -> str:
+    """Produce a JSON plan restricted to the properties the response schema asks for."""
+    schema = response_format.get("json_schema", {}).get("schema", {})
+    properties = schema.get("properties")
+    plan = build_plan_data(trip, rng)
+    if properties is not None:
+        plan = {key: plan.get(key, {} if key == "header" else []) for key in properties}
+    return json.dumps(plan, ensure_ascii=False, indent=1)
+
+
+def estimate_tokens(text: str) -> int:
+    """Same chars/4 heuristic as travel_plan.estimate_tokens."""
+    return -(-len(text or "") // CHARS_PER_TOKEN)
+
+# --------------------------------------------
+# FAKE CLIENT
+# --------------------------------------------
+
+
+class FakeStream:
+    """Iterable of ChatCompletionChunk objects with the same close() as openai.Stream."""
+
+    def __init__(self, chunks, latency: float, tokens_per_second: float):
+        self._chunks = chunks
+        self._latency = latency
+        self._tokens_per_second = tokens_per_second
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        if self._closed.wait(self._latency):
+            return
+        started = time.perf_counter()
+        emitted = 0
+        for chunk, tokens in self._chunks:
+            emitted += tokens
+            delay = started + emitted / self._tokens_per_second - time.perf_counter()
+            if delay > 0 and self._closed.wait(delay):
+                return
+            if self._closed.is_set():
+                return
+            yield chunk
+
+    def close(self):
+        self._closed.set()
+
+
+class FakeCompletions:
+    """Implements chat.completions.create() for FakeLLMClient."""
+
+    def __init__(self, owner: "FakeLLMClient"):
+        self._owner = owner
+
+    def create(self, model, messages, max_tokens=None, stream=False, stream_options=None, response_format=None, **kwargs):
+        owner = self._owner
+        prompt = "\n".join(m["content"] for m in messages)
+        user_prompt = next((m["content"] for m in messages if m["role"] == "user"), "")
+        with owner.lock:
+            rng = random.Random(owner.rng.random())
+            owner.requests += 1
+        latency = owner.slow_latency if rng.random() < owner.slow_rate else owner.latency
+        trip = parse_user_prompt(user_prompt)
+        if response_format and response_format.get("type") == "json_schema":
+            text = build_itinerary_json(trip, rng, response_format)
+        else:
+            text = build_itinerary(trip, rng)
+
+        finish_reason = "stop"
+        if max_tokens and estimate_tokens(text) > max_tokens:
+            text = text[: max_tokens * CHARS_PER_TOKEN]
+            finish_reason = "length"
+
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_tokens": estimate_tokens(text),
+            "total_tokens": estimate_tokens(prompt) + estimate_tokens(text),
+        }
+        completion_id = f"chatcmpl-fake-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if not stream:
+            total = latency + usage["completion_tokens"] / owner.tokens_per_second
+            time.sleep(total)
+            return ChatCompletion.model_validate({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": finish_reason,
+                }],
+                "usage": usage,
+            })
+
+        def chunk(delta, finish=None, chunk_usage=None, with_choice=True):
+            return ChatCompletionChunk.model_validate({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if with_choice else [],
+                "usage": chunk_usage,
+            })
+
+        # One chunk per word keeps streaming close to per-token granularity
+        chunks = [(chunk({"role": "assistant", "content": ""}), 0)]
+        for piece in re.findall(r"\S+\s*|\s+", text):
+            chunks.append((chunk({"content": piece}), estimate_tokens(piece)))
+        chunks.append((chunk({}, finish=finish_reason), 0))
+        if stream_options and stream_options.get("include_usage"):
+            chunks.append((chunk(None, chunk_usage=usage, with_choice=False), 0))
+        return FakeStream(chunks, latency, owner.tokens_per_second)
+
+
+class FakeLLMClient:
+    """
+    Drop-in for OpenAI(...) that generates itineraries locally.
+    latency is the time to first token; tokens_per_second paces the output.
+    A slow_rate fraction of requests waits slow_latency instead (a latency tail).
+    """
+
+    def __init__(self, latency: float = 0.5, tokens_per_second: float = 80.0, seed: int = None,
+                 slow_rate: float = 0.0, slow_latency: float = 0.0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.chat = SimpleNamespace(completions=FakeCompletions(self))
+
+    @classmethod
+    def from_env(cls) -> "FakeLLMClient":
+        """Configure from FAKE_LLM_LATENCY / FAKE_LLM_TOKENS_PER_SEC / FAKE_LLM_SEED / FAKE_LLM_SLOW_RATE / FAKE_LLM_SLOW_LATENCY."""
+        seed = os.getenv("FAKE_LLM_SEED")
+        return cls(
+            latency=float(os.getenv("FAKE_LLM_LATENCY", "0.5")),
+            tokens_per_second=float(os.getenv("FAKE_LLM_TOKENS_PER_SEC", "80")),
+            seed=int(seed) if seed else None,
+            slow_rate=float(os.getenv("FAKE_LLM_SLOW_RATE", "0")),
+            slow_latency=float(os.getenv("FAKE_LLM_SLOW_LATENCY", "0")),
+        )
+
+# --------------------------------------------
+# HTTP STUB SERVER
+# --------------------------------------------
+
+
+def make_handler(fake: FakeLLMClient):
+    """Request handler serving POST /v1/chat/completions from a FakeLLMClient."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            result = fake.chat.completions.create(
+                model=body.get("model", "fake"),
+                messages=body.get("messages", []),
+                max_tokens=body.get("max_tokens"),
+                stream=body.get("stream", False),
+                stream_options=body.get("stream_options"),
+                response_format=body.get("response_format"),
+            )
+
+            if not body.get("stream"):
+                payload = result.model_dump_json(exclude_none=True).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            try:
+                for chunk in result:
+                    self.wfile.write(f"data: {chunk.model_dump_json(exclude_none=True)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # Client cancelled the request
+                result.close()
+            self.close_connection = True
+
+    return Handler
+
+
+def serve(host: str, port: int, fake: FakeLLMClient):
+    """Run the OpenAI-compatible stub until interrupted."""
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    print(f"Fake LLM listening on http://{host}:{port}/v1 "
+          f"(latency {fake.latency}s, {fake.tokens_per_second} tokens/s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible fake LLM server for itinerary generation.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of requests with --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="seconds to first token for slow requests")
+    args = parser.parse_args()
+    serve(args.host, args.port, FakeLLMClient(args.latency, args.tokens_per_second, args.seed, args.slow_rate, args.slow_latency))
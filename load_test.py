@@ -0,0 +1,192 @@
+# load_test.py
+"""
+Load-test the planning path without spending API money.
+
+Simulates N concurrent sessions, each running generate -> render -> export
+the way the Streamlit UI does (background job, plan rendering, PDF build),
+against the in-process FakeLLMClient. Reports throughput and per-stage
+latency percentiles.
+
+    python load_test.py --sessions 20 --iterations 3 --latency 0.5 --tokens-per-second 200
+
+Pass --backend openai to drive the configured backend instead (e.g. the
+fake_llm.py HTTP stub via OPENAI_BASE_URL).
+"""
+
+import argparse
+import io
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import travel_plan
+
+# Streamlit warns about a missing ScriptRunContext on every st.* call outside `streamlit run`
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(lambda record: False)
+from fake_llm import FakeLLMClient
+
+STAGES = ("generate", "render", "export", "total")
+JOB_POLL_SECONDS = 0.05
+
+
+def percentile(values, pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class LoadTestResults:
+    """Thread-safe collection of per-stage timings and errors."""
+
+    def __init__(self):
+        self.timings = {stage: [] for stage in STAGES}
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            self.timings[stage].append(seconds)
+
+    def error(self, message: str):
+        with self.lock:
+            self.errors.append(message)
+
+
+def run_iteration(session_id: int, iteration: int, args, results: LoadTestResults):
+    """One user flow: generate the plan, render it, export the PDF."""
+    rng = random.Random(session_id * 1000 + iteration)
+    destination = rng.choice(sorted(travel_plan.DEST_BG_IMAGES)).title()
+    # Unique dates per flow so the job manager never de-duplicates two sessions
+    start_date = datetime.now().date() + timedelta(days=session_id * args.iterations + iteration)
+    days = args.days or rng.randint(2, 10)
+    params = {
+        "source_city": "Dallas, Texas",
+        "destination": destination,
+        "start_date": start_date,
+        "end_date": start_date + timedelta(days=days - 1),
+        "days": days,
+        "interests": rng.choice(["", "Museums, Food", "Nature, Nightlife", "History"]),
+        "guardrails": rng.choice(["", "Family-friendly", "Budget-conscious"]),
+    }
+
+    flow_started = time.perf_counter()
+    started = flow_started
+    job = travel_plan.get_job_manager().submit(params)
+    while job.is_active:
+        time.sleep(JOB_POLL_SECONDS)
+    if job.status != travel_plan.JOB_DONE:
+        results.error(f"session {session_id}: generate {job.status} {job.error}")
+        return
+    results.add("generate", time.perf_counter() - started)
+
+    started = time.perf_counter()
+    travel_plan.render_plan(
+        job.result, params["source_city"], destination, params["start_date"], params["end_date"], days
+    )
+    results.add("render", time.perf_counter() - started)
+
+    started = time.perf_counter()
+    try:
+        travel_plan.generate_pdf(
+            job.result, destination, params["source_city"], params["start_date"], params["end_date"], days,
+            fetch_images=args.images, output=io.BytesIO(),
+        )
+    except Exception as e:
+        results.error(f"session {session_id}: export failed: {e}")
+        return
+    results.add("export", time.perf_counter() - started)
+    results.add("total", time.perf_counter() - flow_started)
+
+
+def run_session(session_id: int, args, results: LoadTestResults):
+    """A simulated user running several flows back to back."""
+    for iteration in range(args.iterations):
+        try:
+            run_iteration(session_id, iteration, args, results)
+        except Exception as e:
+            results.error(f"session {session_id}: {e}")
+        if args.think_time:
+            time.sleep(args.think_time)
+
+
+def print_report(results: LoadTestResults, elapsed: float, args):
+    """Print throughput, latency percentiles and token usage."""
+    completed = len(results.timings["total"])
+    print()
+    print(f"Sessions: {args.sessions}  Iterations/session: {args.iterations}  Job workers: {travel_plan.JOB_WORKERS}")
+    print(f"Completed flows: {completed}  Errors: {len(results.errors)}  Wall time: {elapsed:.2f}s")
+    print(f"Throughput: {completed / elapsed:.2f} flows/s ({completed / elapsed * 60:.1f} flows/min)")
+    print()
+    print(f"{'stage':<10}{'count':>7}{'mean':>10}{'p50':>10}{'p90':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage in STAGES:
+        values = results.timings[stage]
+        if not values:
+            continue
+        print(
+            f"{stage:<10}{len(values):>7}{sum(values) / len(values):>10.3f}"
+            f"{percentile(values, 50):>10.3f}{percentile(values, 90):>10.3f}"
+            f"{percentile(values, 95):>10.3f}{percentile(values, 99):>10.3f}{max(values):>10.3f}"
+        )
+    usage = travel_plan.get_token_usage_log().summary()
+    if usage.get("requests"):
+        print()
+        print(
+            f"Tokens: avg prompt {usage['avg_prompt_tokens']:.0f}, "
+            f"avg completion {usage['avg_completion_tokens']:.0f}, "
+            f"estimate ratio {usage['estimate_ratio']:.2f}, truncated {usage['truncated']}"
+        )
+    memory = travel_plan.memory_report()
+    print()
+    print(f"Memory: RSS {memory['rss_mb']} MB, jobs {memory['jobs']} ({memory['job_text_bytes'] / 1024:.0f} KB text)")
+    for cache in memory["caches"]:
+        print(f"  {cache['name']}: {cache['entries']} entries, {cache['bytes'] / 1024:.0f} KB, {cache['hits']} hits")
+    print()
+    for route in travel_plan.get_model_router().report():
+        print(
+            f"Route {route['route']}: {route['attempts']} attempts, {route['hedges']} hedges, "
+            f"{route['wins']} wins, {route['failures']} failures, first token p50 {route['first_token_p50']:.2f}s "
+            f"p95 {route['first_token_p95']:.2f}s, hedge delay {route['hedge_delay']:.2f}s"
+        )
+    for message in results.errors[:10]:
+        print(f"✗ {message}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test for the travel planning path.")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent simulated sessions")
+    parser.add_argument("--iterations", type=int, default=3, help="flows per session")
+    parser.add_argument("--days", type=int, default=0, help="trip length (default: random 2-10)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="pause between flows (s)")
+    parser.add_argument("--backend", choices=("fake", "openai"), default="fake")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake backend time to first token (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="fake backend output rate")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of fake requests that are slow")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="fake time to first token for slow requests (s)")
+    parser.add_argument("--images", action="store_true", help="download PDF watermark images")
+    args = parser.parse_args()
+
+    if args.backend == "fake":
+        travel_plan.set_llm_client(
+            FakeLLMClient(args.latency, args.tokens_per_second, args.seed, args.slow_rate, args.slow_latency)
+        )
+    else:
+        travel_plan.set_llm_client(travel_plan.create_llm_client("openai"))
+
+    results = LoadTestResults()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        for session_id in range(args.sessions):
+            pool.submit(run_session, session_id, args, results)
+    elapsed = time.perf_counter() - started
+    print_report(results, elapsed, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import travel_plan as tp  # noqa: E402
+from fake_llm import FakeLLMClient  # noqa: E402
+
+
+@pytest.fixture
+def fake_client():
+    """Route every plan request to an in-process FakeLLMClient for the test."""
+    client = FakeLLMClient(latency=0.05, tokens_per_second=400, seed=7)
+    tp.set_llm_client(client)
+    yield client
+    tp.set_llm_client(None)
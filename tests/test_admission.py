@@ -0,0 +1,66 @@
+import threading
+import time
+from datetime import date
+
+import pytest
+
+import travel_plan as tp
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = tp.TokenBucket(rate=10.0, burst=2)
+    for _ in range(2):
+        assert bucket.wait_time(1) == 0.0
+        bucket.take(1)
+    assert bucket.wait_time(1) == pytest.approx(0.1, abs=0.02)
+    time.sleep(0.12)
+    assert bucket.wait_time(1) == 0.0
+
+
+def test_admission_limits_each_client_and_sheds_on_overload():
+    overload = ""
+    controller = tp.AdmissionController("test", (60.0, 2), (600.0, 3), lambda: overload)
+    assert [controller.admit("s1", "ip").admitted for _ in range(3)] == [True, True, False]
+    limited = controller.admit("s1", "ip")
+    assert not limited.shed and limited.retry_after > 0
+    assert controller.admit("s2", "ip").admitted
+    assert not controller.admit("s3", "ip").admitted  # the IP bucket is empty now
+
+    overload = "Too busy."
+    shed = controller.admit("s4", "other-ip")
+    assert shed.shed and shed.reason == "Too busy." and shed.retry_after == tp.SHED_RETRY_AFTER
+    assert controller.report()["shed"] == 1
+
+
+def test_pdf_builds_in_flight_shed_new_exports(monkeypatch):
+    monkeypatch.setattr(tp, "MAX_INFLIGHT_PDFS", 2)
+    gate = threading.Event()
+    generate_pdf = tp.generate_pdf
+
+    def held_generate_pdf(*args, **kwargs):
+        gate.wait(10)
+        return generate_pdf(*args, **kwargs)
+
+    monkeypatch.setattr(tp, "generate_pdf", held_generate_pdf)
+    plan = f"## Day 1\n**Morning:**\n- Walk along the Seine ({time.time()})"
+    args = lambda n: (f"{plan} {n}", "Paris", "Dallas", date(2026, 11, 1), date(2026, 11, 1), 1)
+    admission = tp.AdmissionController("pdf_test", (0, 0), (0, 0), tp.pdf_overload)
+    admit = lambda: admission.admit("s", "ip")
+
+    builds = [threading.Thread(target=tp.export_pdf, args=args(n), kwargs=dict(fetch_images=False)) for n in range(2)]
+    for build in builds:
+        build.start()
+    deadline = time.monotonic() + 5
+    while tp.get_pdf_builds().load()[0] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    try:
+        with pytest.raises(tp.AdmissionRejected) as rejected:
+            tp.export_pdf(*args(2), fetch_images=False, admit=admit)
+        assert rejected.value.admission.shed
+    finally:
+        gate.set()
+        for build in builds:
+            build.join()
+
+    assert tp.get_pdf_builds().load()[0] == 0
+    assert tp.export_pdf(*args(2), fetch_images=False, admit=admit).startswith(b"%PDF")
@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+import uuid
+
+import pytest
+from starlette.testclient import TestClient
+
+import travel_api
+import travel_plan as tp
+
+TRIP = {"destination": "Rome", "start_date": "2026-11-01", "end_date": "2026-11-03"}
+LEGS = [
+    {"destination": "Tokyo", "start_date": "2026-04-01", "end_date": "2026-04-03"},
+    {"destination": "Kyoto", "start_date": "2026-04-04", "end_date": "2026-04-05"},
+]
+
+
+@pytest.fixture
+def api(fake_client):
+    with TestClient(travel_api.create_app()) as client:
+        yield client
+
+
+def fresh_trip(**fields) -> dict:
+    """Trip JSON no earlier test has generated, so it is never served from a finished job."""
+    return {"source_city": "Dallas", "interests": f"food {uuid.uuid4().hex}", **fields}
+
+
+def read_stream(api, trip: dict):
+    """(text rebuilt from the delta/reset lines, final line) of a streamed plan."""
+    with api.stream("POST", "/v1/plans?stream=1", json=trip) as response:
+        assert response.status_code == 200
+        lines = [json.loads(line) for line in response.iter_lines() if line]
+    text = ""
+    for line in lines[:-1]:
+        text = line["reset"] if "reset" in line else text + line["delta"]
+    return text, lines[-1]
+
+
+def test_streamed_multi_city_plan_matches_the_stitched_plan(api, fake_client):
+    fake_client.tokens_per_second = 1500
+    trip = fresh_trip(legs=LEGS)
+    text, final = read_stream(api, trip)
+    assert final["done"] and final["status"] == tp.JOB_DONE
+    plan_md = final.get("plan_md", text)
+    assert text == plan_md
+    assert "📍" not in plan_md and "Day 4 · Kyoto" in plan_md
+    assert api.post("/v1/plans", json=trip).json()["plan_md"] == plan_md
+
+
+def test_default_concurrency_matches_what_the_planner_can_hold():
+    assert travel_api.MAX_CONCURRENCY == tp.JOB_WORKERS + tp.MAX_QUEUED_JOBS + travel_api.PDF_WORKERS
+
+
+@pytest.mark.parametrize("body, error", [
+    ({**TRIP, "destination": " "}, "destination"),
+    ({**TRIP, "end_date": "2026-10-01"}, "end date"),
+    ({**TRIP, "end_date": "11/03/2026"}, "YYYY-MM-DD"),
+])
+def test_invalid_trips_are_rejected(api, body, error):
+    response = api.post("/v1/plans", json={"source_city": "Dallas", **body})
+    assert response.status_code == 400 and error.lower() in response.json()["error"].lower()
+
+
+def test_saturated_api_answers_503_with_retry_after(fake_client):
+    fake_client.latency = 1.0
+    with TestClient(travel_api.create_app(max_concurrency=1)) as api:
+        held = threading.Thread(target=api.post, args=("/v1/plans",), kwargs=dict(json=fresh_trip(**TRIP)))
+        held.start()
+        time.sleep(0.3)
+        response = api.post("/v1/plans", json=fresh_trip(**TRIP))
+        held.join()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(int(tp.SHED_RETRY_AFTER))
+
+
+def test_client_over_its_rate_gets_429_with_retry_after(api, monkeypatch):
+    controller = tp.AdmissionController("api_test", (6.0, 1), (0, 0), lambda: "")
+    monkeypatch.setattr(tp, "get_generation_admission", lambda: controller)
+    assert api.post("/v1/plans", json=fresh_trip(**TRIP), headers={"X-Client-Id": "a"}).status_code == 200
+
+    response = api.post("/v1/plans", json=fresh_trip(**TRIP), headers={"X-Client-Id": "a"})
+    assert response.status_code == 429 and 0 < int(response.headers["Retry-After"]) <= 10
+    assert "faster than we can serve" in response.json()["error"]
+    assert api.post("/v1/plans", json=fresh_trip(**TRIP), headers={"X-Client-Id": "b"}).status_code == 200
+
+
+def test_overloaded_planner_sheds_with_503(api, monkeypatch):
+    controller = tp.AdmissionController("api_test", (0, 0), (0, 0), lambda: "The planner is very busy right now.")
+    monkeypatch.setattr(tp, "get_generation_admission", lambda: controller)
+    response = api.post("/v1/plans", json=fresh_trip(**TRIP))
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(int(tp.SHED_RETRY_AFTER))
+    assert response.json()["error"].startswith("The planner is very busy right now.")
+
+
+def test_pdf_builds_are_rate_limited_but_cached_pdfs_are_free(api, monkeypatch):
+    controller = tp.AdmissionController("api_test", (6.0, 1), (0, 0), lambda: "")
+    monkeypatch.setattr(tp, "get_pdf_admission", lambda: controller)
+    plan_md = f"## Day 1\n**Morning:**\n- Pantheon ({uuid.uuid4().hex})"
+    body = {"source_city": "Dallas", **TRIP, "plan_md": plan_md, "images": False}
+    headers = {"X-Client-Id": "a"}
+    first = api.post("/v1/plans/pdf", json=body, headers=headers)
+    assert first.status_code == 200 and first.content.startswith(b"%PDF")
+    assert api.post("/v1/plans/pdf", json=body, headers=headers).content == first.content
+
+    response = api.post("/v1/plans/pdf", json={**body, "plan_md": plan_md + " again"}, headers=headers)
+    assert response.status_code == 429 and "Retry-After" in response.headers
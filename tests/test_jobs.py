@@ -0,0 +1,112 @@
+import threading
+import time
+from datetime import date
+from types import SimpleNamespace
+
+import travel_plan as tp
+
+TRIP = dict(source_city="Dallas", destination="Paris", start_date=date(2026, 11, 1), end_date=date(2026, 11, 3),
+            days=3, interests="", guardrails="")
+
+
+def failing_client(message: str):
+    def create(**kwargs):
+        raise RuntimeError(message)
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def test_fingerprint_ignores_key_order():
+    reordered = dict(reversed(list(TRIP.items())))
+    assert tp.job_fingerprint(reordered) == tp.job_fingerprint(TRIP)
+    assert tp.job_fingerprint(dict(TRIP, days=4)) != tp.job_fingerprint(TRIP)
+
+
+def test_job_streams_progress_then_keeps_only_the_result(fake_client):
+    job = tp.JobManager().submit(dict(TRIP, interests="progress"))
+    deadline = time.monotonic() + 10
+    while job.status != tp.JOB_RUNNING or not job.partial_text:
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+    partial = job.partial_text
+    job.future.result(timeout=30)
+    assert job.status == tp.JOB_DONE and job.result.startswith(partial)
+    assert job.partial_text == job.result
+
+
+def test_finished_jobs_are_reused_for_identical_inputs(fake_client):
+    jobs = tp.JobManager()
+    job = jobs.submit(dict(TRIP, interests="reuse"))
+    job.future.result(timeout=30)
+    assert jobs.find(dict(TRIP, interests="reuse")) is job
+    assert jobs.submit(dict(TRIP, interests="reuse")) is job
+    assert fake_client.requests == 1
+    assert jobs.find(dict(TRIP, interests="other")) is None
+
+
+def test_failed_and_fallback_jobs_are_not_reused(monkeypatch):
+    monkeypatch.setattr(tp, "_llm_client_override", failing_client("upstream down"))
+    jobs = tp.JobManager()
+    failed = jobs.submit(dict(TRIP, interests="fails"))
+    failed.future.result(timeout=10)
+    assert failed.status == tp.JOB_FAILED and "upstream down" in failed.error
+    assert jobs.find(dict(TRIP, interests="fails")) is None
+
+    failed.status, failed.fallback = tp.JOB_DONE, "template"
+    assert jobs.find(dict(TRIP, interests="fails")) is None
+
+
+def test_concurrent_identical_submits_share_one_job(fake_client):
+    jobs = tp.JobManager()
+    params = dict(TRIP, interests="museums")
+    results = []
+    threads = [
+        threading.Thread(target=lambda i=i: results.append(jobs.submit(params, subscriber=str(i))))
+        for i in range(16)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({job.job_id for job in results}) == 1
+    results[0].future.result(timeout=30)
+    assert results[0].status == tp.JOB_DONE and len(results[0].subscribers) == 16
+
+
+def test_job_is_cancelled_only_when_its_last_subscriber_leaves(fake_client):
+    fake_client.tokens_per_second = 100
+    jobs = tp.JobManager()
+    job = jobs.submit(dict(TRIP), subscriber="a")
+    assert jobs.submit(dict(TRIP), subscriber="b") is job
+
+    jobs.release(job.job_id, "a")
+    time.sleep(0.2)
+    assert job.is_active and not job.cancel_event.is_set()
+
+    jobs.release(job.job_id, "b")
+    job.future.result(timeout=10)
+    assert job.status == tp.JOB_CANCELLED
+    assert jobs.submit(dict(TRIP), subscriber="c") is not job
+
+
+def test_cancelled_trip_keeps_legs_other_clients_wait_on(fake_client):
+    jobs = tp.JobManager()
+    legs = [tp.TripLeg("Paris", date(2026, 11, 1), date(2026, 11, 3)), tp.TripLeg("Rome", date(2026, 11, 4), date(2026, 11, 5))]
+    trip = jobs.submit(tp.trip_params("Dallas", legs, "shared legs", ""), subscriber="trip")
+    rome = jobs.submit(tp.trip_leg_params(trip.params)[1], subscriber="rome")
+    assert rome is trip.legs[1]
+
+    jobs.release(trip.job_id, "trip")
+    trip.future.result(timeout=30)
+    rome.future.result(timeout=30)
+    assert trip.status == tp.JOB_CANCELLED
+    assert trip.legs[0].status == tp.JOB_CANCELLED and rome.status == tp.JOB_DONE
+
+
+def test_job_cancelled_before_it_starts_never_calls_the_model(fake_client):
+    jobs = tp.JobManager(max_workers=1)
+    blocker = jobs.submit(dict(TRIP, interests="blocker"))
+    queued = jobs.submit(dict(TRIP, interests="queued"), subscriber="q")
+    jobs.release(queued.job_id, "q")
+    queued.future.result(timeout=30)
+    blocker.future.result(timeout=30)
+    assert queued.status == tp.JOB_CANCELLED and fake_client.requests == 1
@@ -0,0 +1,73 @@
+import builtins
+import gc
+import io
+import sys
+from datetime import date
+
+from PIL import Image
+
+import travel_plan as tp
+
+TRIP = dict(source_city="Dallas", destination="Lisbon", start_date=date(2026, 5, 1), end_date=date(2026, 5, 2),
+            days=2, interests="", guardrails="")
+
+
+def test_bounded_cache_evicts_least_recently_used_entries():
+    cache = tp.BoundedCache("test", max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is now the oldest
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_bounded_cache_stays_under_its_byte_budget():
+    cache = tp.BoundedCache("test", max_entries=100, max_bytes=10, sizeof=len)
+    for key in "abcd":
+        cache.put(key, "xxxx")
+    stats = cache.stats()
+    assert stats["bytes"] <= 10 and stats["entries"] == 2
+    cache.put("a", "x" * 20)  # larger than the whole budget: kept out entirely
+    assert cache.get("a") is None and cache.stats()["bytes"] == 0
+
+
+def test_identical_plans_share_one_interned_copy():
+    pool = tp.WeakInternPool("test")
+    first = pool.intern("k", tp.PlanText("## Day 1"))
+    assert pool.intern("k", tp.PlanText("## Day 1")) is first
+    assert pool.stats()["hits"] == 1
+    del first
+    gc.collect()
+    assert pool.stats()["entries"] == 0
+
+
+def test_watermark_images_are_downscaled():
+    out = io.BytesIO()
+    Image.new("RGB", (2000, 1000), "navy").save(out, format="PNG")
+    with Image.open(io.BytesIO(tp.shrink_image(out.getvalue(), max_px=200))) as small:
+        assert max(small.size) == 200
+
+
+def test_rss_is_zero_without_proc_or_resource(monkeypatch):
+    assert tp.process_rss_bytes() > 0
+    real_open = builtins.open
+
+    def no_proc(path, *args, **kwargs):
+        if str(path).startswith("/proc/"):
+            raise OSError("no /proc")
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", no_proc)
+    assert tp.process_rss_bytes() > 0  # peak RSS from the resource module
+    monkeypatch.setitem(sys.modules, "resource", None)  # as on Windows
+    assert tp.process_rss_bytes() == 0
+
+
+def test_finished_jobs_keep_only_the_interned_result(fake_client):
+    job = tp.JobManager().submit(dict(TRIP))
+    job.future.result(timeout=30)
+    assert job.status == tp.JOB_DONE and job.chunks == []
+    assert tp.intern_plan(str(job.result)) is job.result
+    assert tp.memory_report()["caches"]
@@ -0,0 +1,33 @@
+import io
+from types import SimpleNamespace
+
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+import travel_plan as tp
+
+
+def image(color: str) -> ImageReader:
+    out = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(out, format="PNG")
+    return ImageReader(io.BytesIO(out.getvalue()))
+
+
+def test_watermarks_are_drawn_once_per_image_and_slot():
+    out = io.BytesIO()
+    c = canvas.Canvas(out)
+    drawn, shown = [], []
+    draw_image, do_form = c.drawImage, c.doForm
+    c.drawImage = lambda *args, **kwargs: drawn.append(args) or draw_image(*args, **kwargs)
+    c.doForm = lambda name: shown.append(name) or do_form(name)
+    on_page = tp.make_pdf_page_with_watermark([image("navy"), image("teal")])
+    for page in range(1, 7):
+        on_page(c, SimpleNamespace(page=page))
+        c.showPage()
+    c.save()
+
+    assert len(drawn) == 4  # two images, each in the main and the alternate slot
+    assert out.getvalue().count(b"/Subtype /Form") == 4
+    # Every page shows both watermarks, and the images swap slots from page to page
+    assert shown == ["watermark0", "watermark1", "watermark2", "watermark3"] * 3
@@ -0,0 +1,80 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import travel_plan as tp
+
+
+def test_country_names_do_not_stand_in_for_a_city():
+    assert not tp.has_climate_normals("Malaysia")
+    assert not tp.has_climate_normals("Switzerland")
+    assert not tp.has_climate_normals("Penang, Malaysia")
+    assert tp.get_airline_routes().places.resolve("Switzerland") == ""
+
+
+def test_city_spellings_still_resolve():
+    assert tp.has_climate_normals("KL")
+    assert tp.has_climate_normals("Kuala Lumpur, Malaysia")
+    assert tp.has_climate_normals("Zürich")
+    assert tp.has_climate_normals("NYC")
+
+
+def test_month_weights_split_trips_across_months():
+    weights = tp.month_weights([date(2026, 1, 30), date(2026, 7, 1)], [date(2026, 2, 2), date(2026, 7, 1)])
+    assert weights.shape == (2, 12)
+    np.testing.assert_allclose(weights.sum(axis=1), 1.0)
+    assert weights[0, 0] == weights[0, 1] == pytest.approx(0.5)
+    assert weights[1, 6] == 1.0
+    assert tp.month_weights([], []).shape == (0, 12)
+
+
+def test_place_matcher_only_accepts_known_qualifiers():
+    places = tp.PlaceMatcher(["paris", "new york", "york"], {"nyc": "new york"}, {"paris": {"france", "fr"}})
+    assert places.resolve("Paris, France") == "paris"
+    assert places.resolve("downtown Paris") == "paris"
+    assert places.resolve("Paris, Texas") == ""
+    assert places.resolve("NYC") == "new york"
+    assert places.resolve("New York City") == "new york"
+
+
+def test_weather_header_is_filled_from_climate_normals():
+    header = tp.climate_header("Paris, France", date(2026, 1, 10), date(2026, 1, 12))
+    assert header.startswith("**Travel Dates:** January 10, 2026 to January 12, 2026")
+    assert "**Expected Temperature:** " in header and "°F" in header
+    assert "**Weather:** Cold" in header and "**What to Wear:** Warm layers" in header
+    assert tp.climate_header("Atlantis", date(2026, 1, 10), date(2026, 1, 12)) == ""
+
+
+def test_temperature_ranges_read_well_below_zero():
+    assert tp.format_temperature_range(15.2, 24.6) == "15-25°C / 59-76°F"
+    assert tp.format_temperature_range(-5.2, 3.4) == "-5 to 3°C / 23-38°F"
+
+
+def test_airline_lookup_answers_only_for_listed_routes():
+    carriers = pd.DataFrame({"carrier": ["Air France", "Delta"], "hub": ["CDG", "ATL"], "cities": ["paris", "atlanta;dallas"]})
+    routes = pd.DataFrame({"origin": ["dallas"], "destination": ["paris"], "carrier": ["Delta"], "direct": [0]})
+    index = tp.AirlineRouteIndex(carriers, routes)
+
+    options = index.lookup("Dallas", "Paris, France")
+    assert [option.carrier for option in options] == ["Delta", "Air France"]
+    assert not any(option.direct for option in options)
+    assert "Based in Paris" in options[1].note
+    assert index.lookup("Paris", "Dallas")[0].carrier == "Delta"
+    assert index.lookup("Atlanta", "Paris") is None
+    assert index.lookup("Dallas", "Paris, Texas") is None
+
+
+def test_airline_section_is_appended_locally_unless_the_model_wrote_one():
+    itinerary = "## Day 1\n**Morning:**\n- Senso-ji"
+    plan_md, airline_info = tp.attach_airline_section("Chicago", "Tokyo", itinerary)
+    assert "Nonstop flights between Chicago and Tokyo" in airline_info
+    assert tp.split_airline_section(plan_md) == (itinerary, airline_info)
+
+    model_section = "## ✈️ Recommended Airlines\n**JAL**\n- Nonstop"
+    plan_md = f"{itinerary}\n\n{model_section}"
+    assert tp.attach_airline_section("Chicago", "Tokyo", plan_md, truncated=True) == (plan_md, model_section)
+    assert tp.airline_section("Chicago", "Tokyo") == airline_info  # a cut-short section is not cached
+    tp.attach_airline_section("Chicago", "Tokyo", plan_md)
+    assert tp.airline_section("Chicago", "Tokyo") == model_section
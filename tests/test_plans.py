@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+import fake_llm
+import travel_plan as tp
+
+
+def fake_trip(**overrides) -> dict:
+    """Trip fields in the shape fake_llm.parse_user_prompt() returns."""
+    trip = dict(source_city="Dallas", destination="Paris", dates="November 01, 2026 to November 03, 2026", days=3,
+                condensed=False, local_header=False, airlines=True)
+    trip.update(overrides)
+    return trip
+
+
+def test_markdown_plan_round_trips():
+    plan_md = fake_llm.build_itinerary(fake_trip(), random.Random(1))
+    itinerary = tp.parse_plan_markdown(plan_md)
+    assert [day.title for day in itinerary.days] == ["Day 1", "Day 2", "Day 3"]
+    assert [slot.name for slot in itinerary.days[0].slots] == list(tp.PLAN_SLOTS)
+    assert itinerary.header.travel_dates and itinerary.airlines
+    assert tp.itinerary_to_markdown(itinerary) == plan_md
+
+
+def test_markdown_plan_accepts_any_heading_level():
+    itinerary = tp.parse_plan_markdown(
+        "# Paris Getaway\n### Day 1: Arrival\n### Morning\n- Louvre\n**Evening:**\n- Seine cruise\n"
+        "# Day 2\n#### Afternoon:\n- Montmartre\n### ✈️ Recommended Airlines\n**Air France**\n- Nonstop"
+    )
+    assert itinerary.intro == ["# Paris Getaway"]
+    assert [(day.title, [(slot.name, slot.activities) for slot in day.slots]) for day in itinerary.days] == [
+        ("Day 1: Arrival", [("Morning", ["Louvre"]), ("Evening", ["Seine cruise"])]),
+        ("Day 2", [("Afternoon", ["Montmartre"])]),
+    ]
+    assert [(airline.name, airline.reasons) for airline in itinerary.airlines] == [("Air France", ["Nonstop"])]
+
+
+def test_json_plan_round_trips_through_markdown():
+    response_format = tp.plan_response_format(include_header=False)
+    plan_json = fake_llm.build_itinerary_json(fake_trip(), random.Random(1), response_format)
+    itinerary = tp.parse_itinerary_json(plan_json)
+    assert len(itinerary.days) == 3 and itinerary.airlines
+    assert tp.parse_plan_markdown(tp.itinerary_to_markdown(itinerary)) == itinerary
+
+
+@pytest.mark.parametrize("plan_json", ["{", "[]", '{"days": []}', '{"days": [{"title": "Day 1", "slots": "x"}]}'])
+def test_invalid_json_plan_is_rejected(plan_json):
+    with pytest.raises(ValueError):
+        tp.parse_itinerary_json(plan_json)
+
+
+def test_json_system_prompt_has_no_markdown_rules():
+    assert "## for day headers" in tp.build_system_prompt()
+    assert "##" not in tp.build_system_prompt(output_format=tp.PLAN_FORMAT_JSON)
@@ -0,0 +1,40 @@
+import travel_plan as tp
+
+PLAN = """**Travel Dates:** June 01, 2026 to June 02, 2026
+
+## Day 1
+**Morning:**
+- Visit the *Louvre* <script>alert(1)</script>
+- See [the map](https://example.com/map) and [this](javascript:alert(1))
+
+## Day 2
+**Evening:**
+1. Dinner at `Le Procope`
+
+## ✈️ Recommended Airlines
+**Air France**
+- Nonstop"""
+
+
+def test_markdown_is_escaped_and_links_are_limited_to_http():
+    html = tp.markdown_to_html(PLAN)
+    assert "<script>" not in html and "&lt;script&gt;" in html
+    assert '<a href="https://example.com/map" target="_blank" rel="noopener noreferrer">the map</a>' in html
+    assert 'href="javascript' not in html
+    assert "<em>Louvre</em>" in html and "<code>Le Procope</code>" in html
+    assert "<ol>\n<li>" in html and html.count("<ul>") == html.count("</ul>")
+
+
+def test_inline_markup_matches_between_html_and_pdf():
+    text = "**Bold** and *italic* & more"
+    assert tp.inline_markdown_to_html(text) == "<strong>Bold</strong> and <em>italic</em> &amp; more"
+    assert tp.pdf_markup(text) == "<b>Bold</b> and <i>italic</i> &amp; more"
+
+
+def test_plan_is_rendered_once_into_sections():
+    rendered = tp.get_rendered_plan(PLAN)
+    assert tp.get_rendered_plan(PLAN) is rendered
+    assert rendered["hash"] == tp.plan_digest(PLAN)
+    assert "June 01, 2026" in rendered["intro"]
+    assert [title for title, _ in rendered["sections"]] == ["Day 1", "Day 2", "✈️ Recommended Airlines"]
+    assert "<strong>Air France</strong>" in rendered["sections"][-1][1]
@@ -0,0 +1,137 @@
+import threading
+import time
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+import travel_plan as tp
+from fake_llm import FakeLLMClient
+
+TRIP = dict(source_city="Dallas", destination="Paris", start_date=date(2026, 11, 1), end_date=date(2026, 11, 3),
+            days=3, interests="", guardrails="")
+REQUEST = {"messages": [{"role": "user", "content": "Traveling TO: Paris\nNumber of days: 3"}]}
+
+
+def stream_text(hedged) -> str:
+    return "".join(chunk.choices[0].delta.content or "" for chunk in hedged if chunk.choices)
+
+
+class StallingStream:
+    """Passes on the first chunks of a FakeStream, then goes silent until closed."""
+
+    def __init__(self, stream, chunks: int):
+        self.stream = stream
+        self.chunks = chunks
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        for index, chunk in enumerate(self.stream):
+            if index == self.chunks:
+                self.closed.wait(30)
+                return
+            yield chunk
+
+    def close(self):
+        self.closed.set()
+        self.stream.close()
+
+
+def stalling_client(fake: FakeLLMClient, chunks: int):
+    create = lambda **kwargs: StallingStream(fake.chat.completions.create(**kwargs), chunks)
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def test_deadlines_do_not_cut_off_a_streaming_winner(fake_client, monkeypatch):
+    monkeypatch.setattr(tp, "PLAN_DEADLINE_SECONDS", 0.5)
+    router = tp.ModelRouter(tp.parse_routes("fake:fake@0.5"))
+    started = time.perf_counter()
+    text = stream_text(router.request(REQUEST))
+    assert time.perf_counter() - started > 0.5
+    assert "## Day 3" in text and "**Evening:**" in text.split("## Day 3")[1]
+
+
+def test_a_route_that_sends_nothing_times_out(monkeypatch):
+    monkeypatch.setattr(tp, "PLAN_DEADLINE_SECONDS", 0.6)
+    tp.set_llm_client(FakeLLMClient(latency=5.0))
+    try:
+        router = tp.ModelRouter(tp.parse_routes("fake:fake@0.2"))
+        started = time.perf_counter()
+        with pytest.raises(TimeoutError):
+            stream_text(router.request(REQUEST))
+        assert time.perf_counter() - started < 2.0
+        assert router.stats["fake:fake"].first_token.percentile(50) >= 0.2  # timeouts are lower bounds
+    finally:
+        tp.set_llm_client(None)
+
+
+def test_slow_primary_is_hedged_on_the_next_route(monkeypatch):
+    monkeypatch.setattr(tp, "HEDGE_INITIAL_DELAY", 0.2)
+    clients = {"slow": FakeLLMClient(latency=5.0), "fast": FakeLLMClient(latency=0.05, tokens_per_second=4000)}
+    router = tp.ModelRouter(tp.parse_routes("fake:slow@10,fake:fast@10"))
+    router.client = lambda route: clients[route.model]
+    started = time.perf_counter()
+    text = stream_text(router.request(REQUEST))
+    assert "## Day 3" in text
+    assert time.perf_counter() - started < 3.0
+    fast = next(row for row in router.report() if row["route"] == "fake:fast")
+    assert (fast["hedges"], fast["wins"]) == (1, 1)
+    # The losing primary still counts: it waited at least the hedge delay
+    slow = router.stats["fake:slow"].first_token
+    assert slow.samples == 1 and slow.percentile(100) >= 0.2
+
+def test_whole_completion_hedge_is_not_capped_by_the_stall_deadline(fake_client):
+    router = tp.ModelRouter(tp.parse_routes("fake:fake@1"))
+    assert router.hedge_delay(router.routes[0], expected_tokens=1400) > 1
+    text, attempt = router.request(REQUEST, expected_tokens=1400).complete(lambda text, finish_reason: text)
+    assert time.perf_counter() - attempt.started > 1
+    assert "## Day 3" in text
+    assert fake_client.requests == 1 and router.report()[0]["hedges"] == 0
+
+def test_openai_clients_do_not_retry_and_time_out_with_the_route(monkeypatch):
+    monkeypatch.setattr(tp, "OPENAI_API_KEY", "sk-test")
+    client = tp.create_llm_client("openai")
+    assert client.max_retries == 0
+    router = tp.ModelRouter(tp.parse_routes("openai:gpt-4o-mini@12,openai:gpt-4o@30"))
+    tp.set_llm_client(client)
+    try:
+        routed = [router.client(route) for route in router.routes]
+        assert [(c.timeout, c.max_retries) for c in routed] == [(12.0, 0), (30.0, 0)]
+        assert router.client(router.routes[0]) is routed[0]
+    finally:
+        tp.set_llm_client(None)
+
+def test_a_stalled_winner_keeps_its_partial_plan(monkeypatch):
+    router = tp.ModelRouter(tp.parse_routes("fake:fake@0.3"))
+    monkeypatch.setattr(tp, "get_model_router", lambda: router)
+    tp.set_llm_client(stalling_client(FakeLLMClient(latency=0.05, tokens_per_second=4000), chunks=60))
+    try:
+        job = tp.JobManager().submit(dict(TRIP, interests="stall"))
+        job.future.result(timeout=10)
+    finally:
+        tp.set_llm_client(None)
+    assert job.status == tp.JOB_DONE and job.truncated and not job.fallback
+    assert "## Day 1" in job.result and "## Day 3" not in job.result
+    key = tp.fallback_plan_key(TRIP["destination"], TRIP["days"], "stall", "")
+    assert tp.get_fallback_plan_cache().get(key) is None
+
+
+def test_a_route_that_never_starts_falls_back(monkeypatch):
+    monkeypatch.setattr(tp, "PLAN_DEADLINE_SECONDS", 0.4)
+    router = tp.ModelRouter(tp.parse_routes("fake:fake@0.2"))
+    monkeypatch.setattr(tp, "get_model_router", lambda: router)
+    tp.set_llm_client(FakeLLMClient(latency=5.0))
+    try:
+        job = tp.JobManager().submit(dict(TRIP, interests="never starts"))
+        job.future.result(timeout=10)
+    finally:
+        tp.set_llm_client(None)
+    assert job.status == tp.JOB_DONE and job.fallback == "template"
+    assert "## Day 3" in job.result
+
+
+def test_fallback_plans_are_keyed_by_preferences():
+    key = tp.fallback_plan_key("Paris, France", 3, "Museums  and food", "")
+    assert key == tp.fallback_plan_key("paris", 3, "museums and food", "")
+    assert key != tp.fallback_plan_key("paris", 3, "museums and food", "no nightlife")
+    assert key != tp.fallback_plan_key("paris", 3, "hiking", "")
@@ -0,0 +1,64 @@
+from datetime import date
+
+import travel_plan as tp
+
+LEGS = [
+    tp.TripLeg("Paris", date(2026, 6, 1), date(2026, 6, 3)),
+    tp.TripLeg("Rome", date(2026, 6, 4), date(2026, 6, 5)),
+]
+
+
+def leg_itinerary(days: int) -> tp.Itinerary:
+    return tp.Itinerary(days=[
+        tp.PlanDay(title=f"Day {day}: Highlights", slots=[tp.PlanSlot(name="Morning", activities=["Walk"])])
+        for day in range(1, days + 1)
+    ])
+
+
+def test_destinations_split_on_arrows():
+    assert tp.split_destinations("Paris → Rome -> Athens > Split") == ["Paris", "Rome", "Athens", "Split"]
+    assert tp.split_destinations("Paris") == ["Paris"]
+
+
+def test_even_legs_cover_the_trip_without_sharing_days():
+    legs = tp.even_legs(["Paris", "Rome", "Athens"], date(2026, 6, 1), date(2026, 6, 8))
+    assert [leg.days for leg in legs] == [3, 3, 2]
+    assert legs[-1].end_date == date(2026, 6, 8)
+    assert tp.validate_legs("Dallas", legs) == ""
+
+
+def test_stops_may_not_share_a_day():
+    overlapping = [LEGS[0], tp.TripLeg("Rome", date(2026, 6, 3), date(2026, 6, 5))]
+    assert "must start after" in tp.validate_legs("Dallas", overlapping)
+    assert "between 2 and" in tp.validate_legs("Dallas", LEGS[:1])
+    assert tp.validate_legs("", LEGS) == "Please enter your source city."
+
+
+def test_leg_params_fly_in_from_the_previous_stop():
+    params = tp.trip_params("Dallas", LEGS, "food", "")
+    assert (params["destination"], params["days"]) == ("Paris → Rome", 5)
+    paris, rome = tp.trip_leg_params(params)
+    assert (paris["source_city"], rome["source_city"]) == ("Dallas", "Paris")
+    assert rome["days"] == 2 and "stop 2 of 2" in rome["trip_context"]
+
+
+def test_stitched_trip_numbers_each_day_once():
+    params = tp.trip_params("Dallas", LEGS, "", "")
+    trip = tp.stitch_trip_itinerary(params, [leg_itinerary(3), leg_itinerary(2)])
+    assert [day.title for day in trip.days] == [
+        "Day 1 · Paris: Highlights", "Day 2 · Paris: Highlights", "Day 3 · Paris: Highlights",
+        "Day 4 · Rome: Highlights", "Day 5 · Rome: Highlights",
+    ]
+    assert [tp.day_place(day.title) for day in trip.days] == ["Paris"] * 3 + ["Rome"] * 2
+    assert trip.header.travel_dates == tp.format_date_range(date(2026, 6, 1), date(2026, 6, 5))
+
+
+def test_multi_city_job_generates_legs_and_stitches_them(fake_client):
+    jobs = tp.JobManager()
+    job = jobs.submit(tp.trip_params("Dallas", LEGS, "stitching", ""))
+    job.future.result(timeout=30)
+    assert job.status == tp.JOB_DONE and [leg.status for leg in job.legs] == [tp.JOB_DONE] * 2
+    titles = [day.title for day in tp.get_itinerary(job.result).days]
+    assert [title.split(" · ")[0] for title in titles] == [f"Day {n}" for n in range(1, 6)]
+    # A single-city request for one of the stops reuses that leg's job
+    assert jobs.submit(tp.trip_leg_params(job.params)[1]) is job.legs[1]
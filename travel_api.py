@@ -0,0 +1,380 @@
+# travel_api.py
+"""
+Headless HTTP API for itinerary generation and PDF export.
+
+Exposes the planner from travel_plan.py as async JSON/binary endpoints for
+machine clients, without Streamlit's per-session script reruns:
+
+    POST /v1/plans                  trip JSON -> {"plan_md": ..., "itinerary": {...}}
+    POST /v1/plans?stream=1         trip JSON -> NDJSON lines {"delta": ...} or {"reset": ...}, then {"done": true, ...}
+    POST /v1/plans/pdf              trip JSON + "plan_md" -> application/pdf
+    GET  /v1/images?destination=... -> {"url": ...}
+    GET  /healthz                   -> status, memory report, model route latencies and admission counters
+
+Trip JSON: source_city, destination, start_date, end_date (YYYY-MM-DD),
+optional interests and guardrails. Multi-city trips send "legs" (a list of
+destination/start_date/end_date objects) instead of destination and dates.
+
+A streamed plan is the concatenation of its "delta" texts, except that a
+"reset" line replaces everything received so far (a multi-city trip switching
+from per-stop progress to the stitched plan, or a fallback plan replacing a
+stalled one). The final line carries "plan_md" whenever it differs from that text.
+
+Plan and PDF requests are rate limited per client (X-Client-Id header) and
+per IP, and shed when the service is saturated: 429 or 503 with a
+Retry-After header, returned immediately instead of queueing. Run with:
+
+    python travel_api.py --port 8080
+
+Generation runs on travel_plan.JOB_WORKERS threads (env JOB_WORKERS, default 4)
+with up to MAX_QUEUED_JOBS plans waiting for one; that, not --max-concurrency, is
+the plan throughput per process. --max-concurrency only caps open requests and
+defaults to what the job queue and PDF workers can hold.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from datetime import date
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import travel_plan
+
+# Streamlit warns about a missing ScriptRunContext on every st.* call outside `streamlit run`
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(lambda record: False)
+
+PDF_WORKERS = int(os.getenv("API_PDF_WORKERS", "4"))
+# Running and queued generations plus PDF builds; more open requests would only be shed
+MAX_CONCURRENCY = int(os.getenv(
+    "API_MAX_CONCURRENCY", str(travel_plan.JOB_WORKERS + travel_plan.MAX_QUEUED_JOBS + PDF_WORKERS)
+))
+STREAM_INTERVAL = 0.1  # seconds between NDJSON progress writes
+KEEP_ALIVE_SECONDS = 30
+
+
+class ApiError(Exception):
+    """Error returned to the client as {"error": message} with an HTTP status."""
+
+    def __init__(self, status_code: int, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after  # seconds; sent as Retry-After when set
+
+# --------------------------------------------
+# REQUEST VALIDATION
+# --------------------------------------------
+
+
+async def read_json(request: Request) -> dict:
+    """Parse the request body as a JSON object."""
+    try:
+        data = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ApiError(400, "Request body must be valid JSON.")
+    if not isinstance(data, dict):
+        raise ApiError(400, "Request body must be a JSON object.")
+    return data
+
+
+def optional_text(data: dict, name: str) -> str:
+    value = data.get(name) or ""
+    if not isinstance(value, str):
+        raise ApiError(400, f"{name} must be a string.")
+    return value
+
+
+def parse_date(data: dict, name: str):
+    value = data.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, f"{name} must be a date in YYYY-MM-DD format.")
+
+
+def parse_legs(data: dict) -> list:
+    """Multi-city stops from "legs": [{"destination", "start_date", "end_date"}, ...]."""
+    items = data.get("legs")
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ApiError(400, "legs must be a list of objects.")
+    return [
+        travel_plan.TripLeg(
+            optional_text(item, "destination").strip(), parse_date(item, "start_date"), parse_date(item, "end_date")
+        )
+        for item in items
+    ]
+
+
+def parse_trip(data: dict) -> dict:
+    """Validate a trip payload with the same rules as the Streamlit form."""
+    if data.get("legs") is not None:
+        source_city = optional_text(data, "source_city").strip()
+        legs = parse_legs(data)
+        error = travel_plan.validate_legs(source_city, legs)
+        if error:
+            raise ApiError(400, error)
+        return travel_plan.trip_params(
+            source_city, legs, optional_text(data, "interests"), optional_text(data, "guardrails")
+        )
+
+    params = {
+        "source_city": optional_text(data, "source_city").strip(),
+        "destination": optional_text(data, "destination").strip(),
+        "start_date": parse_date(data, "start_date"),
+        "end_date": parse_date(data, "end_date"),
+        "interests": optional_text(data, "interests"),
+        "guardrails": optional_text(data, "guardrails"),
+    }
+    error = travel_plan.validate_trip_inputs(
+        params["source_city"], params["destination"], params["start_date"], params["end_date"]
+    )
+    if error:
+        raise ApiError(400, error)
+    params["days"] = travel_plan.trip_days(params["start_date"], params["end_date"])
+    return params
+
+
+def request_client(request: Request):
+    """(client id, IP) that rate limits apply to."""
+    client_id = request.headers.get("X-Client-Id", "")[:128]
+    return client_id, request.client.host if request.client else ""
+
+
+def reject_if_saturated(request: Request):
+    """503 straight away when every API slot is busy, instead of waiting in line for one."""
+    if request.app.state.limiter.locked():
+        raise ApiError(
+            503,
+            travel_plan.Admission(False, "The service is at capacity.", travel_plan.SHED_RETRY_AFTER).message,
+            travel_plan.SHED_RETRY_AFTER,
+        )
+
+
+def admission_error(admission: "travel_plan.Admission") -> ApiError:
+    """429 for a client over its rate limit, 503 when the service is shedding load."""
+    return ApiError(503 if admission.shed else 429, admission.message, admission.retry_after)
+
+
+def plan_payload(job, params: dict) -> dict:
+    """JSON body describing a finished job."""
+    payload = {
+        "status": job.status,
+        "source_city": params["source_city"],
+        "destination": params["destination"],
+        "start_date": params["start_date"].isoformat(),
+        "end_date": params["end_date"].isoformat(),
+        "days": params["days"],
+    }
+    if params.get("legs"):
+        payload["legs"] = [
+            {"destination": leg["destination"], "start_date": leg["start_date"].isoformat(), "end_date": leg["end_date"].isoformat()}
+            for leg in params["legs"]
+        ]
+    if job.status == travel_plan.JOB_DONE:
+        payload["plan_md"] = job.result
+        payload["truncated"] = job.truncated
+        payload["airline_info"] = job.airline_info
+        payload["fallback"] = job.fallback
+        payload["itinerary"] = asdict(travel_plan.get_itinerary(job.result))
+        if job.usage is not None:
+            payload["usage"] = {
+                "prompt_tokens": job.usage.prompt_tokens,
+                "completion_tokens": job.usage.completion_tokens,
+            }
+    elif job.status == travel_plan.JOB_FAILED:
+        payload["error"] = job.error
+    return payload
+
+# --------------------------------------------
+# ENDPOINTS
+# --------------------------------------------
+
+
+async def create_plan(request: Request):
+    """Generate an itinerary; streams NDJSON progress when ?stream=1."""
+    params = parse_trip(await read_json(request))
+    reject_if_saturated(request)
+    admission = travel_plan.admit_generation(params, *request_client(request))
+    if not admission.admitted:
+        raise admission_error(admission)
+    limiter = request.app.state.limiter
+
+    if request.query_params.get("stream") in ("1", "true"):
+        return StreamingResponse(stream_plan(params, limiter), media_type="application/x-ndjson")
+
+    jobs = travel_plan.get_job_manager()
+    subscriber = uuid.uuid4().hex
+    async with limiter:
+        job = jobs.submit(params, subscriber=subscriber)
+        try:
+            # Shielded: a disconnect must not cancel a worker future other clients share
+            await asyncio.shield(asyncio.wrap_future(job.future))
+        finally:
+            jobs.release(job.job_id, subscriber)
+    if job.status == travel_plan.JOB_FAILED:
+        return JSONResponse(plan_payload(job, params), status_code=502)
+    if job.status != travel_plan.JOB_DONE:
+        return JSONResponse(plan_payload(job, params), status_code=503)
+    return JSONResponse(plan_payload(job, params))
+
+
+async def stream_plan(params: dict, limiter: asyncio.Semaphore):
+    """
+    Yield NDJSON deltas while the job runs, or a reset with the whole text when it
+    changes other than by growing. The job is cancelled if every client waiting on it goes away.
+    """
+    jobs = travel_plan.get_job_manager()
+    subscriber = uuid.uuid4().hex
+    async with limiter:
+        job = jobs.submit(params, subscriber=subscriber)
+        streamed = ""
+        try:
+            while True:
+                finished = job.future.done()
+                text = job.partial_text
+                if text != streamed:
+                    if text.startswith(streamed):
+                        yield json.dumps({"delta": text[len(streamed):]}) + "\n"
+                    else:
+                        yield json.dumps({"reset": text}) + "\n"
+                    streamed = text
+                if finished:
+                    break
+                await asyncio.sleep(STREAM_INTERVAL)
+            final = plan_payload(job, params)
+            # The last read follows the job's end, so the deltas normally spell out the
+            # finished plan; plan_md is sent whenever they do not
+            if final.get("plan_md") == streamed:
+                final.pop("plan_md")
+            final["done"] = True
+            yield json.dumps(final) + "\n"
+        finally:
+            jobs.release(job.job_id, subscriber)
+
+
+async def create_pdf(request: Request):
+    """Render a plan to PDF and return the bytes."""
+    data = await read_json(request)
+    params = parse_trip(data)
+    plan_md = optional_text(data, "plan_md")
+    if not plan_md.strip():
+        raise ApiError(400, "plan_md is required.")
+    fetch_images = data.get("images", True) is not False
+    reject_if_saturated(request)
+    pdf_admission = travel_plan.get_pdf_admission()
+    client = request_client(request)
+
+    loop = asyncio.get_running_loop()
+    async with request.app.state.limiter:
+        try:
+            pdf_bytes = await loop.run_in_executor(
+                request.app.state.pdf_executor,
+                lambda: travel_plan.export_pdf(
+                    plan_md,
+                    params["destination"],
+                    params["source_city"],
+                    params["start_date"],
+                    params["end_date"],
+                    params["days"],
+                    fetch_images=fetch_images,
+                    # Only builds are charged; cached PDFs are served without a token
+                    admit=lambda: pdf_admission.admit(*client),
+                ),
+            )
+        except travel_plan.AdmissionRejected as e:
+            raise admission_error(e.admission)
+    filename = f"travel_plan_{travel_plan.pdf_file_stem(params['destination'])}.pdf"
+    return Response(
+        pdf_bytes,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+async def lookup_image(request: Request):
+    """Background image URL for a destination."""
+    destination = request.query_params.get("destination", "")
+    return JSONResponse({
+        "destination": destination,
+        "url": travel_plan.fetch_destination_image(destination),
+    })
+
+
+async def health(request: Request):
+    return JSONResponse({
+        "status": "ok",
+        "memory": travel_plan.memory_report(),
+        "routes": travel_plan.get_model_router().report(),
+        "admission": travel_plan.admission_report(),
+    })
+
+
+async def handle_api_error(request: Request, exc: ApiError):
+    headers = {"Retry-After": str(math.ceil(exc.retry_after))} if exc.retry_after else None
+    return JSONResponse({"error": exc.message}, status_code=exc.status_code, headers=headers)
+
+# --------------------------------------------
+# APP
+# --------------------------------------------
+
+
+def create_app(max_concurrency: int = MAX_CONCURRENCY, pdf_workers: int = PDF_WORKERS) -> Starlette:
+    """Build the ASGI app; generation and PDF work share one concurrency cap."""
+
+    @asynccontextmanager
+    async def lifespan(app):
+        app.state.limiter = asyncio.Semaphore(max_concurrency)
+        app.state.pdf_executor = ThreadPoolExecutor(max_workers=pdf_workers, thread_name_prefix="pdf")
+        try:
+            yield
+        finally:
+            app.state.pdf_executor.shutdown(wait=False, cancel_futures=True)
+
+    return Starlette(
+        routes=[
+            Route("/v1/plans", create_plan, methods=["POST"]),
+            Route("/v1/plans/pdf", create_pdf, methods=["POST"]),
+            Route("/v1/images", lookup_image, methods=["GET"]),
+            Route("/healthz", health, methods=["GET"]),
+        ],
+        exception_handlers={ApiError: handle_api_error},
+        lifespan=lifespan,
+    )
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless travel planner API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="open plan/PDF requests per worker (generation itself runs on JOB_WORKERS threads)")
+    parser.add_argument("--keep-alive", type=int, default=KEEP_ALIVE_SECONDS, help="idle keep-alive timeout (s)")
+    args = parser.parse_args()
+
+    # Worker processes import travel_api:app, so pass settings through the environment
+    os.environ["API_MAX_CONCURRENCY"] = str(args.max_concurrency)
+    uvicorn.run(
+        "travel_api:app" if args.workers > 1 else create_app(args.max_concurrency),
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_keep_alive=args.keep_alive,
+    )
@@ -1,14 +1,32 @@
 # chatgpt_travel_guide.py
 
 import os
+import hashlib
+import html
+import json
+import math
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
 from datetime import datetime, timedelta
 from textwrap import dedent
 from urllib.parse import quote
 
+import numpy as np
+import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 from openai import OpenAI
+from PIL import Image
 
 from reportlab.lib.pagesizes import LETTER
 from reportlab.lib.units import inch
@@ -16,6 +34,7 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from reportlab.lib.colors import HexColor
 from reportlab.platypus import (
+    Flowable,
     SimpleDocTemplate,
     Paragraph,
     Spacer,
@@ -35,17 +54,199 @@ import requests
 load_dotenv(dotenv_path=Path(__file__).parent / ".env")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    st.error("OPENAI_API_KEY not found. Please set it in your .env file.")
-    st.stop()
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# "openai" (default) or "fake" for the offline stub in fake_llm.py.
+# Point OPENAI_BASE_URL at any OpenAI-compatible server to use it via "openai".
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai").strip().lower()
 
-st.set_page_config(
-    page_title="Travel Guide",
-    page_icon="🌍",
-    layout="wide",
-)
+# --------------------------------------------
+# MEMORY GOVERNOR
+# --------------------------------------------
+
+# Process-wide, size-bounded stores shared by all sessions
+IMAGE_URL_CACHE_ENTRIES = 2048
+IMAGE_BYTES_CACHE_MB = 48
+WATERMARK_MAX_PX = 640  # watermarks are drawn at most 3.5in wide
+
+
+class BoundedCache:
+    """Thread-safe LRU cache bounded by entry count and approximate size in bytes."""
+
+    def __init__(self, name: str, max_entries: int, max_bytes: int = None, sizeof=sys.getsizeof):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.entries and (
+                len(self.entries) > self.max_entries
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "name": self.name,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class PlanText(str):
+    """str subclass that supports weak references, so identical plans can be interned."""
+
+
+class WeakInternPool:
+    """Maps content hashes to one shared object; entries vanish once nothing holds them."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.objects = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def intern(self, key, value):
+        with self.lock:
+            existing = self.objects.get(key)
+            if existing is not None:
+                self.hits += 1
+                return existing
+            self.objects[key] = value
+            return value
+
+    def stats(self) -> dict:
+        with self.lock:
+            values = list(self.objects.values())
+        return {
+            "name": self.name,
+            "entries": len(values),
+            "bytes": sum(sys.getsizeof(v) for v in values),
+            "hits": self.hits,
+        }
+
+
+@st.cache_resource
+def get_image_url_cache() -> BoundedCache:
+    """Destination -> background image URL, shared across sessions."""
+    return BoundedCache("image_urls", IMAGE_URL_CACHE_ENTRIES)
+
+
+@st.cache_resource
+def get_image_bytes_cache() -> BoundedCache:
+    """Image URL -> downscaled image bytes for PDF watermarks."""
+    return BoundedCache("image_bytes", IMAGE_URL_CACHE_ENTRIES, max_bytes=IMAGE_BYTES_CACHE_MB * 1024 * 1024, sizeof=len)
+
+
+@st.cache_resource
+def get_plan_pool() -> WeakInternPool:
+    """Interned plan texts; sessions and jobs with the same plan share one copy."""
+    return WeakInternPool("plans")
+
+
+def intern_plan(plan_md: str) -> str:
+    """Return the shared copy of a plan text."""
+    if not plan_md:
+        return plan_md
+    return get_plan_pool().intern(plan_digest(plan_md), PlanText(plan_md))
+
+
+def shrink_image(data: bytes, max_px: int = WATERMARK_MAX_PX) -> bytes:
+    """Downscale an image to watermark size and re-encode it as JPEG."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if max(img.size) <= max_px:
+                return data
+            img = img.convert("RGB")
+            img.thumbnail((max_px, max_px))
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=80, optimize=True)
+            return out.getvalue()
+    except Exception as e:
+        print(f"✗ Could not downscale image: {e}")
+        return data
+
+
+def fetch_image_bytes(url: str, **request_kwargs):
+    """Download an image once per process; returns downscaled bytes or None."""
+    cache = get_image_bytes_cache()
+    data = cache.get(url)
+    if data is not None:
+        return data
+    response = requests.get(url, timeout=10, **request_kwargs)
+    if response.status_code != 200:
+        return None
+    return cache.put(url, shrink_image(response.content))
+
+
+def process_rss_bytes() -> int:
+    """
+    Current resident set size of this process (peak RSS where /proc is unavailable,
+    0 on platforms without the resource module such as Windows).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def memory_report() -> dict:
+    """Per-process memory figures for the shared caches, jobs and RSS."""
+    jobs = list(get_job_manager().jobs.values())
+    return {
+        "rss_mb": round(process_rss_bytes() / (1024 * 1024), 1),
+        "caches": [
+            get_image_url_cache().stats(),
+            get_image_bytes_cache().stats(),
+            get_plan_pool().stats(),
+            get_airline_cache().stats(),
+            get_itinerary_cache().stats(),
+            get_fallback_plan_cache().stats(),
+            get_pdf_cache().stats(),
+        ],
+        "jobs": len(jobs),
+        "job_text_bytes": sum(len(j.result) + sum(len(c) for c in j.chunks) for j in jobs),
+    }
 
 # --------------------------------------------
 # DESTINATION BACKGROUNDS (WEB + PDF)
@@ -135,9 +336,6 @@ DEST_BG_IMAGES = {
 # Beautiful generic travel background for initial load
 GENERIC_BG_IMAGE = "https://images.unsplash.com/photo-1436491865332-7a61a109cc05?w=1200&q=80"  # Airplane wing over clouds
 
-# Cache for fetched images
-if 'image_cache' not in st.session_state:
-    st.session_state.image_cache = {}
 
 
 def fetch_destination_image(destination: str) -> str:
@@ -149,27 +347,26 @@ def fetch_destination_image(destination: str) -> str:
         return GENERIC_BG_IMAGE
     
     # Check cache first
+    cache = get_image_url_cache()
     cache_key = destination.lower().strip()
-    if cache_key in st.session_state.image_cache:
-        return st.session_state.image_cache[cache_key]
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
     
     # Check predefined verified images with exact and substring matching
     dest_key = destination.strip().lower()
     
     # Exact match first
     if dest_key in DEST_BG_IMAGES:
-        st.session_state.image_cache[cache_key] = DEST_BG_IMAGES[dest_key]
-        return DEST_BG_IMAGES[dest_key]
+        return cache.put(cache_key, DEST_BG_IMAGES[dest_key])
     
     # Substring match (bidirectional)
     for key, url in DEST_BG_IMAGES.items():
         if key in dest_key or dest_key in key:
-            st.session_state.image_cache[cache_key] = url
-            return url
+            return cache.put(cache_key, url)
     
     # No verified image found - use generic travel background
-    st.session_state.image_cache[cache_key] = GENERIC_BG_IMAGE
-    return GENERIC_BG_IMAGE
+    return cache.put(cache_key, GENERIC_BG_IMAGE)
 
 # For PDF backgrounds (optional local images)
 DEST_PDF_BG = {
@@ -314,7 +511,10 @@ def get_pdf_bg_for_destination(destination: str):
 
 
 def get_multiple_images_for_destination(destination: str, count: int = 3):
-    """Get multiple images for a destination using verified sources and variations."""
+    """
+    Get multiple images for a destination using verified sources and variations.
+    Image bytes come from the shared, size-bounded image store (downscaled to watermark size).
+    """
     images = []
     
     # Get the primary verified image
@@ -322,9 +522,9 @@ def get_multiple_images_for_destination(destination: str, count: int = 3):
     
     try:
         print(f"Fetching primary image for {destination}...")
-        response = requests.get(img_url_base, timeout=10)
-        if response.status_code == 200:
-            images.append(ImageReader(io.BytesIO(response.content)))
+        data = fetch_image_bytes(img_url_base)
+        if data:
+            images.append(ImageReader(io.BytesIO(data)))
             print(f"✓ Primary image loaded")
     except Exception as e:
         print(f"✗ Could not fetch primary image: {e}")
@@ -337,9 +537,9 @@ def get_multiple_images_for_destination(destination: str, count: int = 3):
     try:
         query1 = quote(f"{destination} landmark architecture")
         url1 = f"https://source.unsplash.com/800x600/?{query1}&sig=1"
-        response = requests.get(url1, timeout=10, allow_redirects=True)
-        if response.status_code == 200:
-            images.append(ImageReader(io.BytesIO(response.content)))
+        data = fetch_image_bytes(url1, allow_redirects=True)
+        if data:
+            images.append(ImageReader(io.BytesIO(data)))
             print(f"✓ Landmark variation loaded")
     except Exception as e:
         print(f"✗ Variation 1 failed: {e}")
@@ -349,9 +549,9 @@ def get_multiple_images_for_destination(destination: str, count: int = 3):
         try:
             query2 = quote(f"{destination} skyline city view")
             url2 = f"https://source.unsplash.com/800x600/?{query2}&sig=2"
-            response = requests.get(url2, timeout=10, allow_redirects=True)
-            if response.status_code == 200:
-                images.append(ImageReader(io.BytesIO(response.content)))
+            data = fetch_image_bytes(url2, allow_redirects=True)
+            if data:
+                images.append(ImageReader(io.BytesIO(data)))
                 print(f"✓ Cityscape variation loaded")
         except Exception as e:
             print(f"✗ Variation 2 failed: {e}")
@@ -361,9 +561,9 @@ def get_multiple_images_for_destination(destination: str, count: int = 3):
         try:
             query3 = quote(f"{destination} tourist attraction")
             url3 = f"https://source.unsplash.com/800x600/?{query3}&sig=3"
-            response = requests.get(url3, timeout=10, allow_redirects=True)
-            if response.status_code == 200:
-                images.append(ImageReader(io.BytesIO(response.content)))
+            data = fetch_image_bytes(url3, allow_redirects=True)
+            if data:
+                images.append(ImageReader(io.BytesIO(data)))
                 print(f"✓ Tourist attraction variation loaded")
         except Exception as e:
             print(f"✗ Variation 3 failed: {e}")
@@ -372,47 +572,79 @@ def get_multiple_images_for_destination(destination: str, count: int = 3):
     return images if images else None
 
 
-def make_pdf_page_with_watermark(destination_images, page_num_container):
-    """Create PDF page handler with rotating destination image watermarks."""
+def get_leg_watermark_images(places) -> dict:
+    """Watermark image per multi-city stop, from its DEST_BG_IMAGES photo (shared image store)."""
+    images = {}
+    for place in places:
+        try:
+            data = fetch_image_bytes(fetch_destination_image(place))
+            if data:
+                images[place] = [ImageReader(io.BytesIO(data))]
+        except Exception as e:
+            print(f"✗ Could not fetch image for {place}: {e}")
+    print(f"Loaded watermark images for {len(images)} of {len(places)} stops")
+    return images
+
+
+class LegWatermark(Flowable):
+    """Zero-size marker that switches the watermark to a trip leg's images from the next page on."""
+
+    def __init__(self, leg_state: dict, place: str):
+        super().__init__()
+        self.leg_state = leg_state
+        self.place = place
+
+    def wrap(self, available_width, available_height):
+        return 0, 0
+
+    def draw(self):
+        self.leg_state["place"] = self.place
+
+
+# Watermark slots: (x, y, size, alpha) on a LETTER page
+WATERMARK_MAIN = (LETTER[0] - 4 * inch, 0.5 * inch, 3.5 * inch, 0.07)  # bottom-right
+WATERMARK_ALT = (0.5 * inch, LETTER[1] - 3 * inch, 2.5 * inch, 0.05)  # smaller, top-left
+
+
+def make_pdf_page_with_watermark(destination_images, leg_state=None):
+    """
+    Create PDF page handler with rotating destination image watermarks.
+    For multi-city trips leg_state holds {"images": {place: images}, "place": current place}.
+
+    Each image is drawn once per slot into a form XObject that every page
+    reuses, and the rotation follows doc.page, so pages only reference forms.
+    Opacity is set on the page: ReportLab forms carry no ExtGState resources.
+    """
+    default_images = destination_images
+    forms = {}  # (place, image index, slot) -> form name
+
+    def watermark_form(c: canvas.Canvas, place, images, index: int, slot) -> str:
+        key = (place, index, slot)
+        name = forms.get(key)
+        if name is None:
+            name = forms[key] = f"watermark{len(forms)}"
+            x, y, size, _ = slot
+            c.beginForm(name)
+            c.drawImage(images[index], x, y, width=size, height=size, preserveAspectRatio=True, mask="auto")
+            c.endForm()
+        return name
+
     def on_page(c: canvas.Canvas, doc):
+        place = leg_state["place"] if leg_state else None
+        images = leg_state["images"].get(place) if leg_state else None
+        if not images:
+            place, images = None, default_images
+        if not images:
+            return
+
+        # Use a different image on each page (cycle through available images)
+        index = (doc.page - 1) % len(images)
         c.saveState()
-        
-        # Add watermark images if available - rotate through them
-        if destination_images and len(destination_images) > 0:
-            w, h = LETTER
-            try:
-                # Use different image on each page (cycle through available images)
-                img_index = page_num_container[0] % len(destination_images)
-                current_img = destination_images[img_index]
-                
-                # Calculate position for bottom-right watermark
-                img_width = 3.5 * inch
-                img_height = 3.5 * inch
-                x_pos = w - img_width - 0.5 * inch
-                y_pos = 0.5 * inch
-                
-                # Draw watermark with low opacity
-                c.setFillAlpha(0.07)
-                c.drawImage(current_img, x_pos, y_pos, 
-                           width=img_width, height=img_height,
-                           preserveAspectRatio=True, mask='auto')
-                
-                # Also add a smaller watermark in top-left
-                if len(destination_images) > 1:
-                    alt_img_index = (img_index + 1) % len(destination_images)
-                    alt_img = destination_images[alt_img_index]
-                    c.setFillAlpha(0.05)
-                    c.drawImage(alt_img, 0.5 * inch, h - 3 * inch, 
-                               width=2.5 * inch, height=2.5 * inch,
-                               preserveAspectRatio=True, mask='auto')
-                
-                c.setFillAlpha(1.0)
-                
-                # Increment page counter
-                page_num_container[0] += 1
-            except Exception as e:
-                print(f"Error adding watermark: {e}")
-        
+        c.setFillAlpha(WATERMARK_MAIN[3])
+        c.doForm(watermark_form(c, place, images, index, WATERMARK_MAIN))
+        if len(images) > 1:
+            c.setFillAlpha(WATERMARK_ALT[3])
+            c.doForm(watermark_form(c, place, images, (index + 1) % len(images), WATERMARK_ALT))
         c.restoreState()
     return on_page
 
@@ -429,11 +661,14 @@ def init_session_state():
         "start_date": datetime.now().date(),
         "end_date": (datetime.now() + timedelta(days=3)).date(),
         "days": 3,
+        "legs": [],  # Stops of a multi-city trip (dicts with destination/start_date/end_date)
         "interests": "",
         "guardrails": "",
         "plan_md": "",
         "last_bg_destination": "",  # Track background changes
         "airline_info": "",  # Store airline recommendations
+        "active_job_id": "",  # Background generation job attached to this session
+        "client_id": uuid.uuid4().hex,  # Rate-limit key for this browser session
     }
     for k, v in defaults.items():
         st.session_state.setdefault(k, v)
@@ -446,15 +681,920 @@ def reset_form():
     st.session_state.start_date = datetime.now().date()
     st.session_state.end_date = (datetime.now() + timedelta(days=3)).date()
     st.session_state.days = 3
+    st.session_state.legs = []
     st.session_state.interests = ""
     st.session_state.guardrails = ""
     st.session_state.plan_md = ""
     st.session_state.airline_info = ""
     st.session_state.last_bg_destination = ""
+    cancel_active_job()
     st.rerun()
 
 
-init_session_state()
+# --------------------------------------------
+# TRIP INPUTS
+# --------------------------------------------
+
+
+def trip_days(start_date, end_date) -> int:
+    """Inclusive number of days between two dates."""
+    return (end_date - start_date).days + 1
+
+
+def validate_trip_inputs(source_city, destination, start_date, end_date) -> str:
+    """Check the trip form fields; returns an error message, or "" if valid."""
+    if not (source_city or "").strip():
+        return "Please enter your source city."
+    if not (destination or "").strip():
+        return "Please enter a destination."
+    if not start_date or not end_date or end_date < start_date:
+        return "Please select valid travel dates (end date must be on or after start date)."
+    return ""
+
+# --------------------------------------------
+# STRUCTURED PLANS
+# --------------------------------------------
+
+# "markdown" (default): the model writes the plan as Markdown.
+# "json": the model returns a schema-validated JSON itinerary and the Markdown is rendered locally.
+PLAN_FORMAT_MARKDOWN = "markdown"
+PLAN_FORMAT_JSON = "json"
+PLAN_OUTPUT_FORMAT = os.getenv("PLAN_OUTPUT_FORMAT", PLAN_FORMAT_MARKDOWN).strip().lower()
+PLAN_SLOTS = ("Morning", "Afternoon", "Evening")
+ITINERARY_CACHE_ENTRIES = 256
+
+PLAN_HEADER_FIELDS = ("**Travel Dates:**", "**Expected Temperature:**", "**Weather:**", "**What to Wear:**")
+HEADER_ATTRS = ("travel_dates", "temperature", "weather", "what_to_wear")
+AIRLINE_SECTION_TITLE = "## ✈️ Recommended Airlines"
+
+_AIRLINE_SECTION_RE = re.compile(r"^#{1,6}\s*(?:✈️\s*)?Recommended Airlines\b.*$", re.MULTILINE | re.IGNORECASE)
+_HEADER_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+_DAY_TITLE_RE = re.compile(r"^Day\s+\d+", re.IGNORECASE)
+_BOLD_LINE_RE = re.compile(r"^\*\*([^*]+?)\*\*:?$")
+_BULLET_RE = re.compile(r"^(?:[-*•]|\d+[.)])\s+(.*)$")
+# Inline emphasis, shared by the HTML and PDF renderers.
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
+_ITALIC_RE = re.compile(r"(?<![\w*])[*_](?![\s*_])(.+?)(?<![\s*_])[*_](?![\w*])")
+
+
+@dataclass
+class PlanHeader:
+    """Trip facts shown above the itinerary."""
+    travel_dates: str = ""
+    temperature: str = ""
+    weather: str = ""
+    what_to_wear: str = ""
+
+    def fields(self):
+        """(label, value) pairs for the filled-in fields, e.g. ("Weather", "Mild and dry")."""
+        return [
+            (label.strip("*:"), getattr(self, attr))
+            for label, attr in zip(PLAN_HEADER_FIELDS, HEADER_ATTRS)
+            if getattr(self, attr)
+        ]
+
+
+@dataclass
+class PlanSlot:
+    """Morning / Afternoon / Evening block of a day."""
+    name: str
+    activities: list = field(default_factory=list)
+    notes: list = field(default_factory=list)
+
+
+@dataclass
+class PlanDay:
+    title: str
+    slots: list = field(default_factory=list)
+    notes: list = field(default_factory=list)  # text before the first slot
+
+
+@dataclass
+class PlanAirline:
+    name: str
+    reasons: list = field(default_factory=list)
+
+
+@dataclass
+class Itinerary:
+    """A plan parsed once; every renderer (Streamlit, PDF, API) consumes this."""
+    header: PlanHeader = field(default_factory=PlanHeader)
+    intro: list = field(default_factory=list)
+    days: list = field(default_factory=list)
+    airlines: list = field(default_factory=list)
+    airline_notes: list = field(default_factory=list)
+
+    def size_bytes(self) -> int:
+        """Approximate text size, for the itinerary cache budget."""
+        return len(itinerary_to_markdown(self))
+
+# Markdown rendering
+
+
+def header_to_markdown(header: PlanHeader) -> str:
+    return "\n".join(f"**{label}:** {value}" for label, value in header.fields())
+
+
+def slot_to_markdown(slot: PlanSlot) -> str:
+    lines = [f"**{slot.name}:**"] + [f"- {activity}" for activity in slot.activities]
+    if slot.notes:
+        lines += [""] + slot.notes
+    return "\n".join(lines)
+
+
+def day_body_markdown(day: PlanDay) -> str:
+    """A day's content without its ## title."""
+    blocks = ["\n\n".join(day.notes)] if day.notes else []
+    blocks += [slot_to_markdown(slot) for slot in day.slots]
+    return "\n\n".join(blocks)
+
+
+def airlines_body_markdown(airlines, notes=()) -> str:
+    blocks = ["\n".join([f"**{a.name}**"] + [f"- {reason}" for reason in a.reasons]) for a in airlines]
+    return "\n\n".join(blocks + list(notes))
+
+
+def airlines_to_markdown(airlines, notes=()) -> str:
+    """Recommended Airlines section in the SYSTEM_PROMPT output format."""
+    return f"{AIRLINE_SECTION_TITLE}\n{airlines_body_markdown(airlines, notes)}"
+
+
+def itinerary_to_markdown(itinerary: Itinerary) -> str:
+    """Markdown in the SYSTEM_PROMPT output format."""
+    blocks = []
+    header = header_to_markdown(itinerary.header)
+    if header:
+        blocks.append(header)
+    blocks += itinerary.intro
+    blocks += [f"## {day.title}\n{day_body_markdown(day)}" for day in itinerary.days]
+    if itinerary.airlines or itinerary.airline_notes:
+        blocks.append(airlines_to_markdown(itinerary.airlines, itinerary.airline_notes))
+    return "\n\n".join(blocks)
+
+# Parsing
+
+
+def parse_plan_markdown(plan_md: str) -> Itinerary:
+    """
+    Parse a Markdown plan in one pass: header fields, day sections with bold
+    slot lines and bullets, and the Recommended Airlines section. Lines that fit
+    nowhere else are kept as notes on the nearest section.
+
+    Headings of any level are understood: "Day N" and level 1-2 headings start
+    a day (a level 1 title before the first day joins the intro), and deeper
+    headings inside a day start a slot, as models write "### Morning".
+    """
+    itinerary = Itinerary()
+    day = slot = airline = None
+    in_airlines = False
+
+    for line in (plan_md or "").split("\n"):
+        text = line.strip()
+        if not text:
+            continue
+        for label, attr in zip(PLAN_HEADER_FIELDS, HEADER_ATTRS):
+            if text.startswith(label):
+                setattr(itinerary.header, attr, text[len(label):].strip())
+                break
+        else:
+            heading = _HEADER_RE.match(text)
+            if heading:
+                level, title = len(heading.group(1)), heading.group(2).strip(" #")
+                if _AIRLINE_SECTION_RE.match(text):
+                    in_airlines, day, slot, airline = True, None, None, None
+                    continue
+                if _DAY_TITLE_RE.match(title) or level == 2 or (level == 1 and day is not None):
+                    in_airlines, slot, airline = False, None, None
+                    day = PlanDay(title=title)
+                    itinerary.days.append(day)
+                    continue
+                if day is not None and not in_airlines:
+                    slot = PlanSlot(name=title.rstrip(":"))
+                    day.slots.append(slot)
+                    continue
+
+            bold = _BOLD_LINE_RE.match(text)
+            bullet = _BULLET_RE.match(text)
+            if in_airlines:
+                if bold:
+                    airline = PlanAirline(name=bold.group(1).strip())
+                    itinerary.airlines.append(airline)
+                elif bullet and airline is not None:
+                    airline.reasons.append(bullet.group(1).strip())
+                else:
+                    itinerary.airline_notes.append(text)
+            elif day is None:
+                itinerary.intro.append(text)
+            elif bold:
+                slot = PlanSlot(name=bold.group(1).strip().rstrip(":"))
+                day.slots.append(slot)
+            elif bullet and slot is not None:
+                slot.activities.append(bullet.group(1).strip())
+            elif slot is not None:
+                slot.notes.append(text)
+            else:
+                day.notes.append(text)
+    return itinerary
+
+
+def plan_json_schema(include_header: bool = True, include_airlines: bool = True) -> dict:
+    """JSON schema for structured plans (strict mode: every property required)."""
+
+    def strict_object(properties: dict) -> dict:
+        return {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False,
+        }
+
+    text_list = {"type": "array", "items": {"type": "string"}}
+    slot = strict_object({"name": {"type": "string", "enum": list(PLAN_SLOTS)}, "activities": text_list})
+    day = strict_object({"title": {"type": "string"}, "slots": {"type": "array", "items": slot}})
+    properties = {}
+    if include_header:
+        properties["header"] = strict_object({attr: {"type": "string"} for attr in HEADER_ATTRS})
+    properties["days"] = {"type": "array", "items": day}
+    if include_airlines:
+        airline = strict_object({"name": {"type": "string"}, "reasons": text_list})
+        properties["airlines"] = {"type": "array", "items": airline}
+    return strict_object(properties)
+
+
+def plan_response_format(include_header: bool = True, include_airlines: bool = True) -> dict:
+    """response_format for OpenAI structured outputs."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "itinerary",
+            "strict": True,
+            "schema": plan_json_schema(include_header, include_airlines),
+        },
+    }
+
+
+def parse_itinerary_json(text: str) -> Itinerary:
+    """
+    Validate a JSON plan against plan_json_schema() and build the Itinerary.
+    Raises ValueError describing the first problem found.
+    """
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e}")
+
+    def expect(value, kind, path):
+        if not isinstance(value, kind):
+            raise ValueError(f"{path} must be {'an object' if kind is dict else 'a list' if kind is list else 'a string'}")
+        return value
+
+    def strings(value, path):
+        return [expect(item, str, f"{path}[{i}]").strip() for i, item in enumerate(expect(value, list, path))]
+
+    expect(data, dict, "plan")
+    itinerary = Itinerary()
+    if "header" in data:
+        header = expect(data["header"], dict, "header")
+        for attr in HEADER_ATTRS:
+            setattr(itinerary.header, attr, expect(header.get(attr, ""), str, f"header.{attr}").strip())
+
+    days = expect(data.get("days"), list, "days")
+    if not days:
+        raise ValueError("days must not be empty")
+    for i, day_data in enumerate(days):
+        expect(day_data, dict, f"days[{i}]")
+        day = PlanDay(title=expect(day_data.get("title"), str, f"days[{i}].title").strip() or f"Day {i + 1}")
+        for j, slot_data in enumerate(expect(day_data.get("slots"), list, f"days[{i}].slots")):
+            expect(slot_data, dict, f"days[{i}].slots[{j}]")
+            day.slots.append(PlanSlot(
+                name=expect(slot_data.get("name"), str, f"days[{i}].slots[{j}].name").strip(),
+                activities=strings(slot_data.get("activities"), f"days[{i}].slots[{j}].activities"),
+            ))
+        itinerary.days.append(day)
+
+    for i, airline_data in enumerate(expect(data.get("airlines", []), list, "airlines")):
+        expect(airline_data, dict, f"airlines[{i}]")
+        itinerary.airlines.append(PlanAirline(
+            name=expect(airline_data.get("name"), str, f"airlines[{i}].name").strip(),
+            reasons=strings(airline_data.get("reasons"), f"airlines[{i}].reasons"),
+        ))
+    return itinerary
+
+
+@st.cache_resource
+def get_itinerary_cache() -> BoundedCache:
+    """Plan hash -> parsed Itinerary, shared by the UI, PDF export and API."""
+    return BoundedCache("itineraries", ITINERARY_CACHE_ENTRIES, sizeof=Itinerary.size_bytes)
+
+
+def get_itinerary(plan_md: str) -> Itinerary:
+    """Structured form of a plan, parsed at most once per process."""
+    cache = get_itinerary_cache()
+    key = plan_digest(plan_md)
+    itinerary = cache.get(key)
+    if itinerary is None:
+        itinerary = cache.put(key, parse_plan_markdown(plan_md))
+    return itinerary
+
+
+def remember_itinerary(plan_md: str, itinerary: Itinerary):
+    """Store the Itinerary a plan was rendered from, so it is never re-parsed."""
+    get_itinerary_cache().put(plan_digest(plan_md), itinerary)
+
+# --------------------------------------------
+# PLACE LOOKUP
+# --------------------------------------------
+
+DATA_DIR = Path(__file__).parent / "data"
+
+# Other spellings of a city in the bundled tables. Cities only: a country name
+# ("Switzerland") must not pass for one of its cities, or a trip to Geneva would
+# get Zurich's climate and flights; unmatched places are left to the model.
+PLACE_ALIASES = {
+    "kl": "kuala lumpur",
+    "nyc": "new york",
+    "dfw": "dallas",
+    "zürich": "zurich",
+}
+
+
+# city,qualifiers: country/region names ("france;fr") allowed next to a city name,
+# so "Paris, France" matches paris but "Paris, Texas" matches nothing
+PLACE_QUALIFIERS_CSV = DATA_DIR / "place_qualifiers.csv"
+PLACE_FILLER_WORDS = {"city", "downtown", "center", "centre", "area", "metro"}
+_PLACE_WORD_RE = re.compile(r"[\w.]+")
+
+
+def read_place_qualifiers(path=PLACE_QUALIFIERS_CSV) -> dict:
+    """city -> words allowed around its name; an unreadable file allows none."""
+    try:
+        frame = pd.read_csv(path)
+        return {
+            row.city: set(_PLACE_WORD_RE.findall(row.qualifiers.lower().replace(";", " ")))
+            for row in frame.itertuples(index=False)
+        }
+    except (OSError, KeyError, ValueError, AttributeError) as e:
+        print(f"✗ Could not load place qualifiers: {e}")
+        return {}
+
+
+class PlaceMatcher:
+    """Match free-text place names ("Paris, France") against a fixed set of city keys."""
+
+    def __init__(self, names, aliases: dict = None, qualifiers: dict = None):
+        names = set(names)
+        self.keys = {name: name for name in names}
+        for alias, name in (aliases or {}).items():
+            if name in names:
+                self.keys[alias] = name
+        self.qualifiers = qualifiers if qualifiers is not None else read_place_qualifiers()
+        # Whole-word patterns, longest first so "new york" wins over "york"
+        self.patterns = [
+            (re.compile(rf"\b{re.escape(key)}\b"), name)
+            for key, name in sorted(self.keys.items(), key=lambda item: -len(item[0]))
+        ]
+
+    def resolve(self, text: str) -> str:
+        """
+        Canonical city key for the text, or "" if none matches. Words next to the
+        city name must be its own country/region qualifiers ("Paris, Texas" is not paris).
+        """
+        text_key = (text or "").strip().lower()
+        if text_key in self.keys:
+            return self.keys[text_key]
+        for pattern, name in self.patterns:
+            match = pattern.search(text_key)
+            if not match:
+                continue
+            rest = _PLACE_WORD_RE.findall(f"{text_key[:match.start()]} {text_key[match.end():]}")
+            allowed = self.qualifiers.get(name, set()) | PLACE_FILLER_WORDS
+            if all(word in allowed for word in rest):
+                return name
+        return ""
+
+# --------------------------------------------
+# CLIMATE NORMALS
+# --------------------------------------------
+
+# Monthly normals per catalog destination, one row per (destination, metric)
+# with columns jan..dec. Metrics: mean daily high / low (°C), precipitation (mm).
+CLIMATE_NORMALS_CSV = DATA_DIR / "climate_normals.csv"
+CLIMATE_METRICS = ("tmax_c", "tmin_c", "precip_mm")
+CLIMATE_MAX_DAYS = 366  # a longer trip covers every month anyway
+
+
+
+class ClimateNormals:
+    """Monthly normals as a (destinations, metrics, 12) float32 array with name lookup."""
+
+    def __init__(self, names, values: np.ndarray):
+        self.names = list(names)
+        self.values = values
+        self.rows = {name: i for i, name in enumerate(self.names)}
+        self.places = PlaceMatcher(self.names, PLACE_ALIASES)
+
+    @classmethod
+    def from_csv(cls, path=CLIMATE_NORMALS_CSV) -> "ClimateNormals":
+        """Load the bundled table; an unreadable file gives an empty table."""
+        try:
+            frame = pd.read_csv(path)
+            names = frame["destination"].drop_duplicates().tolist()
+            ordered = frame.set_index(["destination", "metric"]).loc[
+                pd.MultiIndex.from_product([names, CLIMATE_METRICS])
+            ]
+            values = ordered.to_numpy(dtype=np.float32).reshape(len(names), len(CLIMATE_METRICS), 12)
+        except (OSError, KeyError, ValueError) as e:
+            print(f"✗ Could not load climate normals from {path}: {e}")
+            return cls([], np.zeros((0, len(CLIMATE_METRICS), 12), dtype=np.float32))
+        print(f"✓ Loaded climate normals for {len(names)} destinations")
+        return cls(names, values)
+
+    def resolve(self, destination: str) -> int:
+        """Row for a free-text destination ("Paris, France"), or -1 if not covered."""
+        return self.rows.get(self.places.resolve(destination), -1)
+
+    def summarize(self, rows: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        Per-trip climate over the months each trip covers.
+        Returns a (trips, 4) array of coldest low, warmest high, mean temperature
+        and mean monthly precipitation; NaN rows for destinations not covered.
+        """
+        summary = np.full((len(rows), 4), np.nan, dtype=np.float32)
+        known = rows >= 0
+        if not known.any():
+            return summary
+        values = self.values[rows[known]]
+        weights = weights[known]
+        covered = weights > 0
+        tmax, tmin, precip = values[:, 0], values[:, 1], values[:, 2]
+        summary[known, 0] = np.where(covered, tmin, np.inf).min(axis=1)
+        summary[known, 1] = np.where(covered, tmax, -np.inf).max(axis=1)
+        summary[known, 2] = np.einsum("tk,tk->t", (tmax + tmin) / 2, weights)
+        summary[known, 3] = np.einsum("tk,tk->t", precip, weights)
+        return summary
+
+
+@st.cache_resource
+def get_climate_normals() -> ClimateNormals:
+    """Bundled climate normals, loaded once per process."""
+    return ClimateNormals.from_csv()
+
+
+def month_weights(start_dates, end_dates) -> np.ndarray:
+    """(trips, 12) share of each trip's days falling in each calendar month."""
+    starts = np.array(start_dates, dtype="datetime64[D]")
+    ends = np.array(end_dates, dtype="datetime64[D]")
+    lengths = np.clip((ends - starts).astype(np.int64) + 1, 1, CLIMATE_MAX_DAYS)
+    weights = np.zeros((len(starts), 12), dtype=np.float32)
+    if not len(starts):
+        return weights
+    offsets = np.arange(lengths.max())
+    months = (starts[:, None] + offsets).astype("datetime64[M]").astype(np.int64) % 12
+    in_trip = offsets < lengths[:, None]
+    np.add.at(weights, (np.nonzero(in_trip)[0], months[in_trip]), 1)
+    return weights / lengths[:, None]
+
+
+def has_climate_normals(destination: str) -> bool:
+    """Whether the weather header can be filled locally for this destination."""
+    return get_climate_normals().resolve(destination) >= 0
+
+
+def format_date_range(start_date, end_date) -> str:
+    return f"{start_date.strftime('%B %d, %Y')} to {end_date.strftime('%B %d, %Y')}"
+
+
+def format_temperature_range(low_c: float, high_c: float) -> str:
+    """e.g. "15-25°C / 59-77°F"; "to" keeps negative ranges readable."""
+    def span(low, high, unit):
+        return f"{low}{' to ' if low < 0 else '-'}{high}{unit}"
+
+    celsius = span(int(round(low_c)), int(round(high_c)), "°C")
+    fahrenheit = span(int(round(low_c * 9 / 5 + 32)), int(round(high_c * 9 / 5 + 32)), "°F")
+    return f"{celsius} / {fahrenheit}"
+
+
+def describe_weather(mean_c: float, low_c: float, high_c: float, precip_mm: float) -> str:
+    """Typical conditions from average temperature and monthly rainfall."""
+    if mean_c >= 27:
+        feel = "Hot"
+    elif mean_c >= 21:
+        feel = "Warm"
+    elif mean_c >= 15:
+        feel = "Mild"
+    elif mean_c >= 8:
+        feel = "Cool"
+    elif mean_c >= 0:
+        feel = "Cold"
+    else:
+        feel = "Freezing"
+
+    if precip_mm < 15:
+        rain = "and dry"
+    elif precip_mm < 60:
+        rain = "with occasional rain"
+    elif precip_mm < 120:
+        rain = "with regular rain"
+    elif precip_mm < 250:
+        rain = "with frequent rain"
+    else:
+        rain = "and very wet (rainy season)"
+
+    weather = f"{feel} {rain}"
+    if high_c - low_c >= 12:
+        weather += "; noticeably cooler at night"
+    return weather
+
+
+def recommend_clothing(mean_c: float, low_c: float, precip_mm: float) -> str:
+    """Packing advice matching describe_weather()."""
+    extras = []
+    if mean_c >= 24:
+        clothing = "Light, breathable clothing, a sun hat and sunscreen"
+        if low_c < 15:
+            extras.append("a light layer for cooler evenings")
+    elif mean_c >= 15:
+        clothing = "Light layers with a light jacket for the evenings"
+    elif mean_c >= 5:
+        clothing = "Warm layers, a sweater and a medium-weight jacket"
+    else:
+        clothing = "A heavy winter coat, hat, gloves and thermal layers"
+    if precip_mm >= 150:
+        extras += ["quick-drying walking shoes", "a rain jacket"]
+    else:
+        extras.append("comfortable walking shoes")
+        if precip_mm >= 60:
+            extras.append("a compact umbrella")
+    if len(extras) > 1:
+        return f"{clothing}, plus {', '.join(extras[:-1])} and {extras[-1]}."
+    return f"{clothing}, plus {extras[0]}."
+
+
+def climate_plan_headers(trips) -> list:
+    """
+    Batch-fill plan headers for (destination, start_date, end_date) trips.
+    Returns a PlanHeader per trip, or None where the destination has no normals.
+    """
+    trips = list(trips)
+    if not trips:
+        return []
+    normals = get_climate_normals()
+    rows = np.array([normals.resolve(destination) for destination, _, _ in trips], dtype=np.int64)
+    weights = month_weights([t[1] for t in trips], [t[2] for t in trips])
+    summary = normals.summarize(rows, weights)
+
+    headers = []
+    for (destination, start_date, end_date), row, (low, high, mean, precip) in zip(trips, rows, summary):
+        if row < 0:
+            headers.append(None)
+            continue
+        headers.append(PlanHeader(
+            travel_dates=format_date_range(start_date, end_date),
+            temperature=format_temperature_range(low, high),
+            weather=describe_weather(mean, low, high, precip),
+            what_to_wear=recommend_clothing(mean, low, precip),
+        ))
+    return headers
+
+
+def climate_headers(trips) -> list:
+    """Markdown headers for a batch of trips; "" where the destination has no normals."""
+    return [header_to_markdown(header) if header else "" for header in climate_plan_headers(trips)]
+
+
+def climate_plan_header(destination: str, start_date, end_date):
+    """PlanHeader for one trip from the climate normals, or None if not covered."""
+    return climate_plan_headers([(destination, start_date, end_date)])[0]
+
+
+def climate_header(destination: str, start_date, end_date) -> str:
+    """Markdown plan header for one trip from the climate normals, or "" if not covered."""
+    return climate_headers([(destination, start_date, end_date)])[0]
+
+# --------------------------------------------
+# AIRLINE ROUTES
+# --------------------------------------------
+
+# carrier,hub,cities: home cities (hub city first) each carrier connects through
+AIRLINE_CARRIERS_CSV = DATA_DIR / "airline_carriers.csv"
+# origin,destination,carrier,direct: known city pairs, valid in both directions
+AIRLINE_ROUTES_CSV = DATA_DIR / "airline_routes.csv"
+AIRLINE_OPTIONS = 3
+AIRLINE_CACHE_ENTRIES = 4096
+# Routes missing from the tables: ask the model for the section and cache its answer
+AIRLINE_LLM_FALLBACK = os.getenv("AIRLINE_LLM_FALLBACK", "1").strip().lower() not in ("0", "false", "no")
+
+
+@dataclass
+class AirlineOption:
+    """One carrier recommendation for a city pair."""
+    carrier: str
+    direct: bool
+    note: str = ""  # routing of a connecting option, or why a home carrier is listed
+
+
+class AirlineRouteIndex:
+    """City-pair lookup of carriers and direct-flight flags from the bundled tables."""
+
+    def __init__(self, carriers: pd.DataFrame, routes: pd.DataFrame):
+        self.hubs = {}  # carrier -> (hub airport, hub city)
+        self.home_carriers = {}  # city -> carriers based there
+        for row in carriers.itertuples(index=False):
+            cities = [c.strip() for c in row.cities.split(";") if c.strip()]
+            self.hubs[row.carrier] = (row.hub, cities[0] if cities else "")
+            for city in cities:
+                self.home_carriers.setdefault(city, []).append(row.carrier)
+
+        self.routes = {}  # (origin, destination) -> [(carrier, direct)], direct first
+        for row in routes.sort_values("direct", ascending=False).itertuples(index=False):
+            for pair in ((row.origin, row.destination), (row.destination, row.origin)):
+                self.routes.setdefault(pair, []).append((row.carrier, bool(row.direct)))
+
+        cities = set(self.home_carriers) | {city for pair in self.routes for city in pair}
+        self.places = PlaceMatcher(cities, PLACE_ALIASES)
+
+    @classmethod
+    def from_csv(cls, carriers_path=AIRLINE_CARRIERS_CSV, routes_path=AIRLINE_ROUTES_CSV) -> "AirlineRouteIndex":
+        """Load the bundled tables; unreadable files give an empty index."""
+        try:
+            carriers = pd.read_csv(carriers_path)
+            routes = pd.read_csv(routes_path)
+            index = cls(carriers, routes)
+        except (OSError, KeyError, ValueError, AttributeError) as e:
+            print(f"✗ Could not load airline routes: {e}")
+            return cls(
+                pd.DataFrame(columns=["carrier", "hub", "cities"]),
+                pd.DataFrame(columns=["origin", "destination", "carrier", "direct"]),
+            )
+        print(f"✓ Loaded {len(routes)} airline routes for {len(carriers)} carriers")
+        return index
+
+    def lookup(self, source_city: str, destination: str):
+        """
+        Up to AIRLINE_OPTIONS carriers for a trip, or None unless the city pair is
+        listed in the routes table (the model answers for other pairs). Listed
+        carriers come first; home carriers at either end fill in, without a
+        claimed stop count.
+        """
+        origin = self.places.resolve(source_city)
+        dest = self.places.resolve(destination)
+        listed = self.routes.get((origin, dest))
+        if not origin or not dest or origin == dest or not listed:
+            return None
+
+        options = [
+            AirlineOption(carrier, direct, "" if direct else self.connection_note(carrier, origin, dest))
+            for carrier, direct in listed
+        ]
+        seen = {option.carrier for option in options}
+        for city in (origin, dest):
+            for carrier in self.home_carriers.get(city, []):
+                if carrier not in seen:
+                    options.append(AirlineOption(
+                        carrier, False, f"Based in {city.title()}; check its current schedule for this route"
+                    ))
+                    seen.add(carrier)
+        return options[:AIRLINE_OPTIONS]
+
+    def connection_note(self, carrier: str, origin: str, dest: str) -> str:
+        """Note for a listed route the table marks as not direct."""
+        hub, hub_city = self.hubs.get(carrier, ("", ""))
+        if not hub:
+            return "Connecting itineraries on this route"
+        if hub_city == origin:
+            return f"Connecting itineraries from its {hub} hub with partner connections"
+        if hub_city == dest:
+            return f"Connecting itineraries into its {hub} hub"
+        return f"Connecting itineraries via {hub}"
+
+
+@st.cache_resource
+def get_airline_routes() -> AirlineRouteIndex:
+    """Bundled airline route index, loaded once per process."""
+    return AirlineRouteIndex.from_csv()
+
+
+@st.cache_resource
+def get_airline_cache() -> BoundedCache:
+    """(source city, destination) -> Recommended Airlines Markdown."""
+    return BoundedCache("airline_sections", AIRLINE_CACHE_ENTRIES)
+
+
+def airline_route_key(source_city: str, destination: str) -> tuple:
+    return (source_city or "").strip().lower(), (destination or "").strip().lower()
+
+
+def format_airline_section(options, source_city: str, destination: str) -> str:
+    """Recommended Airlines Markdown in the SYSTEM_PROMPT output format."""
+    origin = source_city.split(",")[0].strip()
+    dest = destination.split(",")[0].strip()
+    lines = [AIRLINE_SECTION_TITLE]
+    for option in options:
+        lines.append(f"**{option.carrier}**")
+        lines.append(f"- Nonstop flights between {origin} and {dest}" if option.direct else f"- {option.note}")
+        lines.append("")
+    lines.append("Schedules change seasonally; check current timetables before booking.")
+    return "\n".join(lines)
+
+
+def airline_section(source_city: str, destination: str) -> str:
+    """Recommended Airlines Markdown from the cache or the route index; "" if unknown."""
+    cache = get_airline_cache()
+    key = airline_route_key(source_city, destination)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    options = get_airline_routes().lookup(source_city, destination)
+    if options is None:
+        return ""
+    return cache.put(key, format_airline_section(options, source_city, destination))
+
+
+def llm_writes_airlines(source_city: str, destination: str) -> bool:
+    """Whether the completion itself must include the airline section."""
+    return AIRLINE_LLM_FALLBACK and not airline_section(source_city, destination)
+
+
+def split_airline_section(plan_md: str):
+    """Split a plan into (itinerary, airline section); the section is "" if absent."""
+    match = _AIRLINE_SECTION_RE.search(plan_md or "")
+    if not match:
+        return plan_md, ""
+    return plan_md[:match.start()].rstrip(), plan_md[match.start():].strip()
+
+
+def attach_airline_section(source_city: str, destination: str, plan_md: str, truncated: bool = False):
+    """
+    Complete a generated plan with its airline section.
+    Returns (plan_md, airline_info). A section written by the model is cached for
+    the route; otherwise the local one is appended.
+    """
+    _, airline_info = split_airline_section(plan_md)
+    if airline_info:
+        if not truncated:
+            get_airline_cache().put(airline_route_key(source_city, destination), airline_info)
+        return plan_md, airline_info
+    airline_info = airline_section(source_city, destination)
+    if airline_info:
+        plan_md = f"{plan_md.rstrip()}\n\n{airline_info}"
+    return plan_md, airline_info
+
+# --------------------------------------------
+# MULTI-CITY TRIPS
+# --------------------------------------------
+
+# "Paris → Rome → Athens" (or -> / >) in the destination field plans one leg per city
+_LEG_SEPARATOR_RE = re.compile(r"\s*(?:→|->|>)\s*")
+_LEG_DAY_TITLE_RE = re.compile(r"^Day\s+\d+\s*[:.\-–—]?\s*")
+_LEG_PLACE_RE = re.compile(r"^Day \d+ · ([^:]+)")
+MAX_TRIP_LEGS = 6
+LEG_SEPARATOR = " → "
+
+
+@dataclass
+class TripLeg:
+    """One stop of a multi-city trip."""
+    destination: str
+    start_date: object
+    end_date: object
+
+    @property
+    def days(self) -> int:
+        return trip_days(self.start_date, self.end_date)
+
+    def to_dict(self) -> dict:
+        return {"destination": self.destination, "start_date": self.start_date, "end_date": self.end_date}
+
+
+def split_destinations(text: str) -> list:
+    """Destinations of an arrow-separated route; a single name gives one item."""
+    return [name for name in _LEG_SEPARATOR_RE.split((text or "").strip()) if name]
+
+
+def even_legs(destinations, start_date, end_date) -> list:
+    """Split the trip dates into consecutive legs of (nearly) equal length."""
+    total = trip_days(start_date, end_date)
+    base, extra = divmod(total, len(destinations))
+    legs, day = [], start_date
+    for index, destination in enumerate(destinations):
+        length = max(base + (1 if index < extra else 0), 1)
+        legs.append(TripLeg(destination, day, day + timedelta(days=length - 1)))
+        day += timedelta(days=length)
+    return legs
+
+
+def parse_legs(items) -> list:
+    """TripLegs from dicts with destination, start_date and end_date (as stored in job params)."""
+    return [
+        TripLeg((item.get("destination") or "").strip(), item.get("start_date"), item.get("end_date"))
+        for item in items or []
+    ]
+
+
+def validate_legs(source_city, legs) -> str:
+    """Check a multi-city trip; returns an error message, or "" if valid."""
+    if not (source_city or "").strip():
+        return "Please enter your source city."
+    if not 2 <= len(legs) <= MAX_TRIP_LEGS:
+        return f"A multi-city trip needs between 2 and {MAX_TRIP_LEGS} destinations."
+    for index, leg in enumerate(legs, start=1):
+        error = validate_trip_inputs(source_city, leg.destination, leg.start_date, leg.end_date)
+        if error:
+            return f"Stop {index}: {error}"
+        # Stops never share a day, so every "Day N" of the stitched plan belongs to one city
+        if index > 1 and leg.start_date <= legs[index - 2].end_date:
+            return f"Stop {index} ({leg.destination}) must start after the previous stop ends."
+    return ""
+
+
+def trip_params(source_city, legs, interests, guardrails) -> dict:
+    """Job params for a multi-city trip; the trip spans its first to last leg."""
+    return {
+        "source_city": source_city,
+        "destination": LEG_SEPARATOR.join(leg.destination for leg in legs),
+        "start_date": legs[0].start_date,
+        "end_date": legs[-1].end_date,
+        "days": trip_days(legs[0].start_date, legs[-1].end_date),
+        "interests": interests,
+        "guardrails": guardrails,
+        "legs": [leg.to_dict() for leg in legs],
+    }
+
+
+def trip_context(source_city, legs, index: int) -> str:
+    """Shared context added to each leg's prompt so the legs fit together."""
+    leg = legs[index]
+    route = LEG_SEPARATOR.join(f"{stop.destination} ({format_date_range(stop.start_date, stop.end_date)})" for stop in legs)
+    arriving = source_city if index == 0 else legs[index - 1].destination
+    leaving = (
+        f"leaves for {legs[index + 1].destination} on the last day"
+        if index + 1 < len(legs) else f"heads home to {source_city} after the last day"
+    )
+    return (
+        f"This is stop {index + 1} of {len(legs)} on a multi-city trip from {source_city}: {route}. "
+        f"Plan only the {leg.days} day{'s' if leg.days != 1 else ''} in {leg.destination}; the traveler arrives "
+        f"from {arriving} on the first day and {leaving}. Avoid repeating experiences typical of the other stops."
+    )
+
+
+def trip_leg_params(params: dict) -> list:
+    """Per-leg job params for a trip; each leg flies in from the previous stop."""
+    legs = parse_legs(params["legs"])
+    return [
+        {
+            "source_city": params["source_city"] if index == 0 else legs[index - 1].destination,
+            "destination": leg.destination,
+            "start_date": leg.start_date,
+            "end_date": leg.end_date,
+            "days": leg.days,
+            "interests": params["interests"],
+            "guardrails": params["guardrails"],
+            "trip_context": trip_context(params["source_city"], legs, index),
+        }
+        for index, leg in enumerate(legs)
+    ]
+
+
+def leg_day_title(title: str, number: int, destination: str) -> str:
+    """Renumber a leg's day title within the whole trip: "Day 4 · Rome: Ancient Rome"."""
+    rest = _LEG_DAY_TITLE_RE.sub("", title).strip()
+    return f"Day {number} · {destination}" + (f": {rest}" if rest else "")
+
+
+def day_place(title: str) -> str:
+    """Destination of a stitched trip day (see leg_day_title()), or "" for a single-city plan."""
+    match = _LEG_PLACE_RE.match(title)
+    return match.group(1).strip() if match else ""
+
+
+def stitch_trip_itinerary(params: dict, leg_itineraries) -> Itinerary:
+    """
+    Join the legs' itineraries into one trip: days renumbered from the trip start
+    and tagged with their city, headers merged per city, airlines grouped by flight.
+    """
+    legs = parse_legs(params["legs"])
+    trip = Itinerary(header=PlanHeader(travel_dates=format_date_range(params["start_date"], params["end_date"])))
+    for attr in HEADER_ATTRS[1:]:
+        values = [
+            f"{leg.destination}: {getattr(itinerary.header, attr).rstrip('.')}"
+            for leg, itinerary in zip(legs, leg_itineraries) if getattr(itinerary.header, attr)
+        ]
+        setattr(trip.header, attr, " | ".join(values))
+
+    origin = params["source_city"]
+    for leg, itinerary in zip(legs, leg_itineraries):
+        first_day = (leg.start_date - params["start_date"]).days + 1
+        for offset, day in enumerate(itinerary.days):
+            trip.days.append(PlanDay(
+                title=leg_day_title(day.title, first_day + offset, leg.destination),
+                slots=day.slots,
+                notes=(list(itinerary.intro) if offset == 0 else []) + day.notes,
+            ))
+        for airline in itinerary.airlines:
+            trip.airlines.append(PlanAirline(name=f"{origin}{LEG_SEPARATOR}{leg.destination}: {airline.name}", reasons=airline.reasons))
+        trip.airline_notes += [note for note in itinerary.airline_notes if note not in trip.airline_notes]
+        origin = leg.destination
+    return trip
 
 # --------------------------------------------
 # PROMPTS
@@ -504,64 +1644,1573 @@ Output format:
 """).strip()
 
 
-def build_user_prompt(source_city, destination, start_date, end_date, days, interests, guardrails):
-    """Build user prompt from form inputs."""
-    date_range = f"{start_date.strftime('%B %d, %Y')} to {end_date.strftime('%B %d, %Y')}"
-    
-    return dedent(f"""
-    Traveling FROM: {source_city}
-    Traveling TO: {destination}
-    Travel dates: {date_range}
-    Number of days: {days}
-    Special interests: {interests or "General sightseeing, culture, and local experiences"}
-    Guardrails/Restrictions: {guardrails or "None"}
 
-    Create a detailed travel itinerary that makes the most of the time available.
-    
-    IMPORTANT: Start your response with:
-    **Travel Dates:** {date_range}
-    **Expected Temperature:** [provide temperature range in both °C and °F for {destination} during these dates]
-    **Weather:** [describe typical weather conditions]
-    **What to Wear:** [provide specific clothing recommendations based on the weather, planned activities, and local customs/culture]
-    
-    Then provide the day-by-day itinerary with specific recommendations and practical tips.
-    
-    At the end, recommend 2-3 best airlines for flights from {source_city} to {destination}, considering factors like direct flights, service quality, and typical pricing.
-    """).strip()
+JSON_OUTPUT_RULES = dedent("""
+Output format:
+Return a single JSON object that follows the response schema, with no Markdown around it.
+- "days": one entry per day in order, titled "Day N" (optionally "Day N - theme"), each with Morning, Afternoon, and Evening slots
+- Each activity is one plain-text string with the landmark or restaurant name, details, and practical tips
+""").strip()
+JSON_HEADER_RULE = (
+    '- "header": the travel dates, temperature range in both °C and °F, typical weather, '
+    "and clothing advice considering weather, activities, and local customs"
+)
+JSON_AIRLINES_RULE = (
+    '- "airlines": 2-3 best airline options for this route, each with reasons '
+    "(direct flights, service quality, typical price range)"
+)
+
+
+def build_system_prompt(local_header: bool = False, include_airlines: bool = True,
+                        output_format: str = PLAN_FORMAT_MARKDOWN) -> str:
+    """
+    SYSTEM_PROMPT without the parts filled locally: the weather header
+    (climate normals) and/or the airline section (route index). The JSON
+    format swaps the Markdown output template for JSON_OUTPUT_RULES.
+    """
+    prompt = SYSTEM_PROMPT
+    skipped = ()
+    if local_header or output_format == PLAN_FORMAT_JSON:
+        skipped += PLAN_HEADER_FIELDS + ("- IMPORTANT: After providing the date range",)
+    if not include_airlines or output_format == PLAN_FORMAT_JSON:
+        skipped += ("- At the END of your itinerary",)
+
+    if output_format == PLAN_FORMAT_JSON:
+        skipped += ("- Use clear Markdown formatting",)
+        prompt = prompt[:prompt.index("Output format:")]
+    elif not include_airlines:
+        prompt = prompt[:prompt.rindex(AIRLINE_SECTION_TITLE)]
+    lines = [line for line in prompt.splitlines() if not line.lstrip().startswith(skipped)]
+
+    if output_format == PLAN_FORMAT_JSON:
+        lines += ["", JSON_OUTPUT_RULES]
+        if not local_header:
+            lines.append(JSON_HEADER_RULE)
+        if include_airlines:
+            lines.append(JSON_AIRLINES_RULE)
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+LOCAL_HEADER_PROMPT_NOTE = (
+    "IMPORTANT: The travel dates, temperature, weather and clothing advice are added separately. "
+    "Do not include them; start your response directly with ## Day 1."
+)
+
+
+def build_user_prompt(source_city, destination, start_date, end_date, days, interests, guardrails,
+                      local_header=False, include_airlines=True, output_format=PLAN_FORMAT_MARKDOWN, trip_context=""):
+    """Build user prompt from form inputs (plus the shared context when this is one leg of a trip)."""
+    date_range = format_date_range(start_date, end_date)
+
+    if output_format == PLAN_FORMAT_JSON:
+        opening = "Return the itinerary as a JSON object that follows the response schema."
+        if not local_header:
+            opening += (
+                f' Fill "header" for {date_range} in {destination}: temperature range in both °C and °F, '
+                "typical weather, and clothing advice based on the weather, planned activities, and local customs."
+            )
+    elif local_header:
+        opening = LOCAL_HEADER_PROMPT_NOTE
+    else:
+        opening = dedent(f"""
+        IMPORTANT: Start your response with:
+        **Travel Dates:** {date_range}
+        **Expected Temperature:** [provide temperature range in both °C and °F for {destination} during these dates]
+        **Weather:** [describe typical weather conditions]
+        **What to Wear:** [provide specific clothing recommendations based on the weather, planned activities, and local customs/culture]
+
+        Then provide the day-by-day itinerary with specific recommendations and practical tips.
+        """).strip()
+
+    parts = [
+        dedent(f"""
+        Traveling FROM: {source_city}
+        Traveling TO: {destination}
+        Travel dates: {date_range}
+        Number of days: {days}
+        Special interests: {interests or "General sightseeing, culture, and local experiences"}
+        Guardrails/Restrictions: {guardrails or "None"}
+
+        Create a detailed travel itinerary that makes the most of the time available.
+        """).strip(),
+        opening,
+    ]
+    if trip_context:
+        parts.append(trip_context)
+    if include_airlines:
+        parts.append(
+            f"At the end, recommend 2-3 best airlines for flights from {source_city} to {destination}, "
+            "considering factors like direct flights, service quality, and typical pricing."
+        )
+    return "\n\n".join(parts)
+
+# --------------------------------------------
+# TOKEN BUDGET
+# --------------------------------------------
+
+# Rough completion sizes for the SYSTEM_PROMPT output format (gpt-4o-mini, English)
+CHARS_PER_TOKEN = 4
+TOKENS_HEADER = 180  # Travel Dates / Temperature / Weather / What to Wear (0 when filled locally)
+TOKENS_PER_DAY = 320  # Morning / Afternoon / Evening with details and tips
+TOKENS_PER_DAY_CONDENSED = 160
+TOKENS_AIRLINES = 220  # 0 when the route index answers locally
+BUDGET_HEADROOM = 1.25  # max_tokens = estimate * headroom
+JSON_TOKEN_OVERHEAD = 1.15  # keys, quotes and brackets of the JSON plan format
+MIN_COMPLETION_TOKENS = 800
+MAX_COMPLETION_TOKENS = 8000  # latency ceiling per request (model allows 16384)
+
+PLAN_DETAILED = "detailed"
+PLAN_CONDENSED = "condensed"
+
+CONDENSED_PROMPT_NOTE = dedent("""
+This is a long trip. Keep each day compact: one or two short bullet points per
+Morning, Afternoon, and Evening, without long descriptions.
+""").strip()
+
+TOKEN_USAGE_HISTORY = 500
+
+
+@dataclass
+class TokenBudget:
+    """Estimated token usage and output ceiling for one plan request."""
+    prompt_tokens: int
+    completion_tokens: int
+    max_tokens: int
+    strategy: str = PLAN_DETAILED
+    warning: str = ""
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count for English text."""
+    return -(-len(text or "") // CHARS_PER_TOKEN)
+
+
+def detail_multiplier(interests: str, guardrails: str) -> float:
+    """More interests and restrictions make each day's write-up longer."""
+    interest_count = len([i for i in (interests or "").split(",") if i.strip()])
+    multiplier = 1.0 + min(interest_count * 0.05, 0.25)
+    if (guardrails or "").strip():
+        multiplier += 0.05
+    return multiplier
+
+
+def estimate_token_budget(source_city, destination, start_date, end_date, days, interests, guardrails, trip_context="") -> TokenBudget:
+    """
+    Estimate prompt and completion tokens for a trip and pick an output ceiling.
+    Trips that would exceed MAX_COMPLETION_TOKENS switch to the condensed day format.
+    """
+    days = max(int(days), 1)
+    multiplier = detail_multiplier(interests, guardrails)
+    if PLAN_OUTPUT_FORMAT == PLAN_FORMAT_JSON:
+        multiplier *= JSON_TOKEN_OVERHEAD
+    messages = build_messages(
+        source_city, destination, start_date, end_date, days, interests, guardrails, trip_context=trip_context
+    )
+    prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    header_tokens = 0 if has_climate_normals(destination) else TOKENS_HEADER
+    airline_tokens = TOKENS_AIRLINES if llm_writes_airlines(source_city, destination) else 0
+
+    detailed = header_tokens + days * TOKENS_PER_DAY * multiplier + airline_tokens
+    if detailed * BUDGET_HEADROOM <= MAX_COMPLETION_TOKENS:
+        return TokenBudget(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=int(detailed),
+            max_tokens=max(int(detailed * BUDGET_HEADROOM), MIN_COMPLETION_TOKENS),
+        )
+
+    condensed = header_tokens + days * TOKENS_PER_DAY_CONDENSED * multiplier + airline_tokens
+    prompt_tokens += estimate_tokens(CONDENSED_PROMPT_NOTE)
+    if condensed * BUDGET_HEADROOM <= MAX_COMPLETION_TOKENS:
+        warning = f"Long trip ({days} days): using a condensed day-by-day format."
+    else:
+        warning = (
+            f"Very long trip ({days} days): the itinerary may be cut short. "
+            "Consider planning it in shorter segments."
+        )
+    return TokenBudget(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=int(condensed),
+        max_tokens=min(int(condensed * BUDGET_HEADROOM), MAX_COMPLETION_TOKENS),
+        strategy=PLAN_CONDENSED,
+        warning=warning,
+    )
+
+
+class TokenUsageLog:
+    """Bounded, thread-safe record of estimated vs. actual token usage."""
+
+    def __init__(self, maxlen: int = TOKEN_USAGE_HISTORY):
+        self.entries = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+
+    def record(self, budget: TokenBudget, days: int, usage, finish_reason: str = ""):
+        """Store one response's usage next to its estimate."""
+        if usage is None:
+            return
+        entry = {
+            "days": days,
+            "strategy": budget.strategy,
+            "estimated_prompt": budget.prompt_tokens,
+            "estimated_completion": budget.completion_tokens,
+            "max_tokens": budget.max_tokens,
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "truncated": finish_reason == "length",
+        }
+        with self.lock:
+            self.entries.append(entry)
+        print(
+            f"Tokens: prompt {usage.prompt_tokens} (est {budget.prompt_tokens}), "
+            f"completion {usage.completion_tokens} (est {budget.completion_tokens}, max {budget.max_tokens})"
+        )
+
+    def summary(self) -> dict:
+        """Aggregate figures for capacity planning."""
+        with self.lock:
+            entries = list(self.entries)
+        if not entries:
+            return {"requests": 0}
+        completion = [e["completion_tokens"] for e in entries]
+        return {
+            "requests": len(entries),
+            "avg_prompt_tokens": sum(e["prompt_tokens"] for e in entries) / len(entries),
+            "avg_completion_tokens": sum(completion) / len(entries),
+            "max_completion_tokens": max(completion),
+            "avg_completion_tokens_per_day": sum(c / e["days"] for c, e in zip(completion, entries)) / len(entries),
+            "estimate_ratio": sum(e["completion_tokens"] / e["estimated_completion"] for e in entries) / len(entries),
+            "truncated": sum(e["truncated"] for e in entries),
+        }
+
+
+@st.cache_resource
+def get_token_usage_log() -> TokenUsageLog:
+    """Process-wide token usage log."""
+    return TokenUsageLog()
+
+# --------------------------------------------
+# LLM BACKEND
+# --------------------------------------------
+
+# A backend is any object exposing OpenAI's client.chat.completions.create(...)
+_llm_client_override = None
+
+
+def create_llm_client(backend: str = None):
+    """Create the chat completions client for the configured backend."""
+    backend = backend or LLM_BACKEND
+    if backend == "fake":
+        from fake_llm import FakeLLMClient
+        return FakeLLMClient.from_env()
+    if backend == "openai":
+        if not OPENAI_API_KEY:
+            raise RuntimeError("OPENAI_API_KEY not found. Please set it in your .env file.")
+        # The model router retries and hedges across routes; SDK retries would multiply its attempts
+        return OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    raise ValueError(f"Unknown LLM_BACKEND: {backend!r} (expected 'openai' or 'fake')")
+
+
+@st.cache_resource
+def get_backend_client(backend: str):
+    """Client for one backend, shared across sessions and routes."""
+    return create_llm_client(backend)
+
+
+def get_default_llm_client():
+    """Client for LLM_BACKEND, shared across sessions."""
+    return get_backend_client(LLM_BACKEND)
+
+
+def get_llm_client():
+    """Client used for all plan generation calls."""
+    if _llm_client_override is not None:
+        return _llm_client_override
+    return get_default_llm_client()
+
+
+def set_llm_client(llm_client):
+    """Override the backend client (e.g. with a FakeLLMClient); None restores the default."""
+    global _llm_client_override
+    _llm_client_override = llm_client
+
+# --------------------------------------------
+# MODEL ROUTING
+# --------------------------------------------
+
+# Ordered "backend:model@deadline" choices, e.g. "openai:gpt-4o-mini@45,openai:gpt-4o@60".
+# A request starts on the first route; another attempt (the next route, wrapping
+# around) is launched when the current one is slower than its hedge delay or fails.
+# Route deadlines bound the wait for the first token and any later stall, and
+# PLAN_DEADLINE_SECONDS the wait until some route produces text; neither cuts
+# off a completion that keeps streaming.
+PLAN_MODEL = "gpt-4o-mini"
+PLAN_ROUTE_DEADLINE = 60.0  # seconds to first token (or between chunks) when a route gives none
+PLAN_ROUTES = os.getenv("PLAN_ROUTES", f"{LLM_BACKEND}:{PLAN_MODEL}@{PLAN_ROUTE_DEADLINE:g}")
+PLAN_DEADLINE_SECONDS = float(os.getenv("PLAN_DEADLINE_SECONDS", "90"))  # then fall back to a cached/template plan
+ROUTER_MAX_ATTEMPTS = int(os.getenv("ROUTER_MAX_ATTEMPTS", "3"))  # primary + hedges/retries per request
+
+# Hedge after the route's p95 time to first token (plus p95 generation time when
+# waiting for the whole completion); the initial delay applies until enough samples exist
+HEDGE_PERCENTILE = 95
+HEDGE_INITIAL_DELAY = float(os.getenv("HEDGE_DELAY_SECONDS", "5"))
+HEDGE_MIN_DELAY = 0.25
+HEDGE_MIN_SAMPLES = 20
+INITIAL_SECONDS_PER_1K_TOKENS = 15.0  # generation time before the rate histogram has samples
+LATENCY_HISTOGRAM_WINDOW = 1000  # samples before old counts are halved, so thresholds follow drift
+
+
+class PlanDeadlineExceeded(TimeoutError):
+    """No model route produced text within PLAN_DEADLINE_SECONDS (or the winner stalled past its route deadline)."""
+
+
+@dataclass
+class ModelRoute:
+    """One backend/model choice with its per-attempt deadline (time to first token or between chunks)."""
+    backend: str
+    model: str
+    deadline: float = PLAN_ROUTE_DEADLINE
+
+    @property
+    def name(self) -> str:
+        return f"{self.backend}:{self.model}"
+
+
+def parse_routes(spec: str) -> list:
+    """Parse PLAN_ROUTES ("backend:model@deadline,..."); backend and deadline are optional."""
+    routes = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        target, _, deadline = item.partition("@")
+        backend, _, model = target.rpartition(":")
+        routes.append(ModelRoute(
+            backend=(backend or LLM_BACKEND).strip().lower(),
+            model=model.strip() or PLAN_MODEL,
+            deadline=float(deadline) if deadline else PLAN_ROUTE_DEADLINE,
+        ))
+    if not routes:
+        raise ValueError("PLAN_ROUTES must list at least one backend:model route.")
+    return routes
+
+
+class LatencyHistogram:
+    """Log-bucketed latency counts with decay, for cheap percentile estimates."""
+
+    BOUNDS = np.geomspace(0.01, 600.0, 64)  # bucket upper edges in seconds
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.BOUNDS) + 1)
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.counts[np.searchsorted(self.BOUNDS, seconds)] += 1
+            if self.counts.sum() > LATENCY_HISTOGRAM_WINDOW:
+                self.counts *= 0.5
+
+    @property
+    def samples(self) -> float:
+        with self.lock:
+            return float(self.counts.sum())
+
+    def percentile(self, pct: float) -> float:
+        """Upper edge of the bucket holding the pct-th percentile (0.0 when empty)."""
+        with self.lock:
+            total = self.counts.sum()
+            if not total:
+                return 0.0
+            bucket = int(np.searchsorted(np.cumsum(self.counts), total * pct / 100))
+        return float(self.BOUNDS[min(bucket, len(self.BOUNDS) - 1)])
+
+
+@dataclass
+class RouteStats:
+    """Latency histograms and outcome counters for one route."""
+    first_token: LatencyHistogram = field(default_factory=LatencyHistogram)
+    per_1k_tokens: LatencyHistogram = field(default_factory=LatencyHistogram)  # generation time after the first token
+    attempts: int = 0
+    hedges: int = 0
+    wins: int = 0
+    failures: int = 0
+
+
+class RouteAttempt:
+    """One in-flight completion request on a route."""
+
+    def __init__(self, route: ModelRoute):
+        self.route = route
+        self.started = time.perf_counter()
+        self.deadline = self.started + route.deadline  # pushed back by every chunk
+        self.first_token_at = 0.0
+        self.stream = None
+        self.closed = False
+        self.buffer = []  # chunks received before the attempt won (stream mode)
+        self.text = []  # content received (completion mode)
+        self.usage = None
+        self.finish_reason = ""
+
+    def consume(self, chunk):
+        """Track text, usage and finish reason of a chunk."""
+        self.deadline = time.perf_counter() + self.route.deadline
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return ""
+        self.finish_reason = chunk.choices[0].finish_reason or self.finish_reason
+        delta = chunk.choices[0].delta.content or ""
+        if delta and not self.first_token_at:
+            self.first_token_at = time.perf_counter()
+        self.text.append(delta)
+        return delta
+
+    def completion_tokens(self) -> int:
+        if self.usage is not None:
+            return self.usage.completion_tokens
+        return estimate_tokens("".join(self.text))
+
+
+_ATTEMPT_DONE = object()
+
+
+class ModelRouter:
+    """Routes plan requests across PLAN_ROUTES with hedging, deadlines and latency tracking."""
+
+    def __init__(self, routes: list):
+        self.routes = routes
+        self.stats = {route.name: RouteStats() for route in routes}
+        self.clients = {}  # route name -> (backend client, copy with the route's timeout)
+        self.lock = threading.Lock()
+
+    def client(self, route: ModelRoute):
+        """
+        Client for a route (set_llm_client() overrides every route). OpenAI clients
+        get the route deadline as their timeout, so a hung request fails instead of
+        holding its thread for the SDK's 10-minute default.
+        """
+        base = _llm_client_override if _llm_client_override is not None else get_backend_client(route.backend)
+        if not hasattr(base, "with_options"):
+            return base
+        with self.lock:
+            cached_base, client = self.clients.get(route.name, (None, None))
+            if cached_base is not base:
+                client = base.with_options(timeout=route.deadline, max_retries=0)
+                self.clients[route.name] = (base, client)
+        return client
+
+    def hedge_delay(self, route: ModelRoute, expected_tokens: int = 0) -> float:
+        """
+        How long to wait on an attempt before launching another one. Waits on the
+        first token are capped by the route deadline; waits on a whole completion
+        by PLAN_DEADLINE_SECONDS, since the route deadline only bounds a stall.
+        """
+        stats = self.stats[route.name]
+        if stats.first_token.samples >= HEDGE_MIN_SAMPLES:
+            delay = stats.first_token.percentile(HEDGE_PERCENTILE)
+        else:
+            delay = HEDGE_INITIAL_DELAY
+        cap = route.deadline
+        if expected_tokens:
+            if stats.per_1k_tokens.samples >= HEDGE_MIN_SAMPLES:
+                rate = stats.per_1k_tokens.percentile(HEDGE_PERCENTILE)
+            else:
+                rate = INITIAL_SECONDS_PER_1K_TOKENS
+            delay += rate * expected_tokens / 1000
+            cap = max(PLAN_DEADLINE_SECONDS, route.deadline)
+        return min(max(delay, HEDGE_MIN_DELAY), cap)
+
+    def count(self, route: ModelRoute, counter: str):
+        with self.lock:
+            stats = self.stats[route.name]
+            setattr(stats, counter, getattr(stats, counter) + 1)
+
+    def observe(self, attempt: RouteAttempt):
+        """Record a finished attempt's time to first token and generation rate."""
+        stats = self.stats[attempt.route.name]
+        if not attempt.first_token_at:
+            return
+        stats.first_token.record(attempt.first_token_at - attempt.started)
+        tokens = attempt.completion_tokens()
+        if tokens:
+            stats.per_1k_tokens.record((time.perf_counter() - attempt.first_token_at) * 1000 / tokens)
+
+    def observe_abandoned(self, attempt: RouteAttempt):
+        """
+        Record an attempt closed before it finished (lost to a hedge or timed out).
+        Without a first token, the time it waited is recorded as a lower bound, so
+        slow attempts that lose still raise the percentile the hedge delay follows.
+        """
+        waited = (attempt.first_token_at or time.perf_counter()) - attempt.started
+        self.stats[attempt.route.name].first_token.record(waited)
+
+    def request(self, request: dict, expected_tokens: int = 0) -> "HedgedRequest":
+        """
+        Start a hedged chat completion (create() kwargs without model/stream).
+        expected_tokens > 0 hedges on total completion time rather than time to first token.
+        """
+        return HedgedRequest(self, request, expected_tokens)
+
+    def report(self) -> list:
+        """Per-route latency percentiles, current hedge delay and outcome counts."""
+        report = []
+        for route in self.routes:
+            stats = self.stats[route.name]
+            report.append({
+                "route": route.name,
+                "deadline": route.deadline,
+                "samples": int(stats.first_token.samples),
+                "first_token_p50": stats.first_token.percentile(50),
+                "first_token_p95": stats.first_token.percentile(95),
+                "hedge_delay": self.hedge_delay(route),
+                "attempts": stats.attempts,
+                "hedges": stats.hedges,
+                "wins": stats.wins,
+                "failures": stats.failures,
+            })
+        return report
+
+
+class HedgedRequest:
+    """
+    One logical plan request raced across routes. The first attempt starts at once;
+    another is launched when the newest one exceeds its hedge delay or an attempt
+    fails. The first usable result wins and every other attempt is closed.
+    Iterate it like an OpenAI stream (the winner is the first attempt to produce
+    text), or call complete() to wait for the first completion that validates.
+    """
+
+    def __init__(self, router: ModelRouter, request: dict, expected_tokens: int = 0):
+        self.router = router
+        self.request = request
+        self.expected_tokens = expected_tokens
+        self.deadline = time.perf_counter() + PLAN_DEADLINE_SECONDS
+        self.events = queue.Queue()
+        self.attempts = []
+        self.winner = None
+        self.next_hedge_at = 0.0
+        self.last_error = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            for attempt, item in self._events():
+                if isinstance(item, Exception):
+                    self._fail(attempt, item)
+                elif item is _ATTEMPT_DONE:
+                    if attempt is self.winner:
+                        self.router.observe(attempt)
+                        return
+                    self._fail(attempt, ValueError(f"{attempt.route.name} returned no itinerary text"))
+                elif attempt is self.winner:
+                    attempt.consume(item)
+                    yield item
+                else:
+                    attempt.buffer.append(item)
+                    if attempt.consume(item):
+                        self._win(attempt)
+                        yield from attempt.buffer
+                        attempt.buffer = []
+        finally:
+            self.close()
+
+    def complete(self, validate):
+        """
+        Wait for the first attempt whose full text passes validate(text, finish_reason);
+        a ValueError from validate rejects that attempt and another is tried.
+        Returns (validated value, winning RouteAttempt), or None if closed meanwhile.
+        """
+        try:
+            for attempt, item in self._events():
+                if isinstance(item, Exception):
+                    self._fail(attempt, item)
+                elif item is _ATTEMPT_DONE:
+                    try:
+                        value = validate("".join(attempt.text), attempt.finish_reason)
+                    except ValueError as e:
+                        self._fail(attempt, e)
+                        continue
+                    self._win(attempt)
+                    self.router.observe(attempt)
+                    return value, attempt
+                else:
+                    attempt.consume(item)
+        finally:
+            self.close()
+
+    def close(self):
+        """Abort every attempt still streaming."""
+        with self.lock:
+            self.closed = True
+            attempts = list(self.attempts)
+        for attempt in attempts:
+            self._close_attempt(attempt)
+        self.events.put((None, None))  # wake the consumer
+
+    def _events(self):
+        """(attempt, chunk | _ATTEMPT_DONE | exception) from live attempts, hedging on a timer."""
+        self._launch()
+        while not self.closed:
+            now = time.perf_counter()
+            # The overall deadline only guards the wait for text; output already streaming is kept
+            producing = any(attempt.first_token_at for attempt in self._live())
+            if now >= self.deadline and not producing:
+                raise PlanDeadlineExceeded(f"No itinerary within {PLAN_DEADLINE_SECONDS:g}s.")
+            for attempt in self._live():
+                if now >= attempt.deadline:
+                    self._fail(attempt, TimeoutError(f"{attempt.route.name} sent nothing for {attempt.route.deadline:g}s"))
+            if self.winner is None and (now >= self.next_hedge_at or not self._live()):
+                if not self._launch(hedge=bool(self._live())) and not self._live():
+                    raise self.last_error or RuntimeError("No model route could be tried.")
+            wake = min(
+                [self.next_hedge_at]
+                + ([] if producing else [self.deadline])
+                + [attempt.deadline for attempt in self._live()]
+            )
+            try:
+                attempt, item = self.events.get(timeout=max(wake - time.perf_counter(), 0.001))
+            except queue.Empty:
+                continue
+            if attempt is not None and not attempt.closed:
+                yield attempt, item
+
+    def _live(self) -> list:
+        return [attempt for attempt in self.attempts if not attempt.closed]
+
+    def _launch(self, hedge: bool = False) -> bool:
+        """
+        Start an attempt on the next route, alongside slow live attempts (hedge)
+        or after failed ones; False once ROUTER_MAX_ATTEMPTS is reached.
+        """
+        with self.lock:
+            if self.closed or len(self.attempts) >= ROUTER_MAX_ATTEMPTS:
+                self.next_hedge_at = float("inf")
+                return False
+            routes = self.router.routes
+            route = routes[len(self.attempts) % len(routes)]
+            attempt = RouteAttempt(route)
+            self.attempts.append(attempt)
+        self.next_hedge_at = attempt.started + self.router.hedge_delay(route, self.expected_tokens)
+        self.router.count(route, "attempts")
+        if hedge:
+            self.router.count(route, "hedges")
+            print(f"↻ Hedging plan request on {route.name} (attempt {len(self.attempts)})")
+        elif len(self.attempts) > 1:
+            print(f"↻ Retrying plan request on {route.name} (attempt {len(self.attempts)})")
+        threading.Thread(target=self._pump, args=(attempt,), name=f"plan-route-{route.model}", daemon=True).start()
+        return True
+
+    def _pump(self, attempt: RouteAttempt):
+        """Attempt thread: forward the route's stream into the event queue."""
+        try:
+            stream = self.router.client(attempt.route).chat.completions.create(
+                model=attempt.route.model,
+                stream=True,
+                stream_options={"include_usage": True},
+                **self.request,
+            )
+            with self.lock:
+                attempt.stream = stream
+            # Closing may have raced the request being opened
+            if attempt.closed:
+                stream.close()
+                return
+            for chunk in stream:
+                self.events.put((attempt, chunk))
+            self.events.put((attempt, _ATTEMPT_DONE))
+        except Exception as e:
+            self.events.put((attempt, e))
+
+    def _win(self, attempt: RouteAttempt):
+        self.winner = attempt
+        self.next_hedge_at = float("inf")
+        self.router.count(attempt.route, "wins")
+        for other in self._live():
+            if other is not attempt:
+                self.router.observe_abandoned(other)
+                self._close_attempt(other)
+
+    def _fail(self, attempt: RouteAttempt, error: Exception):
+        self._close_attempt(attempt)
+        self.router.count(attempt.route, "failures")
+        if attempt is self.winner:
+            if isinstance(error, TimeoutError):
+                raise PlanDeadlineExceeded(str(error))
+            raise error
+        print(f"✗ Plan attempt on {attempt.route.name} failed: {error}")
+        # Errors raised straight away say nothing about latency
+        if attempt.first_token_at or isinstance(error, TimeoutError):
+            self.router.observe_abandoned(attempt)
+        self.last_error = error
+        # Try the next route right away instead of waiting for the hedge timer
+        self.next_hedge_at = 0.0
+
+    def _close_attempt(self, attempt: RouteAttempt):
+        with self.lock:
+            attempt.closed = True
+            stream = attempt.stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception as e:
+                print(f"✗ Could not close stream on {attempt.route.name}: {e}")
+
+
+@st.cache_resource
+def get_model_router() -> ModelRouter:
+    """Router over PLAN_ROUTES, shared so latency histograms cover every session."""
+    return ModelRouter(parse_routes(PLAN_ROUTES))
+
+# --------------------------------------------
+# FALLBACK PLANS
+# --------------------------------------------
+
+FALLBACK_PLAN_ENTRIES = 256
+
+# Used when no route answers in time and no recent plan exists for the same trip and preferences
+TEMPLATE_ACTIVITIES = {
+    "Morning": [
+        "Walk the historic center of {destination} and its main square",
+        "Visit the best-known museum in {destination} early, before the crowds",
+        "Breakfast at a local café, then explore a market in {destination}",
+    ],
+    "Afternoon": [
+        "Lunch on regional dishes, then tour a landmark of {destination}",
+        "Explore a different neighbourhood of {destination} on foot",
+        "Take a guided tour or boat trip to see {destination} from a new angle",
+    ],
+    "Evening": [
+        "Dinner at a well-reviewed local restaurant (reserve ahead)",
+        "Sunset at a viewpoint, then an evening stroll",
+        "Catch a show, concert or night market",
+    ],
+}
+
+
+@st.cache_resource
+def get_fallback_plan_cache() -> BoundedCache:
+    """(destination, days, interests, guardrails) -> Itinerary of the latest generated plan, reused past the deadline."""
+    return BoundedCache("fallback_plans", FALLBACK_PLAN_ENTRIES, sizeof=Itinerary.size_bytes)
+
+
+def fallback_plan_key(destination: str, days: int, interests: str = "", guardrails: str = "") -> tuple:
+    """Cache key; a plan is only reused for the same interests and guardrails it was written for."""
+    def normalized(text):
+        return " ".join((text or "").lower().split())
+
+    place = get_climate_normals().places.resolve(destination) or normalized(destination)
+    return place, days, normalized(interests), normalized(guardrails)
+
+
+def remember_fallback_plan(destination: str, days: int, interests: str, guardrails: str, plan_md: str):
+    """Keep a generated plan as the fallback for later identical trips (place, length and preferences)."""
+    get_fallback_plan_cache().put(fallback_plan_key(destination, days, interests, guardrails), get_itinerary(plan_md))
+
+
+def template_itinerary(destination: str, days: int) -> Itinerary:
+    """Generic day-by-day plan built without the model."""
+    itinerary = Itinerary()
+    for day in range(days):
+        itinerary.days.append(PlanDay(title=f"Day {day + 1}", slots=[
+            PlanSlot(name=slot, activities=[options[day % len(options)].format(destination=destination)])
+            for slot, options in TEMPLATE_ACTIVITIES.items()
+        ]))
+    return itinerary
+
+
+def fallback_plan(source_city, destination, start_date, end_date, days, interests="", guardrails=""):
+    """
+    Plan served when routing hits PLAN_DEADLINE_SECONDS: the latest plan for the same
+    destination, length, interests and guardrails, else a template, with the header and
+    airlines filled locally. Returns (plan_md, airline_info, source) where source is "cached" or "template".
+    """
+    cached = get_fallback_plan_cache().get(fallback_plan_key(destination, days, interests, guardrails))
+    source = "cached" if cached is not None else "template"
+    base = cached or template_itinerary(destination, days)
+    itinerary = Itinerary(intro=list(base.intro), days=list(base.days))
+    itinerary.header = climate_plan_header(destination, start_date, end_date) or PlanHeader(
+        travel_dates=format_date_range(start_date, end_date)
+    )
+    airline_info = airline_section(source_city, destination)
+    if airline_info:
+        local = parse_plan_markdown(airline_info)
+        itinerary.airlines, itinerary.airline_notes = local.airlines, local.airline_notes
+    plan_md = itinerary_to_markdown(itinerary)
+    remember_itinerary(plan_md, itinerary)
+    print(f"↺ Serving {source} fallback plan for {destination} ({days} days)")
+    return plan_md, airline_info, source
 
 # --------------------------------------------
 # OPENAI CALL
 # --------------------------------------------
 
 
-def generate_travel_plan(source_city, destination, start_date, end_date, days, interests, guardrails):
-    """Generate travel plan using OpenAI API."""
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": build_user_prompt(
-                    source_city, destination, start_date, end_date, days, interests, guardrails
-                ),
-            },
-        ],
-        temperature=0.7,
+def build_messages(source_city, destination, start_date, end_date, days, interests, guardrails, strategy=PLAN_DETAILED,
+                   trip_context=""):
+    """
+    Build the chat messages for a travel plan request.
+    Catalog destinations leave the weather header out (see climate_header()) and
+    known routes leave the airline section out (see attach_airline_section()).
+    trip_context places one leg within a multi-city trip (see trip_context()).
+    """
+    local_header = has_climate_normals(destination)
+    include_airlines = llm_writes_airlines(source_city, destination)
+    user_prompt = build_user_prompt(
+        source_city, destination, start_date, end_date, days, interests, guardrails,
+        local_header, include_airlines, PLAN_OUTPUT_FORMAT, trip_context,
+    )
+    if strategy == PLAN_CONDENSED:
+        user_prompt = f"{user_prompt}\n\n{CONDENSED_PROMPT_NOTE}"
+    return [
+        {"role": "system", "content": build_system_prompt(local_header, include_airlines, PLAN_OUTPUT_FORMAT)},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def plan_request_kwargs(source_city, destination) -> dict:
+    """Extra create() arguments for PLAN_OUTPUT_FORMAT (the JSON schema in json mode)."""
+    if PLAN_OUTPUT_FORMAT != PLAN_FORMAT_JSON:
+        return {}
+    return {"response_format": plan_response_format(
+        include_header=not has_climate_normals(destination),
+        include_airlines=llm_writes_airlines(source_city, destination),
+    )}
+
+
+def finish_json_plan(source_city, destination, start_date, end_date, text: str):
+    """
+    Build the final plan from a JSON completion: validate it, fill the header and
+    airlines locally where available, render Markdown and cache the Itinerary.
+    Returns (plan_md, airline_info); raises ValueError on malformed output.
+    """
+    itinerary = parse_itinerary_json(text)
+    header = climate_plan_header(destination, start_date, end_date)
+    if header is not None:
+        itinerary.header = header
+    if itinerary.airlines:
+        airline_info = airlines_to_markdown(itinerary.airlines)
+        get_airline_cache().put(airline_route_key(source_city, destination), airline_info)
+    else:
+        airline_info = airline_section(source_city, destination)
+        local = parse_plan_markdown(airline_info)
+        itinerary.airlines, itinerary.airline_notes = local.airlines, local.airline_notes
+    plan_md = itinerary_to_markdown(itinerary)
+    remember_itinerary(plan_md, itinerary)
+    return plan_md, airline_info
+
+
+def finish_plan(source_city, destination, start_date, end_date, text: str, finish_reason: str = ""):
+    """
+    Final (plan_md, airline_info) from a complete PLAN_OUTPUT_FORMAT completion.
+    Raises ValueError for unusable output (the router then tries another route)
+    and RuntimeError when JSON was cut off by the token limit.
+    """
+    if PLAN_OUTPUT_FORMAT == PLAN_FORMAT_JSON:
+        try:
+            return finish_json_plan(source_city, destination, start_date, end_date, text)
+        except ValueError as e:
+            if finish_reason == "length":
+                raise RuntimeError("The itinerary hit its length limit before the JSON was complete.")
+            raise ValueError(f"Malformed itinerary JSON: {e}")
+    if not text.strip():
+        raise ValueError("The model returned an empty itinerary.")
+    header = climate_header(destination, start_date, end_date)
+    plan_md = f"{header}\n\n{text}" if header else text
+    return attach_airline_section(source_city, destination, plan_md, finish_reason == "length")
+
+
+def plan_request(source_city, destination, start_date, end_date, days, interests, guardrails, budget: TokenBudget,
+                 trip_context="") -> dict:
+    """create() arguments for a plan request; the router adds model and streaming."""
+    return {
+        "messages": build_messages(
+            source_city, destination, start_date, end_date, days, interests, guardrails, budget.strategy, trip_context
+        ),
+        "temperature": 0.7,
+        "max_tokens": budget.max_tokens,
+        **plan_request_kwargs(source_city, destination),
+    }
+
+
+def generate_travel_plan(source_city, destination, start_date, end_date, days, interests, guardrails, trip_context=""):
+    """
+    Generate travel plan through the model router.
+    Returns a cached or template plan (see fallback_plan()) past PLAN_DEADLINE_SECONDS.
+    """
+    budget = estimate_token_budget(
+        source_city, destination, start_date, end_date, days, interests, guardrails, trip_context
+    )
+    request = get_model_router().request(
+        plan_request(source_city, destination, start_date, end_date, days, interests, guardrails, budget, trip_context),
+        expected_tokens=budget.completion_tokens,
+    )
+    try:
+        (plan_md, _), attempt = request.complete(
+            lambda text, finish_reason: finish_plan(source_city, destination, start_date, end_date, text, finish_reason)
+        )
+    except PlanDeadlineExceeded as e:
+        print(f"✗ {e}")
+        plan_md, _, _ = fallback_plan(source_city, destination, start_date, end_date, days, interests, guardrails)
+        return plan_md
+    get_token_usage_log().record(budget, days, attempt.usage, attempt.finish_reason)
+    if attempt.finish_reason != "length":
+        remember_fallback_plan(destination, days, interests, guardrails, plan_md)
+    return plan_md
+
+
+def stream_travel_plan(source_city, destination, start_date, end_date, days, interests, guardrails, budget=None,
+                       trip_context=""):
+    """
+    Start a streaming travel plan request through the model router.
+    Returns a HedgedRequest; iterate it for chunks and call close() to abort upstream.
+    The final chunk carries token usage. Callers add climate_header() and
+    attach_airline_section(), or use finish_plan(), themselves.
+    """
+    if budget is None:
+        budget = estimate_token_budget(
+            source_city, destination, start_date, end_date, days, interests, guardrails, trip_context
+        )
+    return get_model_router().request(
+        plan_request(source_city, destination, start_date, end_date, days, interests, guardrails, budget, trip_context)
     )
-    return response.choices[0].message.content
+
+# --------------------------------------------
+# BACKGROUND GENERATION JOBS
+# --------------------------------------------
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_POLL_INTERVAL = 1.0  # seconds between UI refreshes while a job runs
+JOB_TTL_SECONDS = 60 * 60  # finished jobs stay attachable for an hour
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+JOB_ACTIVE_STATES = (JOB_QUEUED, JOB_RUNNING)
+
+
+@dataclass
+class GenerationJob:
+    """State of one background itinerary generation."""
+    job_id: str
+    fingerprint: str
+    params: dict
+    status: str = JOB_QUEUED
+    result: str = ""
+    error: str = ""
+    created_at: float = field(default_factory=time.time)
+    finished_at: float = 0.0
+    chunks: list = field(default_factory=list)
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    stream: object = None
+    future: Future = field(default_factory=Future)  # resolved once the job reaches a final state
+    usage: object = None
+    truncated: bool = False
+    airline_info: str = ""
+    fallback: str = ""  # "cached" or "template" when served past PLAN_DEADLINE_SECONDS
+    legs: list = field(default_factory=list)  # per-leg jobs of a multi-city trip
+    subscribers: set = field(default_factory=set)  # sessions/clients/trips waiting on it; cancelled when the last leaves
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @property
+    def partial_text(self) -> str:
+        with self.lock:
+            text = "".join(self.chunks) or self.result
+            legs = list(self.legs)
+        if text or not legs:
+            return text
+        # Legs run concurrently but are revealed in order, so the text only grows
+        shown = []
+        for leg in legs:
+            shown.append(f"## 📍 {leg.params['destination']}\n\n{leg.partial_text}")
+            if leg.is_active:
+                break
+        return "\n\n".join(shown)
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in JOB_ACTIVE_STATES
+
+    def cancel(self):
+        """Cancel the job and abort the upstream request if it is streaming (JobManager.release() decides when)."""
+        self.cancel_event.set()
+        with self.lock:
+            stream = self.stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception as e:
+                print(f"✗ Could not close stream for job {self.job_id}: {e}")
+
+
+def job_fingerprint(params: dict) -> str:
+    """Stable hash of the generation inputs, used to de-duplicate identical requests."""
+    payload = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class JobManager:
+    """Process-wide registry of generation jobs backed by a thread pool."""
+
+    def __init__(self, max_workers: int = JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plan-job")
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, params: dict, subscriber: str = "") -> GenerationJob:
+        """
+        Start a job, or return the active/finished job for identical inputs, and
+        subscribe the caller to it. Callers that pass no subscriber id can never
+        release the job, so it always runs to completion.
+        """
+        fingerprint = job_fingerprint(params)
+        with self.lock:
+            self._prune()
+            job = self._find(fingerprint)
+            if job is not None:
+                print(f"↺ Reusing job {job.job_id} ({job.status})")
+                job.subscribers.add(subscriber or uuid.uuid4().hex)
+                return job
+            job = GenerationJob(job_id=uuid.uuid4().hex, fingerprint=fingerprint, params=params)
+            job.subscribers.add(subscriber or uuid.uuid4().hex)
+            self.jobs[job.job_id] = job
+        # The future exists before the job is published, so a concurrent identical submit can wait on it
+        if params.get("legs"):
+            self._start_trip(job)
+        else:
+            self.executor.submit(self._run, job).add_done_callback(lambda _: job.future.set_result(None))
+        return job
+
+    def find(self, params: dict):
+        """The job submit() would reuse for these inputs, or None if it would start one."""
+        fingerprint = job_fingerprint(params)
+        with self.lock:
+            return self._find(fingerprint)
+
+    def _find(self, fingerprint: str):
+        """Active or cleanly finished job with this fingerprint. Caller holds the lock."""
+        for job in self.jobs.values():
+            if job.fingerprint != fingerprint or job.cancel_event.is_set():
+                continue
+            if job.is_active or (job.status == JOB_DONE and not job.fallback):
+                return job
+        return None
+
+    def backlog(self):
+        """(queued jobs, seconds the oldest of them has waited): the generation load signal."""
+        now = time.time()
+        with self.lock:
+            waits = [now - job.created_at for job in self.jobs.values() if job.status == JOB_QUEUED]
+        return len(waits), max(waits, default=0.0)
+
+    def get(self, job_id: str):
+        """Look up a job by id, or None if it is unknown or expired."""
+        if not job_id:
+            return None
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def subscribe(self, job_id: str, subscriber: str):
+        """Add a subscriber to an existing job (e.g. a session reattaching after a reload)."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.subscribers.add(subscriber)
+
+    def release(self, job_id: str, subscriber: str):
+        """
+        Unsubscribe from a job. The last subscriber leaving an active job cancels it,
+        which in turn releases its trip legs.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.subscribers.discard(subscriber)
+            if job.subscribers or not job.is_active or job.cancel_event.is_set():
+                return
+            # Set under the lock so a concurrent submit() cannot reuse the job
+            job.cancel_event.set()
+            legs = list(job.legs)
+        print(f"⏹️ Cancelling job {job.job_id}: no subscribers left")
+        job.cancel()
+        for leg in legs:
+            self.release(leg.job_id, job.job_id)
+
+    def _prune(self):
+        """Drop finished jobs older than JOB_TTL_SECONDS. Caller holds the lock."""
+        cutoff = time.time() - JOB_TTL_SECONDS
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if not job.is_active and job.finished_at and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def _start_trip(self, job: GenerationJob):
+        """
+        Multi-city trip: submit every leg as its own job so they generate in parallel,
+        and stitch them when the last one finishes (no worker waits on the legs).
+        """
+        job.status = JOB_RUNNING
+        legs = [self.submit(leg_params, subscriber=job.job_id) for leg_params in trip_leg_params(job.params)]
+        pending = set(range(len(legs)))
+        with job.lock:
+            job.legs = legs
+
+        def leg_done(index):
+            with job.lock:
+                pending.discard(index)
+                last = not pending
+            if last:
+                self._finish_trip(job)
+
+        for index, leg in enumerate(legs):
+            leg.future.add_done_callback(lambda _, index=index: leg_done(index))
+
+    def _finish_trip(self, job: GenerationJob):
+        """Stitch the finished legs into the trip plan."""
+        try:
+            unfinished = [(index, leg) for index, leg in enumerate(job.legs, start=1) if leg.status != JOB_DONE]
+            if job.cancel_event.is_set():
+                job.status = JOB_CANCELLED
+            elif unfinished:
+                index, leg = unfinished[0]
+                job.error = f"Stop {index} ({leg.params['destination']}): {leg.error or leg.status}"
+                job.status = JOB_FAILED
+            else:
+                itinerary = stitch_trip_itinerary(job.params, [get_itinerary(leg.result) for leg in job.legs])
+                plan_md = itinerary_to_markdown(itinerary)
+                remember_itinerary(plan_md, itinerary)
+                if itinerary.airlines or itinerary.airline_notes:
+                    job.airline_info = airlines_to_markdown(itinerary.airlines, itinerary.airline_notes)
+                job.truncated = any(leg.truncated for leg in job.legs)
+                job.fallback = next((leg.fallback for leg in job.legs if leg.fallback), "")
+                job.result = intern_plan(plan_md)
+                job.status = JOB_DONE
+        except Exception as e:
+            print(f"✗ Job {job.job_id} failed: {e}")
+            job.error = str(e)
+            job.status = JOB_FAILED
+        finally:
+            job.finished_at = time.time()
+            job.future.set_result(None)
+
+    def _run(self, job: GenerationJob):
+        """Worker body: stream the completion into the job until done or cancelled."""
+        if job.cancel_event.is_set():
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+            return
+
+        job.status = JOB_RUNNING
+        params = job.params
+        try:
+            budget = estimate_token_budget(**params)
+            header = climate_header(params["destination"], params["start_date"], params["end_date"])
+            if header:
+                with job.lock:
+                    job.chunks.append(f"{header}\n\n")
+
+            try:
+                if PLAN_OUTPUT_FORMAT == PLAN_FORMAT_JSON:
+                    plan_md = self._run_json(job, budget)
+                else:
+                    self._stream(job, budget, job.chunks)
+                    plan_md = ""
+                    if not job.cancel_event.is_set():
+                        plan_md, job.airline_info = attach_airline_section(
+                            params["source_city"], params["destination"], job.partial_text, job.truncated
+                        )
+            except PlanDeadlineExceeded as e:
+                if job.cancel_event.is_set():
+                    raise
+                print(f"✗ Job {job.job_id}: {e}")
+                plan_md, job.airline_info, job.fallback = fallback_plan(
+                    params["source_city"], params["destination"], params["start_date"], params["end_date"], params["days"],
+                    params["interests"], params["guardrails"],
+                )
+
+            if job.cancel_event.is_set():
+                job.status = JOB_CANCELLED
+            else:
+                job.result = intern_plan(plan_md)
+                job.status = JOB_DONE
+                if not job.fallback and not job.truncated:
+                    remember_fallback_plan(
+                        params["destination"], params["days"], params["interests"], params["guardrails"], job.result
+                    )
+        except Exception as e:
+            if job.cancel_event.is_set():
+                job.status = JOB_CANCELLED
+            else:
+                print(f"✗ Job {job.job_id} failed: {e}")
+                job.error = str(e)
+                job.status = JOB_FAILED
+        finally:
+            with job.lock:
+                job.stream = None
+                # The streamed pieces are only needed while the job is running
+                job.chunks = []
+            job.finished_at = time.time()
+
+    def _stream(self, job: GenerationJob, budget: TokenBudget, sink: list):
+        """
+        Stream one completion's text into sink; records usage and truncation on the job.
+        A winner that stalls after sending text ends the plan early (truncated);
+        PlanDeadlineExceeded only propagates when no text arrived.
+        """
+        stream = stream_travel_plan(**job.params, budget=budget)
+        with job.lock:
+            job.stream = stream
+        # Cancellation may have raced the request being opened
+        if job.cancel_event.is_set():
+            stream.close()
+        finish_reason = ""
+        streamed = stalled = False
+        try:
+            for chunk in stream:
+                if job.cancel_event.is_set():
+                    break
+                if chunk.usage is not None:
+                    job.usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    streamed = True
+                    with job.lock:
+                        sink.append(delta)
+        except PlanDeadlineExceeded as e:
+            if not streamed:
+                raise
+            print(f"✗ Job {job.job_id}: {e}; keeping the partial plan")
+            stalled = True
+        get_token_usage_log().record(budget, job.params["days"], job.usage, finish_reason)
+        job.truncated = stalled or finish_reason == "length"
+
+    def _run_json(self, job: GenerationJob, budget: TokenBudget) -> str:
+        """
+        json mode: wait for the first routed completion that validates (only the
+        header is shown meanwhile), then render it.
+        """
+        params = job.params
+        request = get_model_router().request(plan_request(**params, budget=budget), expected_tokens=budget.completion_tokens)
+        with job.lock:
+            job.stream = request
+        if job.cancel_event.is_set():
+            request.close()
+        result = request.complete(
+            lambda text, finish_reason: finish_plan(
+                params["source_city"], params["destination"], params["start_date"], params["end_date"], text, finish_reason
+            )
+        )
+        if result is None:
+            return ""
+        (plan_md, job.airline_info), attempt = result
+        job.usage = attempt.usage
+        job.truncated = attempt.finish_reason == "length"
+        get_token_usage_log().record(budget, params["days"], job.usage, attempt.finish_reason)
+        return plan_md
+
+
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    """Shared job manager that survives script reruns and reconnects."""
+    return JobManager()
+
+
+def attach_job(job_id: str):
+    """Make a job the active one for this session and remember it in the URL."""
+    st.session_state.active_job_id = job_id
+    if job_id:
+        st.query_params["job"] = job_id
+    elif "job" in st.query_params:
+        del st.query_params["job"]
+
+
+def cancel_active_job():
+    """
+    Detach this session from its job. The job itself is only cancelled when no
+    other session or API client is waiting on it.
+    """
+    get_job_manager().release(st.session_state.active_job_id, st.session_state.client_id)
+    attach_job("")
+
+
+def stop_active_job():
+    """Cancel button: detach from the job and say so."""
+    cancel_active_job()
+    st.session_state.job_notice = ("warning", "⏹️ Generation cancelled.")
+
+# --------------------------------------------
+# ADMISSION CONTROL
+# --------------------------------------------
+
+# Token buckets per session and per client IP: (requests per minute, burst); a rate of 0 disables one
+GENERATE_SESSION_LIMIT = (float(os.getenv("GENERATE_RATE_PER_MINUTE", "4")), int(os.getenv("GENERATE_BURST", "3")))
+GENERATE_IP_LIMIT = (float(os.getenv("GENERATE_IP_RATE_PER_MINUTE", "12")), int(os.getenv("GENERATE_IP_BURST", "6")))
+PDF_SESSION_LIMIT = (float(os.getenv("PDF_RATE_PER_MINUTE", "12")), int(os.getenv("PDF_BURST", "4")))
+PDF_IP_LIMIT = (float(os.getenv("PDF_IP_RATE_PER_MINUTE", "40")), int(os.getenv("PDF_IP_BURST", "10")))
+RATE_LIMIT_CLIENTS = 10000  # buckets kept per limiter; the least recently seen clients are dropped
+
+# Global load shedding: past these, new work is refused with a retry hint instead of queueing
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", str(JOB_WORKERS * 4)))
+MAX_QUEUE_WAIT_SECONDS = float(os.getenv("MAX_QUEUE_WAIT_SECONDS", "20"))
+MAX_INFLIGHT_PDFS = int(os.getenv("MAX_INFLIGHT_PDFS", "4"))
+MAX_PDF_SECONDS = 15.0  # age of the oldest running PDF build
+SHED_RETRY_AFTER = 5.0
+
+# Behind a reverse proxy, take the client IP from X-Forwarded-For (only if the proxy sets it)
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "0") == "1"
+
+PDF_CACHE_ENTRIES = 256
+PDF_CACHE_MB = 64
+
+
+class TokenBucket:
+    """Refills rate tokens per second up to burst. Callers serialize access."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait_time(self, cost: float) -> float:
+        """Seconds until cost tokens are available (0.0 if they are now)."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def take(self, cost: float):
+        self.tokens -= cost
+
+
+@dataclass
+class Admission:
+    """Outcome of an admission check."""
+    admitted: bool
+    reason: str = ""
+    retry_after: float = 0.0  # seconds
+    shed: bool = False  # global overload (HTTP 503) rather than this client's rate limit (HTTP 429)
+
+    @property
+    def message(self) -> str:
+        return f"{self.reason} Please try again in {math.ceil(self.retry_after)} seconds."
+
+
+class AdmissionRejected(Exception):
+    """Raised by export_pdf() when a build is refused; carries the Admission with the retry hint."""
+
+    def __init__(self, admission: Admission):
+        super().__init__(admission.message)
+        self.admission = admission
+
+
+class InflightTracker:
+    """Counts running operations and how long the oldest has been running."""
+
+    def __init__(self):
+        self.started = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def track(self):
+        token = object()
+        with self.lock:
+            self.started[token] = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                del self.started[token]
+
+    def load(self):
+        """(running operations, seconds the oldest has been running)."""
+        now = time.monotonic()
+        with self.lock:
+            starts = list(self.started.values())
+        return len(starts), now - min(starts, default=now)
+
+
+class AdmissionController:
+    """
+    Token-bucket limits per session and per IP in front of one kind of work,
+    plus a global overload check that sheds new requests before they queue.
+    """
+
+    def __init__(self, name: str, session_limit, ip_limit, overloaded):
+        self.name = name
+        self.limits = {"session": session_limit, "ip": ip_limit}
+        self.buckets = {kind: BoundedCache(f"{name}_{kind}_buckets", RATE_LIMIT_CLIENTS) for kind in self.limits}
+        self.overloaded = overloaded  # () -> reason to shed, or ""
+        self.admitted = 0
+        self.limited = 0
+        self.shed = 0
+        self.lock = threading.Lock()
+
+    def admit(self, session_id: str = "", ip: str = "", cost: int = 1) -> Admission:
+        """Charge cost tokens to the session and IP buckets if both have them and the service is not overloaded."""
+        reason = self.overloaded()
+        if reason:
+            with self.lock:
+                self.shed += 1
+            return Admission(False, reason, SHED_RETRY_AFTER, shed=True)
+
+        with self.lock:
+            charges = []
+            for kind, key in (("session", session_id), ("ip", ip)):
+                rate, burst = self.limits[kind]
+                if not key or rate <= 0:
+                    continue
+                bucket = self.buckets[kind].get(key)
+                if bucket is None:
+                    bucket = self.buckets[kind].put(key, TokenBucket(rate / 60, burst))
+                charges.append((bucket, min(cost, bucket.burst)))
+            wait = max((bucket.wait_time(charge) for bucket, charge in charges), default=0.0)
+            if wait:
+                self.limited += 1
+                return Admission(False, "You're sending requests faster than we can serve them.", wait)
+            for bucket, charge in charges:
+                bucket.take(charge)
+            self.admitted += 1
+        return Admission(True)
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "name": self.name,
+                "admitted": self.admitted,
+                "limited": self.limited,
+                "shed": self.shed,
+                "clients": sum(len(cache.entries) for cache in self.buckets.values()),
+            }
+
+
+def generation_overload() -> str:
+    """Reason to shed new plan requests, or "" while the job queue keeps up."""
+    queued, oldest_wait = get_job_manager().backlog()
+    if queued >= MAX_QUEUED_JOBS or oldest_wait > MAX_QUEUE_WAIT_SECONDS:
+        return "The planner is very busy right now."
+    return ""
+
+
+def pdf_overload() -> str:
+    """Reason to shed new PDF builds, or "" while exports keep up."""
+    inflight, oldest = get_pdf_builds().load()
+    if inflight >= MAX_INFLIGHT_PDFS or oldest > MAX_PDF_SECONDS:
+        return "PDF export is very busy right now."
+    return ""
+
+
+@st.cache_resource
+def get_generation_admission() -> AdmissionController:
+    """Admission control for new itinerary generations, shared by the UI and API."""
+    return AdmissionController("generate", GENERATE_SESSION_LIMIT, GENERATE_IP_LIMIT, generation_overload)
+
+
+@st.cache_resource
+def get_pdf_admission() -> AdmissionController:
+    """Admission control for PDF builds, shared by the UI and API."""
+    return AdmissionController("pdf", PDF_SESSION_LIMIT, PDF_IP_LIMIT, pdf_overload)
+
+
+@st.cache_resource
+def get_pdf_builds() -> InflightTracker:
+    """PDF builds currently running in this process."""
+    return InflightTracker()
+
+
+def admit_generation(params: dict, session_id: str = "", ip: str = "") -> Admission:
+    """
+    Admission for a plan request. Requests that reuse an identical running or
+    finished job are free; multi-city trips cost one token per leg.
+    """
+    if get_job_manager().find(params) is not None:
+        return Admission(True)
+    return get_generation_admission().admit(session_id, ip, cost=max(len(params.get("legs") or ()), 1))
+
+
+def admission_report() -> dict:
+    """Admission counters and the load signals behind load shedding."""
+    queued, oldest_wait = get_job_manager().backlog()
+    inflight, oldest_pdf = get_pdf_builds().load()
+    return {
+        "controllers": [get_generation_admission().report(), get_pdf_admission().report()],
+        "queued_jobs": queued,
+        "oldest_queue_wait": round(oldest_wait, 2),
+        "inflight_pdfs": inflight,
+        "oldest_pdf_seconds": round(oldest_pdf, 2),
+    }
+
+
+def session_client():
+    """(session id, client IP) that rate limits apply to for this Streamlit session."""
+    ip = st.context.ip_address or ""
+    if TRUST_FORWARDED_FOR:
+        ip = (st.context.headers.get("X-Forwarded-For") or ip).split(",")[0].strip()
+    return st.session_state.client_id, ip
+
+
+@st.cache_resource
+def get_pdf_cache() -> BoundedCache:
+    """Built PDFs by plan and trip, so reruns and repeat downloads never rebuild them."""
+    return BoundedCache("pdf_exports", PDF_CACHE_ENTRIES, max_bytes=PDF_CACHE_MB * 1024 * 1024, sizeof=len)
+
+
+def export_pdf(plan_md: str, destination: str, source_city: str, start_date, end_date, days: int,
+               fetch_images: bool = True, admit=None) -> bytes:
+    """
+    PDF bytes for a plan, built at most once per process (shared, size-bounded cache).
+    admit() -> Admission runs only when the PDF has to be built; a refusal raises AdmissionRejected.
+    """
+    key = plan_digest("\n".join(map(str, (plan_md, destination, source_city, start_date, end_date, days, fetch_images))))
+    cache = get_pdf_cache()
+    data = cache.get(key)
+    if data is not None:
+        return data
+    if admit is not None:
+        admission = admit()
+        if not admission.admitted:
+            raise AdmissionRejected(admission)
+    with get_pdf_builds().track():
+        buffer = generate_pdf(
+            plan_md, destination, source_city, start_date, end_date, days, fetch_images=fetch_images, output=io.BytesIO()
+        )
+    return cache.put(key, buffer.getvalue())
 
 # --------------------------------------------
 # PDF GENERATION
 # --------------------------------------------
 
 
-def generate_pdf(plan_md: str, destination: str, source_city: str, start_date, end_date, days: int) -> str:
-    """Generate beautifully formatted PDF from markdown plan with multiple destination images."""
-    filename = f"travel_plan_{destination.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+def pdf_markup(text: str) -> str:
+    """Inline Markdown (bold, italic) as ReportLab paragraph markup, with the rest escaped."""
+    text = html.escape(text, quote=False)
+    text = _BOLD_RE.sub(r"<b>\1</b>", text)
+    return _ITALIC_RE.sub(r"<i>\1</i>", text)
+
+
+def pdf_file_stem(destination: str) -> str:
+    """Filesystem- and header-safe name part for a destination ("Paris → Rome" -> "Paris_Rome")."""
+    return re.sub(r"[^\w-]+", "_", destination).strip("_") or "trip"
+
+
+def generate_pdf(plan_md: str, destination: str, source_city: str, start_date, end_date, days: int, fetch_images: bool = True, output=None, itinerary=None):
+    """
+    Generate beautifully formatted PDF from markdown plan with multiple destination images.
+    Pass fetch_images=False to skip downloading watermark images (offline/load tests).
+    Pass a file-like output (e.g. io.BytesIO) to build in memory; otherwise the PDF is
+    written to the working directory and its filename is returned.
+    The content comes from the plan's Itinerary (parsed once and cached, or passed in).
+    """
+    filename = f"travel_plan_{pdf_file_stem(destination)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
 
     doc = SimpleDocTemplate(
-        filename,
+        output if output is not None else filename,
         pagesize=LETTER,
         rightMargin=0.75 * inch,
         leftMargin=0.75 * inch,
@@ -569,9 +3218,22 @@ def generate_pdf(plan_md: str, destination: str, source_city: str, start_date, e
         bottomMargin=0.9 * inch,
     )
 
+    itinerary = itinerary or get_itinerary(plan_md)
+    # Multi-city trips tag each day with its stop; each stop gets its own watermark
+    places = [day_place(day.title) for day in itinerary.days]
+    leg_state = None
+    if len(set(places)) > 1 and all(places):
+        leg_state = {"images": {}, "place": places[0]}
+        if fetch_images:
+            leg_state["images"] = get_leg_watermark_images(list(dict.fromkeys(places)))
+
     # Get multiple destination images for variety
-    print(f"Fetching images for {destination}...")
-    destination_images = get_multiple_images_for_destination(destination, count=3)
+    destination_images = None
+    if leg_state is not None:
+        destination_images = leg_state["images"].get(places[0])
+    elif fetch_images:
+        print(f"Fetching images for {destination}...")
+        destination_images = get_multiple_images_for_destination(destination, count=3)
     if destination_images:
         print(f"Successfully loaded {len(destination_images)} images for PDF watermarks")
     else:
@@ -666,171 +3328,377 @@ def generate_pdf(plan_md: str, destination: str, source_city: str, start_date, e
     story.append(Spacer(1, 0.1 * inch))
     story.append(Paragraph(f"{source_city} → {destination}", styles["CustomTitle"]))
     story.append(Spacer(1, 0.3 * inch))
-    
-    # Extract and display temperature info from the markdown if present
-    temp_info_lines = []
-    other_content_lines = []
-    capturing_temp = True
-    
-    for line in plan_md.split("\n"):
-        if line.strip().startswith("**Travel Dates:**") or \
-           line.strip().startswith("**Expected Temperature:**") or \
-           line.strip().startswith("**Weather:**") or \
-           line.strip().startswith("**What to Wear:**"):
-            temp_info_lines.append(line.strip())
-        elif line.strip().startswith("##"):
-            capturing_temp = False
-            other_content_lines.append(line)
-        elif not capturing_temp or (line.strip() and not line.strip().startswith("**")):
-            capturing_temp = False
-            other_content_lines.append(line)
-    
+
+    def bullets(items):
+        return ListFlowable(
+            [ListItem(Paragraph(pdf_markup(item), styles["CustomBody"])) for item in items],
+            bulletType="bullet",
+            leftIndent=20,
+            bulletFontSize=10,
+        )
+
+    def paragraphs(texts):
+        return [Paragraph(pdf_markup(text), styles["CustomBody"]) for text in texts]
+
     # Display temperature and weather info on title page
-    if temp_info_lines:
-        for info_line in temp_info_lines:
-            story.append(Paragraph(info_line, styles["CustomSubtitle"]))
+    header_fields = itinerary.header.fields()
+    if header_fields:
+        for label, value in header_fields:
+            story.append(Paragraph(f"<b>{html.escape(label)}:</b> {pdf_markup(value)}", styles["CustomSubtitle"]))
     else:
         # Fallback if AI didn't include it
         date_range = f"{start_date.strftime('%B %d, %Y')} - {end_date.strftime('%B %d, %Y')}"
-        story.append(Paragraph(f"**Travel Dates:** {date_range}", styles["CustomSubtitle"]))
-        story.append(Paragraph(f"**Duration:** {days} day{'s' if days != 1 else ''}", styles["CustomSubtitle"]))
+        story.append(Paragraph(f"<b>Travel Dates:</b> {date_range}", styles["CustomSubtitle"]))
+        story.append(Paragraph(f"<b>Duration:</b> {days} day{'s' if days != 1 else ''}", styles["CustomSubtitle"]))
     
     story.append(Spacer(1, 0.4 * inch))
     
     # Divider line
     story.append(Spacer(1, 12))
-
-    buffer_list_items = []
-    in_airline_section = False
-    skip_temp_info = True  # Skip temperature info lines since we already displayed them
-
-    # Use filtered content that excludes already-displayed temp info
-    content_to_process = "\n".join(other_content_lines) if temp_info_lines else plan_md
-
-    for line in content_to_process.split("\n"):
-        line_stripped = line.strip()
-        
-        # Skip the temperature/weather/clothing info lines if they appear in content
-        if line_stripped.startswith("**Travel Dates:**") or \
-           line_stripped.startswith("**Expected Temperature:**") or \
-           line_stripped.startswith("**Weather:**") or \
-           line_stripped.startswith("**What to Wear:**"):
-            continue
-        
-        # Check if we're entering airline section
-        if "✈️" in line_stripped or "airline" in line_stripped.lower():
-            in_airline_section = True
-        
-        if line.startswith("##"):
-            # Flush any buffered list items
-            if buffer_list_items:
-                story.append(
-                    ListFlowable(
-                        buffer_list_items,
-                        bulletType="bullet",
-                        leftIndent=20,
-                        bulletFontSize=10,
-                    )
-                )
-                buffer_list_items = []
-            
-            story.append(Spacer(1, 8))
-            header_text = line.replace("##", "").strip()
-            
-            # Use different style for airline section
-            if in_airline_section:
-                story.append(Paragraph(header_text, styles["AirlineHeader"]))
-            else:
-                story.append(Paragraph(header_text, styles["DayHeader"]))
-                
-        elif line_stripped.startswith("**") and line_stripped.endswith("**"):
+    story.extend(paragraphs(itinerary.intro))
+
+    for index, day in enumerate(itinerary.days):
+        if leg_state is not None and index and places[index] != places[index - 1]:
+            # Each stop starts on a new page under its own watermark
+            story.append(LegWatermark(leg_state, places[index]))
+            story.append(PageBreak())
+        story.append(Spacer(1, 8))
+        story.append(Paragraph(pdf_markup(day.title), styles["DayHeader"]))
+        story.extend(paragraphs(day.notes))
+        for slot in day.slots:
             # Section headers like "Morning:", "Afternoon:", etc.
-            if buffer_list_items:
-                story.append(
-                    ListFlowable(
-                        buffer_list_items,
-                        bulletType="bullet",
-                        leftIndent=20,
-                        bulletFontSize=10,
-                    )
-                )
-                buffer_list_items = []
-            story.append(Paragraph(line_stripped, styles["SectionHeader"]))
-            
-        elif line_stripped.startswith("-"):
-            # List items
-            buffer_list_items.append(
-                ListItem(Paragraph(line_stripped[1:].strip(), styles["CustomBody"]))
-            )
-        elif line_stripped:
-            # Regular paragraphs
-            if buffer_list_items:
-                story.append(
-                    ListFlowable(
-                        buffer_list_items,
-                        bulletType="bullet",
-                        leftIndent=20,
-                        bulletFontSize=10,
-                    )
-                )
-                buffer_list_items = []
-            story.append(Paragraph(line_stripped, styles["CustomBody"]))
-
-    # Flush any remaining list items
-    if buffer_list_items:
-        story.append(
-            ListFlowable(
-                buffer_list_items,
-                bulletType="bullet",
-                leftIndent=20,
-                bulletFontSize=10,
-            )
-        )
+            story.append(Paragraph(f"{pdf_markup(slot.name)}:", styles["SectionHeader"]))
+            if slot.activities:
+                story.append(bullets(slot.activities))
+            story.extend(paragraphs(slot.notes))
+
+    if itinerary.airlines or itinerary.airline_notes:
+        story.append(Spacer(1, 8))
+        story.append(Paragraph(pdf_markup(AIRLINE_SECTION_TITLE[3:]), styles["AirlineHeader"]))
+        for airline in itinerary.airlines:
+            story.append(Paragraph(pdf_markup(airline.name), styles["SectionHeader"]))
+            if airline.reasons:
+                story.append(bullets(airline.reasons))
+        story.extend(paragraphs(itinerary.airline_notes))
 
     # Build PDF with rotating watermarks
-    # Use a list to track page numbers (mutable container for closure)
-    page_counter = [0]
-    on_page_fn = make_pdf_page_with_watermark(destination_images, page_counter)
+    on_page_fn = make_pdf_page_with_watermark(destination_images, leg_state)
     doc.build(story, onFirstPage=on_page_fn, onLaterPages=on_page_fn)
     
-    return filename
+    return output if output is not None else filename
+
+# --------------------------------------------
+# PLAN RENDERING
+# --------------------------------------------
+
+RENDER_CACHE_ENTRIES = 256
+
+_CODE_RE = re.compile(r"`([^`]+)`")
+_LINK_RE = re.compile(r"\[([^\]]+)\]\((https?://[^\s)]+)\)")
+_ORDERED_RE = re.compile(r"^\d+[.)]\s+(.*)$")
+
+
+def inline_markdown_to_html(text: str) -> str:
+    """Escape text, then apply bold/italic/code/link markup. Only http(s) links are kept."""
+    text = html.escape(text, quote=True)
+    text = _CODE_RE.sub(r"<code>\1</code>", text)
+    text = _LINK_RE.sub(r'<a href="\2" target="_blank" rel="noopener noreferrer">\1</a>', text)
+    text = _BOLD_RE.sub(r"<strong>\1</strong>", text)
+    text = _ITALIC_RE.sub(r"<em>\1</em>", text)
+    return text
+
+
+def markdown_to_html(md: str) -> str:
+    """
+    Convert itinerary Markdown to sanitized HTML.
+    Covers what the planner emits: headers, bold/italic, bullet and numbered lists,
+    links, rules and paragraphs. All source text is HTML-escaped.
+    """
+    out = []
+    list_tag = None
+
+    def close_list():
+        nonlocal list_tag
+        if list_tag:
+            out.append(f"</{list_tag}>")
+            list_tag = None
+
+    for line in md.split("\n"):
+        stripped = line.strip()
+        if not stripped:
+            close_list()
+            continue
+
+        header = _HEADER_RE.match(stripped)
+        ordered = _ORDERED_RE.match(stripped)
+        if header:
+            close_list()
+            level = len(header.group(1))
+            out.append(f"<h{level}>{inline_markdown_to_html(header.group(2))}</h{level}>")
+        elif stripped in ("---", "***", "___"):
+            close_list()
+            out.append("<hr>")
+        elif stripped.startswith(("- ", "* ", "+ ")):
+            if list_tag != "ul":
+                close_list()
+                out.append("<ul>")
+                list_tag = "ul"
+            out.append(f"<li>{inline_markdown_to_html(stripped[2:].strip())}</li>")
+        elif ordered:
+            if list_tag != "ol":
+                close_list()
+                out.append("<ol>")
+                list_tag = "ol"
+            out.append(f"<li>{inline_markdown_to_html(ordered.group(1))}</li>")
+        else:
+            close_list()
+            out.append(f"<p>{inline_markdown_to_html(stripped)}</p>")
+
+    close_list()
+    return "\n".join(out)
+
+
+def plan_digest(plan_md: str) -> str:
+    """Content hash identifying a plan."""
+    return hashlib.sha256(plan_md.encode("utf-8")).hexdigest()
+
+
+def plan_sections(itinerary: Itinerary):
+    """A plan's intro Markdown (header fields) and its sections as (title, Markdown body) pairs."""
+    intro = "\n\n".join(filter(None, [header_to_markdown(itinerary.header)] + itinerary.intro))
+    sections = [(day.title, day_body_markdown(day)) for day in itinerary.days]
+    if itinerary.airlines or itinerary.airline_notes:
+        sections.append((
+            AIRLINE_SECTION_TITLE[3:],
+            airlines_body_markdown(itinerary.airlines, itinerary.airline_notes),
+        ))
+    return intro, sections
+
+
+@st.cache_resource(max_entries=RENDER_CACHE_ENTRIES, show_spinner=False)
+def render_plan_fragments(plan_hash: str, _plan_md: str) -> dict:
+    """
+    Render a plan to HTML fragments once, keyed by plan hash and shared across sessions.
+    Returns {"hash", "intro", "sections": [(title, html), ...]}.
+    """
+    intro, sections = plan_sections(get_itinerary(_plan_md))
+    return {
+        "hash": plan_hash,
+        "intro": markdown_to_html(intro),
+        "sections": [(title, markdown_to_html(body)) for title, body in sections],
+    }
+
+
+def get_rendered_plan(plan_md: str) -> dict:
+    """Cached HTML fragments for a plan."""
+    return render_plan_fragments(plan_digest(plan_md), plan_md)
+
+
+@st.fragment
+def render_plan_section(key: str, title: str, body_html: str, expanded: bool = False):
+    """
+    Collapsible plan section. Its HTML is only sent while open, and toggling it
+    reruns just this fragment rather than the whole page.
+    """
+    if st.toggle(title, value=expanded, key=f"plan_section_{key}"):
+        st.html(body_html)
 
 # --------------------------------------------
 # UI
 # --------------------------------------------
 
-# Update background if destination changed
-current_dest = st.session_state.destination or ""
-if current_dest != st.session_state.last_bg_destination:
-    set_destination_background(current_dest)
-    st.session_state.last_bg_destination = current_dest
-else:
-    # Show generic travel background on initial load
-    set_destination_background("")
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def render_active_job():
+    """Show live progress for the attached job and deliver its plan when finished."""
+    job = get_job_manager().get(st.session_state.active_job_id)
+    if job is None:
+        attach_job("")
+        st.rerun()
+
+    params = job.params
+    if job.is_active:
+        st.info(f"🗺️ Creating your personalized {params['days']}-day itinerary from {params['source_city']} to {params['destination']}...")
+        if job.legs:
+            st.caption(" · ".join(
+                f"{'✅' if leg.status == JOB_DONE else '⏳' if leg.is_active else '⚠️'} {leg.params['destination']}" for leg in job.legs
+            ))
+        partial = job.partial_text
+        if partial:
+            st.markdown(partial)
+        st.button("⏹️ Cancel", on_click=stop_active_job, key=f"cancel_{job.job_id}")
+        return
+
+    # Deliver the outcome into session state; it is shown after the full rerun
+    attach_job("")
+    if job.status == JOB_DONE:
+        st.session_state.plan_md = intern_plan(job.result)
+        st.session_state.airline_info = job.airline_info
+        if job.fallback:
+            source = "a recent plan for the same trip and preferences" if job.fallback == "cached" else "a general template"
+            st.session_state.job_notice = (
+                "warning",
+                f"⏳ The planner took too long, so this itinerary is based on {source}. Generate again for a personalized plan.",
+            )
+        elif job.truncated:
+            st.session_state.job_notice = ("warning", "⚠️ The itinerary was cut short (length limit or a stalled model) and may end early.")
+        else:
+            st.session_state.job_notice = ("success", f"✅ Your {params['source_city']} → {params['destination']} itinerary is ready!")
+    elif job.status == JOB_FAILED:
+        st.session_state.job_notice = ("error", f"❌ Error generating plan: {job.error}")
+    elif job.status == JOB_CANCELLED:
+        st.session_state.job_notice = ("warning", "⏹️ Generation cancelled.")
+    st.rerun()
 
-st.title("🌍 AI Travel Guide")
-st.caption("Personalized itineraries with stunning destination backgrounds")
 
-with st.expander("ℹ️ How it works"):
-    st.markdown(
-        """
-        1. **Enter your destination** - The background will automatically change to match
-        2. **Set your preferences** - Number of days, interests, and any restrictions
-        3. **Generate your plan** - Get a detailed day-by-day itinerary
-        4. **Download as PDF** - Save your itinerary with a beautiful layout
-        
-        Try destinations like: Paris, Tokyo, New York, Karachi, Athens, London, Rome, Dubai, Barcelona, Sydney
-        """
+def draft_trip_legs(destinations, start_date, end_date):
+    """
+    Per-stop dates to offer for a route: the session's legs while the route and
+    trip dates are unchanged, otherwise an even split. Returns (legs, error message or "").
+    """
+    if not start_date or not end_date or end_date < start_date:
+        return [], "Please select valid travel dates (end date must be on or after start date)."
+    if trip_days(start_date, end_date) < len(destinations):
+        return [], f"Please allow at least one day for each of the {len(destinations)} stops."
+    previous = parse_legs(st.session_state.legs)
+    if (
+        [leg.destination for leg in previous] == destinations
+        and (st.session_state.start_date, st.session_state.end_date) == (start_date, end_date)
+    ):
+        return previous, ""
+    return even_legs(destinations, start_date, end_date), ""
+
+
+def form_trip_legs(destination_input, start_date_input, end_date_input, legs_input):
+    """
+    Stops of a multi-city trip entered in the form, or [] for a single destination.
+    Uses the per-stop editor's dates when it was shown. Returns (legs, error message or "").
+    """
+    destinations = split_destinations(destination_input)
+    if len(destinations) < 2:
+        return [], ""
+    legs, error = draft_trip_legs(destinations, start_date_input, end_date_input)
+    if error or legs_input is None:
+        return legs, error
+
+    def editor_date(value):
+        return None if pd.isna(value) else pd.Timestamp(value).date()
+
+    return [
+        TripLeg(row.destination, editor_date(row.start_date), editor_date(row.end_date))
+        for row in legs_input.itertuples()
+    ], ""
+
+
+def render_plan(plan_md, source_city, destination, start_date, end_date, days):
+    """Render a finished itinerary in the current container."""
+    st.markdown("---")
+    st.subheader(f"✈️ {source_city} → {destination}")
+    st.caption(f"🗓️ {start_date.strftime('%B %d, %Y')} - {end_date.strftime('%B %d, %Y')} ({days} days)")
+    rendered = get_rendered_plan(plan_md)
+    if rendered["intro"]:
+        st.html(rendered["intro"])
+    for index, (title, body_html) in enumerate(rendered["sections"]):
+        render_plan_section(f"{rendered['hash'][:16]}_{index}", title, body_html, expanded=index == 0)
+
+
+def render_pdf_download():
+    """PDF download button for the session's plan; the PDF is built once and shared across reruns."""
+    pdf_admission = get_pdf_admission()
+    try:
+        pdf_bytes = export_pdf(
+            st.session_state.plan_md,
+            st.session_state.destination,
+            st.session_state.source_city,
+            st.session_state.start_date,
+            st.session_state.end_date,
+            st.session_state.days,
+            admit=lambda: pdf_admission.admit(*session_client()),
+        )
+    except AdmissionRejected as e:
+        st.warning(f"⏳ {e.admission.message}")
+        st.button("🔁 Retry PDF", use_container_width=True)
+        return
+    except Exception as e:
+        st.error(f"Error generating PDF: {str(e)}")
+        return
+    st.download_button(
+        "📄 Download PDF",
+        pdf_bytes,
+        file_name=f"travel_plan_{pdf_file_stem(st.session_state.destination)}.pdf",
+        mime="application/pdf",
+        use_container_width=True,
+    )
+
+
+def main():
+    """Streamlit entry point."""
+    st.set_page_config(
+        page_title="Travel Guide",
+        page_icon="🌍",
+        layout="wide",
     )
 
-# Two-column layout
-left_col, right_col = st.columns([1, 2])
+    try:
+        router = get_model_router()
+        for route in router.routes:
+            router.client(route)
+    except (RuntimeError, ValueError) as e:
+        st.error(str(e))
+        st.stop()
+
+    init_session_state()
+
+    # Reattach to a background job after a reconnect (job id is kept in the URL)
+    if not st.session_state.active_job_id and "job" in st.query_params:
+        reattached = get_job_manager().get(st.query_params["job"])
+        if reattached is not None:
+            st.session_state.active_job_id = reattached.job_id
+            # The reloaded page is a new session (the old one never released its subscription)
+            get_job_manager().subscribe(reattached.job_id, st.session_state.client_id)
+            for key in ("source_city", "destination", "start_date", "end_date", "days", "interests", "guardrails"):
+                st.session_state[key] = reattached.params[key]
+            st.session_state.legs = reattached.params.get("legs", [])
+        else:
+            del st.query_params["job"]
+
+    # Update background if destination changed
+    current_dest = st.session_state.destination or ""
+    if current_dest != st.session_state.last_bg_destination:
+        set_destination_background(current_dest)
+        st.session_state.last_bg_destination = current_dest
+    else:
+        # Show generic travel background on initial load
+        set_destination_background("")
+
+    st.title("🌍 AI Travel Guide")
+    st.caption("Personalized itineraries with stunning destination backgrounds")
+
+    with st.expander("ℹ️ How it works"):
+        st.markdown(
+            """
+            1. **Enter your destination** - The background will automatically change to match
+            2. **Set your preferences** - Number of days, interests, and any restrictions
+            3. **Generate your plan** - Get a detailed day-by-day itinerary
+            4. **Download as PDF** - Save your itinerary with a beautiful layout
+
+            Try destinations like: Paris, Tokyo, New York, Karachi, Athens, London, Rome, Dubai, Barcelona, Sydney
+            """
+        )
+
+    # Operator view: add ?debug=1 to the URL
+    if st.query_params.get("debug"):
+        with st.expander("🧠 Memory report"):
+            st.json(memory_report())
+        with st.expander("🚦 Admission control"):
+            st.json(admission_report())
 
-with left_col:
-    st.subheader("📝 Plan Your Trip")
+    # Two-column layout
+    left_col, right_col = st.columns([1, 2])
 
-    with st.form("travel_form"):
-        # Source and Destination in same row
+    with left_col:
+        st.subheader("📝 Plan Your Trip")
+
+        # Route and dates sit outside the form so the per-stop editor follows them as they change
         col_cities1, col_cities2 = st.columns(2)
         with col_cities1:
             source_city_input = st.text_input(
@@ -839,15 +3707,15 @@ with left_col:
                 placeholder="e.g., Dallas, New York, London...",
                 help="Where are you traveling from?"
             )
-        
+
         with col_cities2:
             destination_input = st.text_input(
                 "🛬 To (Destination)",
                 value=st.session_state.destination,
                 placeholder="e.g., Paris, Tokyo, Karachi...",
-                help="Where do you want to go?"
+                help="Where do you want to go? For a multi-city trip list the stops in order: Paris → Rome → Athens"
             )
-        
+
         # Date inputs
         col_date1, col_date2 = st.columns(2)
         with col_date1:
@@ -857,7 +3725,7 @@ with left_col:
                 min_value=datetime.now().date(),
                 help="When does your trip start?"
             )
-        
+
         with col_date2:
             end_date_input = st.date_input(
                 "📅 End Date",
@@ -865,10 +3733,10 @@ with left_col:
                 min_value=datetime.now().date(),
                 help="When does your trip end?"
             )
-        
+
         # Calculate days automatically - ALWAYS show this
         if start_date_input and end_date_input and end_date_input >= start_date_input:
-            calculated_days = (end_date_input - start_date_input).days + 1
+            calculated_days = trip_days(start_date_input, end_date_input)
             st.success(f"📊 Trip duration: **{calculated_days} day{'s' if calculated_days != 1 else ''}**")
         elif start_date_input and end_date_input:
             st.error("⚠️ End date must be on or after start date")
@@ -876,90 +3744,123 @@ with left_col:
         else:
             calculated_days = 3
 
-        interests_input = st.text_input(
-            "❤️ Special Interests",
-            value=st.session_state.interests,
-            placeholder="e.g., Museums, Food, Nature, Nightlife...",
-            help="What are you most interested in experiencing?"
-        )
+        with st.form("travel_form"):
+            # Per-stop dates as soon as the destination is a route (split evenly until edited)
+            legs_input = None
+            destinations = split_destinations(destination_input)
+            if len(destinations) > 1:
+                draft_legs, draft_error = draft_trip_legs(destinations, start_date_input, end_date_input)
+                with st.expander("🗺️ Dates per stop", expanded=True):
+                    if draft_error:
+                        st.caption(f"⚠️ {draft_error}")
+                    else:
+                        legs_input = st.data_editor(
+                            pd.DataFrame([leg.to_dict() for leg in draft_legs]),
+                            column_config={
+                                "destination": st.column_config.TextColumn("Stop", disabled=True),
+                                "start_date": st.column_config.DateColumn("First day"),
+                                "end_date": st.column_config.DateColumn("Last day"),
+                            },
+                            hide_index=True,
+                            use_container_width=True,
+                            # A new route or new trip dates start a fresh editor
+                            key=f"legs_editor_{job_fingerprint([leg.to_dict() for leg in draft_legs])[:12]}",
+                        )
+
+            interests_input = st.text_input(
+                "❤️ Special Interests",
+                value=st.session_state.interests,
+                placeholder="e.g., Museums, Food, Nature, Nightlife...",
+                help="What are you most interested in experiencing?"
+            )
 
-        guardrails_input = st.text_input(
-            "⚠️ Restrictions/Guardrails",
-            value=st.session_state.guardrails,
-            placeholder="e.g., Family-friendly, No walking tours, Budget-conscious...",
-            help="Any restrictions or preferences to consider?"
-        )
+            guardrails_input = st.text_input(
+                "⚠️ Restrictions/Guardrails",
+                value=st.session_state.guardrails,
+                placeholder="e.g., Family-friendly, No walking tours, Budget-conscious...",
+                help="Any restrictions or preferences to consider?"
+            )
 
-        submitted = st.form_submit_button("✨ Generate Travel Plan", use_container_width=True)
+            submitted = st.form_submit_button("✨ Generate Travel Plan", use_container_width=True)
+
+    with right_col:
+        notice = st.session_state.pop("job_notice", None)
+        if notice:
+            kind, message = notice
+            getattr(st, kind)(message)
+
+        if submitted:
+            legs, input_error = form_trip_legs(destination_input, start_date_input, end_date_input, legs_input)
+            if not legs and not input_error:
+                input_error = validate_trip_inputs(source_city_input, destination_input, start_date_input, end_date_input)
+            elif legs and not input_error:
+                input_error = validate_legs(source_city_input, legs)
+            if input_error:
+                st.error(f"⚠️ {input_error}")
+            else:
+                if legs:
+                    plan_params = trip_params(source_city_input, legs, interests_input, guardrails_input)
+                else:
+                    plan_params = {
+                        "source_city": source_city_input,
+                        "destination": destination_input,
+                        "start_date": start_date_input,
+                        "end_date": end_date_input,
+                        "days": calculated_days,
+                        "interests": interests_input,
+                        "guardrails": guardrails_input,
+                    }
+
+                admission = admit_generation(plan_params, *session_client())
+                if not admission.admitted:
+                    # Refuse fast and leave the current plan untouched
+                    st.warning(f"⏳ {admission.message}")
+                else:
+                    # Update session state
+                    for key in ("source_city", "destination", "start_date", "end_date", "days", "interests", "guardrails"):
+                        st.session_state[key] = plan_params[key]
+                    st.session_state.legs = plan_params.get("legs", [])
+
+                    # Update background immediately
+                    set_destination_background(plan_params["destination"])
+                    st.session_state.last_bg_destination = plan_params["destination"]
+
+                    for request_params in trip_leg_params(plan_params) if legs else [plan_params]:
+                        budget = estimate_token_budget(**request_params)
+                        if budget.warning:
+                            st.warning(f"⚠️ {request_params['destination']}: {budget.warning}" if legs else f"⚠️ {budget.warning}")
+                            break
+
+                    # Run generation in the background so reruns/disconnects don't lose the result
+                    job = get_job_manager().submit(plan_params, subscriber=st.session_state.client_id)
+                    previous_job_id = st.session_state.active_job_id
+                    if previous_job_id and previous_job_id != job.job_id:
+                        get_job_manager().release(previous_job_id, st.session_state.client_id)
+                    attach_job(job.job_id)
+
+        if st.session_state.active_job_id:
+            render_active_job()
+
+        if st.session_state.plan_md and not st.session_state.active_job_id:
+            render_plan(
+                st.session_state.plan_md,
+                st.session_state.source_city,
+                st.session_state.destination,
+                st.session_state.start_date,
+                st.session_state.end_date,
+                st.session_state.days,
+            )
+
+            st.markdown("---")
+            col1, col2 = st.columns(2)
+
+            with col1:
+                render_pdf_download()
+
+            with col2:
+                if st.button("🔄 Start Over", use_container_width=True):
+                    reset_form()
 
-with right_col:
-    if submitted:
-        if not source_city_input.strip():
-            st.error("⚠️ Please enter your source city.")
-        elif not destination_input.strip():
-            st.error("⚠️ Please enter a destination.")
-        elif calculated_days < 1:
-            st.error("⚠️ Please select valid travel dates (end date must be after start date).")
-        else:
-            # Update session state
-            st.session_state.source_city = source_city_input
-            st.session_state.destination = destination_input
-            st.session_state.start_date = start_date_input
-            st.session_state.end_date = end_date_input
-            st.session_state.days = calculated_days
-            st.session_state.interests = interests_input
-            st.session_state.guardrails = guardrails_input
-            
-            # Update background immediately
-            set_destination_background(destination_input)
-            st.session_state.last_bg_destination = destination_input
-
-            with st.spinner(f"🗺️ Creating your personalized {calculated_days}-day itinerary from {source_city_input} to {destination_input}..."):
-                try:
-                    plan = generate_travel_plan(
-                        source_city_input,
-                        destination_input,
-                        start_date_input,
-                        end_date_input,
-                        calculated_days,
-                        interests_input,
-                        guardrails_input,
-                    )
-                    st.session_state.plan_md = plan
-                    st.success(f"✅ Your {source_city_input} → {destination_input} itinerary is ready!")
-                except Exception as e:
-                    st.error(f"❌ Error generating plan: {str(e)}")
-
-    if st.session_state.plan_md:
-        st.markdown("---")
-        st.subheader(f"✈️ {st.session_state.source_city} → {st.session_state.destination}")
-        st.caption(f"🗓️ {st.session_state.start_date.strftime('%B %d, %Y')} - {st.session_state.end_date.strftime('%B %d, %Y')} ({st.session_state.days} days)")
-        st.markdown(st.session_state.plan_md)
-
-        st.markdown("---")
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            try:
-                pdf_path = generate_pdf(
-                    st.session_state.plan_md,
-                    st.session_state.destination,
-                    st.session_state.source_city,
-                    st.session_state.start_date,
-                    st.session_state.end_date,
-                    st.session_state.days,
-                )
-                with open(pdf_path, "rb") as f:
-                    st.download_button(
-                        "📄 Download PDF",
-                        f,
-                        file_name=pdf_path,
-                        mime="application/pdf",
-                        use_container_width=True,
-                    )
-            except Exception as e:
-                st.error(f"Error generating PDF: {str(e)}")
 
-        with col2:
-            if st.button("🔄 Start Over", use_container_width=True):
-                reset_form()
\ No newline at end of file
+if __name__ == "__main__":
+    main()